@@ -1,11 +1,18 @@
 from datetime import datetime, timedelta
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import time
+import bcrypt
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from passlib.hash import bcrypt as bcrypt_scheme
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from database import get_users_collection
 from models import TokenData
+from user_cache import user_cache
+from projections import AUTH_USER_PROJECTION
 import os
 from dotenv import load_dotenv
 
@@ -16,8 +23,22 @@ SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key")
 ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("JWT_EXPIRE_MINUTES", "30"))
 
+# Password hashing configurations
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "64"))
+# When set, bcrypt rounds are tuned at startup so one hash takes about this long.
+# Tuning only ever raises the cost above passlib's default, never lowers it
+PASSWORD_HASH_TARGET_MS = float(os.getenv("PASSWORD_HASH_TARGET_MS", "0"))
+BCRYPT_MIN_ROUNDS = bcrypt_scheme.default_rounds
+BCRYPT_MAX_ROUNDS = 16
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+# bcrypt releases the GIL, so a small thread pool keeps it off the event loop
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_pending_password_jobs = 0
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
@@ -27,6 +48,52 @@ def get_password_hash(password: str) -> str:
     """Hash a password"""
     return pwd_context.hash(password)
 
+async def _run_password_job(func, *args):
+    """Run bcrypt work in the password pool, shedding load once the queue is full"""
+    global _pending_password_jobs
+    if _pending_password_jobs >= PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many authentication requests, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    
+    _pending_password_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, func, *args)
+    finally:
+        _pending_password_jobs -= 1
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password without blocking the event loop"""
+    return await _run_password_job(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    """Hash a password without blocking the event loop"""
+    return await _run_password_job(get_password_hash, password)
+
+def calibrate_bcrypt_rounds(target_ms: float) -> int:
+    """Pick the highest bcrypt cost whose hash time stays within target_ms, at least the default"""
+    started = time.perf_counter()
+    bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds=BCRYPT_MIN_ROUNDS))
+    base_ms = (time.perf_counter() - started) * 1000
+    
+    # Each extra round doubles the cost
+    rounds = BCRYPT_MIN_ROUNDS
+    while rounds < BCRYPT_MAX_ROUNDS and base_ms * 2 ** (rounds + 1 - BCRYPT_MIN_ROUNDS) <= target_ms:
+        rounds += 1
+    
+    pwd_context.update(bcrypt__rounds=rounds)
+    print(f"✅ bcrypt cost set to {rounds} rounds (~{base_ms * 2 ** (rounds - BCRYPT_MIN_ROUNDS):.0f} ms per hash)")
+    return rounds
+
+async def tune_password_hashing():
+    """Calibrate bcrypt rounds against PASSWORD_HASH_TARGET_MS, if configured"""
+    if PASSWORD_HASH_TARGET_MS > 0:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(password_executor, calibrate_bcrypt_rounds, PASSWORD_HASH_TARGET_MS)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
     to_encode = data.copy()
@@ -39,6 +106,22 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def get_token_subject(token: str) -> Optional[str]:
+    """Username from a JWT, or None when the token is missing or invalid"""
+    if not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    return payload.get("sub")
+
+async def get_optional_username(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+) -> Optional[str]:
+    """Username of the caller when a valid token is sent; never fails the request"""
+    return get_token_subject(credentials.credentials) if credentials else None
+
 async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Verify JWT token and return user data"""
     credentials_exception = HTTPException(
@@ -56,11 +139,16 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
     except JWTError:
         raise credentials_exception
     
+    user = user_cache.get(token_data.username)
+    if user is not None:
+        return user
+    
     users_collection = await get_users_collection()
-    user = await users_collection.find_one({"username": token_data.username})
+    user = await users_collection.find_one({"username": token_data.username}, AUTH_USER_PROJECTION)
     if user is None:
         raise credentials_exception
     
+    user_cache.set(token_data.username, user)
     return user
 
 async def get_current_user(user: dict = Depends(verify_token)):
@@ -0,0 +1,155 @@
+"""
+Chat broadcast backplane.
+
+ConnectionManager publishes every serialized chat frame here exactly once;
+the backplane hands it back to each worker, which delivers it to its own
+local sockets. The in-process backplane is used for a single worker, the
+Redis one when chat runs across several workers or pods.
+
+A worker subscribes to a stream's channel when its first local socket
+joins and unsubscribes when the last one leaves, so it only receives the
+streams it serves. Notifications subscribe to every channel instead.
+"""
+from typing import Awaitable, Callable, Optional, Set
+import asyncio
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHAT_BACKPLANE_URL = os.getenv("CHAT_BACKPLANE_URL", "")
+CHAT_CHANNEL_PREFIX = os.getenv("CHAT_CHANNEL_PREFIX", "twitch_clone:chat:")
+
+MessageHandler = Callable[[str, str], Awaitable[None]]
+
+
+class Backplane:
+    """Publishes frames per stream and delivers them to a local handler"""
+
+    def __init__(self):
+        self.handler: Optional[MessageHandler] = None
+
+    async def start(self, handler: MessageHandler):
+        self.handler = handler
+
+    async def subscribe(self, stream_id: str):
+        """Start receiving a stream's frames on this worker"""
+
+    async def unsubscribe(self, stream_id: str):
+        """Stop receiving a stream's frames on this worker"""
+
+    def receives(self, stream_id: str) -> bool:
+        """Whether every frame published for the stream reaches this worker"""
+        return True
+
+    async def publish(self, stream_id: str, frame: str):
+        raise NotImplementedError
+
+    async def close(self):
+        self.handler = None
+
+
+class InProcessBackplane(Backplane):
+    """Delivers straight back to this process, for single-worker deployments"""
+
+    async def publish(self, stream_id: str, frame: str):
+        if self.handler:
+            await self.handler(stream_id, frame)
+
+
+class RedisBackplane(Backplane):
+    """Redis pub/sub backplane shared by every worker connected to the same server"""
+
+    def __init__(
+        self,
+        url: str = CHAT_BACKPLANE_URL,
+        client=None,
+        channel_prefix: str = CHAT_CHANNEL_PREFIX,
+        subscribe_all: bool = False
+    ):
+        super().__init__()
+        self.url = url
+        self.client = client
+        self.channel_prefix = channel_prefix
+        self.subscribe_all = subscribe_all
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+        self._streams: Set[str] = set()
+        # The pubsub connection only exists after the first subscription
+        self._subscribed = asyncio.Event()
+
+    async def start(self, handler: MessageHandler):
+        await super().start(handler)
+        if self.client is None:
+            # Only needed when a Redis URL is configured
+            import redis.asyncio as redis
+            self.client = redis.from_url(self.url, decode_responses=True)
+
+        self._pubsub = self.client.pubsub()
+        if self.subscribe_all:
+            await self._pubsub.psubscribe(f"{self.channel_prefix}*")
+            self._subscribed.set()
+        self._listener = asyncio.create_task(self._listen())
+        print(f"✅ Backplane connected: {self.channel_prefix}* on {self.url or 'injected client'}")
+
+    async def subscribe(self, stream_id: str):
+        if self.subscribe_all or stream_id in self._streams:
+            return
+        self._streams.add(stream_id)
+        await self._pubsub.subscribe(f"{self.channel_prefix}{stream_id}")
+        self._subscribed.set()
+
+    async def unsubscribe(self, stream_id: str):
+        if stream_id not in self._streams:
+            return
+        self._streams.discard(stream_id)
+        await self._pubsub.unsubscribe(f"{self.channel_prefix}{stream_id}")
+
+    def receives(self, stream_id: str) -> bool:
+        return self.subscribe_all or stream_id in self._streams
+
+    async def publish(self, stream_id: str, frame: str):
+        await self.client.publish(f"{self.channel_prefix}{stream_id}", frame)
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            self._listener = None
+        if self._pubsub is not None:
+            if self.subscribe_all:
+                await self._pubsub.punsubscribe()
+            elif self._streams:
+                await self._pubsub.unsubscribe()
+            await self._pubsub.aclose()
+            self._pubsub = None
+        self._streams.clear()
+        self._subscribed.clear()
+        await super().close()
+
+    async def _listen(self):
+        prefix_length = len(self.channel_prefix)
+        await self._subscribed.wait()
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                channel = message["channel"]
+                data = message["data"]
+                if isinstance(channel, bytes):
+                    channel = channel.decode()
+                if isinstance(data, bytes):
+                    data = data.decode()
+                await self.handler(channel[prefix_length:], data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Chat backplane error: {e}")
+                await asyncio.sleep(1)
+
+
+def create_backplane(channel_prefix: str = CHAT_CHANNEL_PREFIX, subscribe_all: bool = False) -> Backplane:
+    """Pick the backplane from CHAT_BACKPLANE_URL (empty means in-process)"""
+    if CHAT_BACKPLANE_URL.startswith(("redis://", "rediss://")):
+        return RedisBackplane(CHAT_BACKPLANE_URL, channel_prefix=channel_prefix, subscribe_all=subscribe_all)
+    return InProcessBackplane()
@@ -0,0 +1,534 @@
+"""
+Load benchmark for chat fan-out and the REST hot paths.
+
+Runs the real app in-process (uvicorn on a free local port) against an
+in-memory MongoDB stand-in (mongomock-motor), or against a throwaway
+database on a real server with --mongo-url. Reports:
+
+  chat  N streams x M viewers with one sender per stream at a fixed rate:
+        p50/p99 delivery latency, delivered messages per second and memory
+        per viewer connection. The WebSocket clients run in a child process,
+        so tracemalloc in this process only sees the server's allocations;
+        any client that fails to connect or errors out fails the run
+  rest  /api/streams/live, /api/chat/{id}/messages, /api/categories/ and
+        /api/auth/login at a fixed concurrency: p50/p99 latency and
+        requests per second; any failed request fails the run
+
+Results can be saved as a baseline and later runs compared against it;
+the exit status is 1 when a request failed or a metric regressed past
+the tolerance (a baseline is not saved from a failed run).
+
+Run from the backend directory (needs httpx and mongomock-motor, see
+benchmarks/requirements.txt):
+    python -m benchmarks.bench_load --save-baseline benchmarks/baseline.json
+    python -m benchmarks.bench_load --baseline benchmarks/baseline.json
+"""
+import os
+
+# Make the limits that protect production chat stay out of the way of the
+# load generator; must be set before the app modules read their config
+os.environ.setdefault("CHAT_SLOW_MODE_SECONDS", "0")
+os.environ.setdefault("CHAT_STREAM_MESSAGES_PER_SECOND", "1000000")
+os.environ.setdefault("CHAT_STREAM_BURST", "1000000")
+os.environ["CHAT_BACKPLANE_URL"] = ""
+
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import random
+import socket
+import sys
+import time
+import tracemalloc
+
+import httpx
+import uvicorn
+import websockets
+
+from auth_utils import get_password_hash
+from category_utils import slugify
+from chat_protocol import FRAME_BATCH, FRAME_CHAT, FRAME_OTHER, msgpack
+from database import db
+
+BENCH_DATABASE = "twitch_clone_bench"
+BENCH_USER = "bench_user"
+BENCH_PASSWORD = "bench-password"
+BENCH_MARKER = "bench:"
+CATEGORIES = ["Just Chatting", "Gaming", "Music", "Art", "Science & Technology", "Sports"]
+SENDER_NAMES = [f"chatter_{i}" for i in range(50)]
+
+# Metrics where a higher value is better; everything else is lower-is-better
+HIGHER_IS_BETTER = {"messages_per_second", "requests_per_second", "delivery_ratio"}
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[int(round(q * (len(ordered) - 1)))]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def use_database(mongo_url: Optional[str]):
+    """Point database.py at the benchmark database before the app starts"""
+    if mongo_url:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        db.client = AsyncIOMotorClient(mongo_url)
+    else:
+        from mongomock_motor import AsyncMongoMockClient
+        db.client = AsyncMongoMockClient()
+    db.database_name = BENCH_DATABASE
+
+
+async def seed(streams: int, chat_messages: int) -> List[str]:
+    """Insert users, categories, live streams and chat history; returns the stream ids"""
+    database = db.client[db.database_name]
+    now = datetime.utcnow()
+
+    await database.users.insert_one({
+        "username": BENCH_USER,
+        "email": f"{BENCH_USER}@example.com",
+        "full_name": "Bench User",
+        "hashed_password": get_password_hash(BENCH_PASSWORD),
+        "bio": "",
+        "followers_count": 0,
+        "following_count": 0,
+        "is_streaming": False,
+        "is_active": True,
+        "created_at": now
+    })
+    streamers = await database.users.insert_many([{
+        "username": f"streamer_{i}",
+        "email": f"streamer_{i}@example.com",
+        "full_name": f"Streamer {i}",
+        "hashed_password": "",
+        "is_streaming": True,
+        "is_active": True,
+        "created_at": now
+    } for i in range(streams)])
+
+    await database.categories.insert_many([{
+        "name": name,
+        "slug": slugify(name),
+        "description": f"{name} streams",
+        "thumbnail_url": None,
+        "viewer_count": 0,
+        "stream_count": 0
+    } for name in CATEGORIES])
+
+    result = await database.streams.insert_many([{
+        "streamer_id": streamer_id,
+        "streamer_username": f"streamer_{i}",
+        "title": f"Benchmark stream {i}",
+        "description": "",
+        "category": CATEGORIES[i % len(CATEGORIES)],
+        "category_slug": slugify(CATEGORIES[i % len(CATEGORIES)]),
+        "thumbnail_url": None,
+        "viewer_count": random.randint(0, 20000),
+        "is_live": True,
+        "started_at": now - timedelta(minutes=i),
+        "created_at": now
+    } for i, streamer_id in enumerate(streamers.inserted_ids)])
+
+    for stream_id in result.inserted_ids:
+        if chat_messages:
+            await database.chat_messages.insert_many([{
+                "stream_id": stream_id,
+                "user_id": None,
+                "username": random.choice(SENDER_NAMES),
+                "message": f"History message {i}",
+                "color": "#9146FF",
+                "timestamp": now - timedelta(seconds=chat_messages - i)
+            } for i in range(chat_messages)])
+    return [str(stream_id) for stream_id in result.inserted_ids]
+
+
+class ChatStats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.delivered = 0
+        self.sent = 0
+        self.connected = 0
+        self.errors: List[str] = []
+
+
+def parse_frame(raw, protocol: str) -> Tuple[bool, List[str]]:
+    """(is a heartbeat ping, chat message texts) for a received JSON or compact frame"""
+    if protocol == "json":
+        data = json.loads(raw)
+        frame_type = data.get("type")
+        if frame_type == "chat_batch":
+            return False, [message["message"] for message in data["messages"]]
+        if frame_type == "chat_message":
+            return False, [data["message"]]
+        return frame_type == "ping", []
+
+    data = msgpack.unpackb(raw)
+    if data[0] == FRAME_BATCH:
+        return False, [frame[3] for frame in data[1] if frame[0] == FRAME_CHAT]
+    if data[0] == FRAME_CHAT:
+        return False, [data[3]]
+    return data[0] == FRAME_OTHER and data[1].get("type") == "ping", []
+
+
+async def viewer(url: str, protocol: str, stats: ChatStats, handshakes: asyncio.Semaphore, settled: Callable[[], None]):
+    subprotocols = ["chat.msgpack.v1"] if protocol == "msgpack" else None
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            # Limit concurrent handshakes only, not open connections
+            async with handshakes:
+                ws = await stack.enter_async_context(
+                    websockets.connect(url, subprotocols=subprotocols, max_queue=None)
+                )
+            stats.connected += 1
+            settled()
+            async for raw in ws:
+                now = time.perf_counter()
+                ping, texts = parse_frame(raw, protocol)
+                if ping:
+                    await ws.send(json.dumps({"type": "pong"}))
+                for text in texts:
+                    if text.startswith(BENCH_MARKER):
+                        stats.latencies.append(now - float(text[len(BENCH_MARKER):]))
+                        stats.delivered += 1
+        stats.errors.append(f"viewer {url}: closed by the server")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        stats.errors.append(f"viewer {url}: {e!r}")
+    finally:
+        settled()
+
+
+async def sender(url: str, rate: float, duration: float, stats: ChatStats):
+    async with websockets.connect(url, max_queue=None) as ws:
+        # Keep the sender's own inbound queue empty
+        drain = asyncio.create_task(_drain(ws))
+        started = time.perf_counter()
+        sent = 0
+        while time.perf_counter() - started < duration:
+            await ws.send(json.dumps({
+                "username": random.choice(SENDER_NAMES),
+                "message": f"{BENCH_MARKER}{time.perf_counter()}",
+                "color": "#9146FF"
+            }))
+            sent += 1
+            stats.sent += 1
+            # Fixed schedule so a slow send does not lower the offered rate
+            delay = started + sent / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        drain.cancel()
+
+
+async def _drain(ws):
+    async for _ in ws:
+        pass
+
+
+async def _run_clients(conn, ws_base: str, stream_ids: List[str], viewers: int, protocol: str, rate: float, duration: float):
+    stats = ChatStats()
+    total = len(stream_ids) * viewers
+    ready = asyncio.Event()
+    handshakes = asyncio.Semaphore(100)
+
+    def settled():
+        # Every viewer has either connected or failed
+        if stats.connected + len(stats.errors) >= total:
+            ready.set()
+
+    tasks = [
+        asyncio.create_task(viewer(
+            f"{ws_base}/ws/chat/{stream_id}?session_id=bench-{stream_id}-{i}&heartbeat=1",
+            protocol, stats, handshakes, settled
+        ))
+        for stream_id in stream_ids
+        for i in range(viewers)
+    ]
+    try:
+        await asyncio.wait_for(ready.wait(), timeout=60)
+    except asyncio.TimeoutError:
+        stats.errors.append(f"only {stats.connected}/{total} viewers connected within 60s")
+    loop = asyncio.get_running_loop()
+    conn.send(("connected", stats.connected, stats.errors))
+
+    if not stats.errors and await loop.run_in_executor(None, conn.recv) == "go":
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            sender(f"{ws_base}/ws/chat/{stream_id}?session_id=bench-sender-{stream_id}&heartbeat=1", rate, duration, stats)
+            for stream_id in stream_ids
+        ), return_exceptions=True)
+        stats.errors.extend(f"sender: {result!r}" for result in results if isinstance(result, BaseException))
+        # Give in-flight messages (and batch windows) time to arrive
+        await asyncio.sleep(1)
+        elapsed = time.perf_counter() - started
+    else:
+        elapsed = 0.0
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    conn.send(("done", {
+        "latencies": stats.latencies,
+        "delivered": stats.delivered,
+        "sent": stats.sent,
+        "elapsed": elapsed,
+        "errors": stats.errors
+    }))
+
+
+def client_process(conn, *args):
+    """Entry point of the child process that runs every chat client"""
+    try:
+        asyncio.run(_run_clients(conn, *args))
+    finally:
+        conn.close()
+
+
+class ChatBenchmarkFailed(Exception):
+    pass
+
+
+async def run_chat(ws_base: str, stream_ids: List[str], args) -> Dict[str, float]:
+    from websocket_manager import manager
+
+    loop = asyncio.get_running_loop()
+    context = multiprocessing.get_context("spawn")
+    conn, child_conn = context.Pipe()
+    clients = context.Process(
+        target=client_process,
+        args=(child_conn, ws_base, stream_ids, args.viewers, args.protocol, args.rate, args.duration),
+        daemon=True
+    )
+
+    # Clients live in the child process, so everything traced here is server side
+    tracemalloc.start(25)
+    before = tracemalloc.take_snapshot()
+    clients.start()
+    try:
+        _, connected, errors = await loop.run_in_executor(None, conn.recv)
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        connections = sum(len(connections) for connections in manager.active_connections.values())
+        grown = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+        if not errors:
+            conn.send("go")
+        _, stats = await loop.run_in_executor(None, conn.recv)
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        await loop.run_in_executor(None, clients.join, 30)
+
+    if stats["errors"]:
+        raise ChatBenchmarkFailed(
+            f"{len(stats['errors'])} chat client errors ({connected} viewers connected), first: {stats['errors'][0]}"
+        )
+    expected = stats["sent"] * args.viewers
+    if not stats["delivered"]:
+        raise ChatBenchmarkFailed(f"no chat messages delivered ({stats['sent']} sent)")
+
+    latencies = stats["latencies"]
+    return {
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "messages_per_second": stats["delivered"] / stats["elapsed"],
+        "delivery_ratio": stats["delivered"] / expected,
+        "bytes_per_connection": grown / connections if connections else 0.0
+    }
+
+
+async def run_rest(
+    name: str,
+    request: Callable[[], Awaitable[httpx.Response]],
+    concurrency: int,
+    requests: int
+) -> Dict[str, float]:
+    latencies: List[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            started = time.perf_counter()
+            try:
+                response = await request()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    if errors:
+        print(f"❌ {name}: {errors}/{requests} requests failed")
+    return {
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "requests_per_second": requests / elapsed,
+        "errors": errors,
+        "error_rate": errors / requests
+    }
+
+
+async def run_rest_suite(http_base: str, stream_ids: List[str], args) -> Dict[str, Dict[str, float]]:
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=http_base, limits=limits, timeout=30) as client:
+        endpoints = {
+            "streams_live": (lambda: client.get("/api/streams/live"), args.requests),
+            "chat_history": (lambda: client.get(f"/api/chat/{stream_ids[0]}/messages"), args.requests),
+            "categories": (lambda: client.get("/api/categories/"), args.requests),
+            # bcrypt dominates login, so it gets fewer requests
+            "login": (
+                lambda: client.post("/api/auth/login", json={"username": BENCH_USER, "password": BENCH_PASSWORD}),
+                max(1, args.requests // 10)
+            ),
+        }
+        results = {}
+        for name, (request, requests) in endpoints.items():
+            # Warm caches and connections before measuring
+            await request()
+            results[name] = await run_rest(name, request, args.concurrency, requests)
+        return results
+
+
+async def run(args) -> dict:
+    use_database(args.mongo_url)
+    stream_ids = await seed(args.streams, args.chat_messages)
+
+    from main import app
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        if serving.done():
+            serving.result()
+        await asyncio.sleep(0.05)
+
+    results = {"config": {
+        "streams": args.streams,
+        "viewers": args.viewers,
+        "rate": args.rate,
+        "duration": args.duration,
+        "protocol": args.protocol,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "database": "mongodb" if args.mongo_url else "mongomock"
+    }}
+    try:
+        if not args.skip_chat:
+            results["chat"] = await run_chat(f"ws://127.0.0.1:{port}", stream_ids, args)
+        if not args.skip_rest:
+            results["rest"] = await run_rest_suite(f"http://127.0.0.1:{port}", stream_ids, args)
+    finally:
+        server.should_exit = True
+        await serving
+        if args.mongo_url:
+            await db.client.drop_database(BENCH_DATABASE)
+    return results
+
+
+def flatten(results: dict) -> Dict[str, float]:
+    metrics = {}
+    for name, value in results.get("chat", {}).items():
+        metrics[f"chat.{name}"] = value
+    for endpoint, values in results.get("rest", {}).items():
+        for name, value in values.items():
+            metrics[f"rest.{endpoint}.{name}"] = value
+    return metrics
+
+
+def report(results: dict, baseline: Optional[dict], tolerance: float) -> List[str]:
+    """
+    Print the results (against the baseline when given); returns the failed
+    metrics: any that regressed past the tolerance, and any request errors
+    at all, since a run that only produced errors would otherwise look fast.
+    """
+    current = flatten(results)
+    previous = flatten(baseline) if baseline else {}
+    if baseline and baseline.get("config") != results["config"]:
+        print(f"⚠️  Baseline was recorded with a different configuration: {baseline.get('config')}")
+
+    regressions = []
+    print(f"{'metric':<40}{'current':>14}{'baseline':>14}{'change':>10}")
+    for name, value in current.items():
+        failed_requests = name.endswith((".errors", ".error_rate")) and value > 0
+        if failed_requests:
+            regressions.append(name)
+        if name not in previous:
+            print(f"{name:<40}{value:>14.2f}{'  FAILED' if failed_requests else ''}")
+            continue
+        old = previous[name]
+        change = (value - old) / old if old else 0.0
+        worse = -change if name.rsplit(".", 1)[-1] in HIGHER_IS_BETTER else change
+        flag = "  FAILED" if failed_requests else ""
+        if worse > tolerance and not name.endswith((".errors", ".error_rate")):
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<40}{value:>14.2f}{old:>14.2f}{change:>+10.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--streams", type=int, default=10)
+    parser.add_argument("--viewers", type=int, default=50, help="viewers per stream")
+    parser.add_argument("--rate", type=float, default=10, help="chat messages per second per stream")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of chat traffic")
+    parser.add_argument("--protocol", choices=["json", "msgpack"], default="json")
+    parser.add_argument("--chat-messages", type=int, default=200, help="seeded chat history per stream")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=500, help="requests per REST endpoint")
+    parser.add_argument("--mongo-url", help="use a real MongoDB server instead of the in-memory stand-in")
+    parser.add_argument("--skip-chat", action="store_true")
+    parser.add_argument("--skip-rest", action="store_true")
+    parser.add_argument("--baseline", help="compare against results saved with --save-baseline")
+    parser.add_argument("--save-baseline", help="write the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression")
+    args = parser.parse_args()
+    if args.protocol == "msgpack" and msgpack is None:
+        parser.error("--protocol msgpack needs the msgpack package")
+
+    try:
+        results = asyncio.run(run(args))
+    except ChatBenchmarkFailed as e:
+        print(f"❌ Chat benchmark failed: {e}")
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+
+    failed = [name for name in regressions if name.endswith((".errors", ".error_rate"))]
+    if args.save_baseline and failed:
+        print("❌ Not saving a baseline from a run with failed requests")
+    elif args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"✅ Saved baseline to {args.save_baseline}")
+    if failed:
+        print(f"❌ Requests failed: {', '.join(failed)}")
+    if len(regressions) > len(failed):
+        print(f"❌ {len(regressions) - len(failed)} metrics regressed by more than {args.tolerance:.0%}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
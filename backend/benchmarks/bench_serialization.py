@@ -0,0 +1,92 @@
+"""
+Serialization benchmark for the /live and chat history payloads.
+
+Compares FastAPI's default path (response_model validation of List[dict] plus
+jsonable_encoder and json.dumps) with serialization.dumps on the same
+documents, and reports the CPU time spent per request.
+
+Run from the backend directory:
+    python -m benchmarks.bench_serialization
+"""
+from bson import ObjectId
+from datetime import datetime, timedelta
+from typing import Callable, List
+import argparse
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from serialization import dumps, orjson
+
+_list_of_dicts = TypeAdapter(List[dict])
+
+
+def sample_live_page(size: int) -> List[dict]:
+    now = datetime.utcnow()
+    return [{
+        "id": str(ObjectId()),
+        "streamer_id": str(ObjectId()),
+        "streamer_username": f"streamer_{i}",
+        "title": f"Live Stream number {i} with a reasonably long title",
+        "category": "Science & Technology",
+        "thumbnail_url": "https://images.unsplash.com/photo-1569965352022-f014c3ca4c5e",
+        "viewer_count": 20000 - i,
+        "is_live": True,
+        "started_at": now - timedelta(minutes=i),
+        "cursor": "WzIwMDAwLCB7IiRvaWQiOiAiNjVhMDAwMDAwMDAwMDAwMDAwMDAwMDAwIn1d"
+    } for i in range(size)]
+
+
+def sample_chat_page(size: int) -> List[dict]:
+    now = datetime.utcnow()
+    return [{
+        "id": str(ObjectId()),
+        "username": f"viewer_{i}",
+        "message": "This gameplay is insane! How are you so good at this?",
+        "color": "#9146FF",
+        "timestamp": now - timedelta(seconds=i),
+        "cursor": "WyIyMDI0LTAxLTAxVDAwOjAwOjAwWiIsIHsiJG9pZCI6ICI2NWEwIn1d"
+    } for i in range(size)]
+
+
+def fastapi_default(payload: List[dict]) -> bytes:
+    validated = _list_of_dicts.validate_python(payload)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def fast_path(payload: List[dict]) -> bytes:
+    return dumps(payload)
+
+
+def measure(func: Callable[[List[dict]], bytes], payload: List[dict], iterations: int) -> float:
+    """CPU microseconds per call"""
+    func(payload)
+    started = time.process_time()
+    for _ in range(iterations):
+        func(payload)
+    return (time.process_time() - started) / iterations * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"JSON backend: {'orjson' if orjson else 'stdlib json'}")
+    print(f"{'payload':<28}{'default (us)':>14}{'fast (us)':>12}{'saved':>10}")
+    for name, payload in [
+        ("/live (20 streams)", sample_live_page(20)),
+        ("/live (100 streams)", sample_live_page(100)),
+        ("chat history (50 msgs)", sample_chat_page(50)),
+        ("chat history (100 msgs)", sample_chat_page(100)),
+    ]:
+        default_us = measure(fastapi_default, payload, args.iterations)
+        fast_us = measure(fast_path, payload, args.iterations)
+        saved = 1 - fast_us / default_us if default_us else 0
+        print(f"{name:<28}{default_us:>14.1f}{fast_us:>12.1f}{saved:>9.0%}")
+
+
+if __name__ == "__main__":
+    main()
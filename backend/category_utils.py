@@ -0,0 +1,71 @@
+"""
+Category resolution and precomputed per-category counters.
+
+Streams store a normalized category_slug next to the display name, so
+category filters are exact indexed matches. Each category document keeps
+stream_count/viewer_count up to date incrementally as streams start, stop
+and change viewer count; reconcile_category_counters rebuilds them in bulk.
+"""
+from pymongo import ReturnDocument, UpdateOne
+from database import get_categories_collection, get_streams_collection
+from search_index import search_index
+import re
+
+_NON_SLUG_CHARS = re.compile(r"[^a-z0-9]+")
+
+
+def slugify(name: str) -> str:
+    """'Science & Technology' -> 'science-technology'"""
+    return _NON_SLUG_CHARS.sub("-", name.lower()).strip("-")
+
+
+async def adjust_category_counters(category_slug: str, streams: int = 0, viewers: int = 0):
+    """Apply a live stream/viewer delta to a category"""
+    if not category_slug or (streams == 0 and viewers == 0):
+        return
+    categories_collection = await get_categories_collection()
+    category = await categories_collection.find_one_and_update(
+        {"slug": category_slug},
+        {"$inc": {"stream_count": streams, "viewer_count": viewers}},
+        projection={"stream_count": 1, "viewer_count": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if category is not None:
+        search_index.update_category_rank(
+            category_slug, is_live=category["stream_count"] > 0, viewers=category["viewer_count"]
+        )
+
+
+async def reconcile_category_counters():
+    """Backfill missing stream slugs and recompute every category's counters"""
+    streams_collection = await get_streams_collection()
+    categories_collection = await get_categories_collection()
+
+    # Streams created before category_slug existed
+    unresolved = await streams_collection.distinct("category", {"category_slug": {"$exists": False}})
+    for name in unresolved:
+        await streams_collection.update_many(
+            {"category": name, "category_slug": {"$exists": False}},
+            {"$set": {"category_slug": slugify(name)}}
+        )
+
+    totals = await streams_collection.aggregate([
+        {"$match": {"is_live": True}},
+        {"$group": {
+            "_id": "$category_slug",
+            "stream_count": {"$sum": 1},
+            "viewer_count": {"$sum": "$viewer_count"}
+        }}
+    ]).to_list(length=None)
+    counters = {total["_id"]: total for total in totals}
+
+    categories = await categories_collection.find({}, {"slug": 1}).to_list(length=None)
+    updates = [
+        UpdateOne({"_id": category["_id"]}, {"$set": {
+            "stream_count": counters.get(category["slug"], {}).get("stream_count", 0),
+            "viewer_count": counters.get(category["slug"], {}).get("viewer_count", 0)
+        }})
+        for category in categories
+    ]
+    if updates:
+        await categories_collection.bulk_write(updates, ordered=False)
@@ -0,0 +1,98 @@
+"""
+In-memory ring buffer of the most recent chat messages per stream.
+
+Used to replay recent chat to sockets as they connect and to answer
+GET /api/chat/{stream_id}/messages without touching MongoDB whenever the
+requested window is already in memory.
+"""
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional, Set
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHAT_HISTORY_SIZE = int(os.getenv("CHAT_HISTORY_SIZE", "100"))
+CHAT_HISTORY_MAX_STREAMS = int(os.getenv("CHAT_HISTORY_MAX_STREAMS", "10000"))
+
+
+class ChatHistory:
+    def __init__(self, size: int = CHAT_HISTORY_SIZE, max_streams: int = CHAT_HISTORY_MAX_STREAMS):
+        self.size = size
+        self.max_streams = max_streams
+        # Least recently used streams are evicted first
+        self._streams: "OrderedDict[str, Deque[dict]]" = OrderedDict()
+        # Streams whose buffer is known to hold their entire chat history
+        self._complete: Set[str] = set()
+
+    def append(self, stream_id: str, message: dict):
+        """Record a formatted message (id, username, message, color, timestamp)"""
+        messages = self._streams.get(stream_id)
+        if messages is None:
+            messages = self._new_buffer(stream_id)
+        else:
+            self._streams.move_to_end(stream_id)
+
+        if len(messages) == self.size:
+            # The oldest message is about to fall off the end
+            self._complete.discard(stream_id)
+        messages.append(message)
+
+    def prime(self, stream_id: str, messages: List[dict], complete: bool = False):
+        """Seed an empty buffer with the newest messages loaded from MongoDB (oldest first)"""
+        if stream_id in self._streams:
+            # Live messages arrived meanwhile; they are newer than what was loaded
+            return
+        buffer = self._new_buffer(stream_id)
+        buffer.extend(messages[-self.size:])
+        if complete and len(messages) <= self.size:
+            self._complete.add(stream_id)
+
+    def recent(self, stream_id: str, limit: Optional[int] = None) -> List[dict]:
+        """The newest `limit` messages held in memory, oldest first"""
+        messages = self._streams.get(stream_id)
+        if not messages:
+            return []
+        if limit is None or limit >= len(messages):
+            return list(messages)
+        return list(messages)[-limit:]
+
+    def window(self, stream_id: str, skip: int, limit: int) -> Optional[List[dict]]:
+        """
+        Messages skip..skip+limit counted back from the newest, oldest first,
+        or None when that window is not fully held in memory.
+        """
+        messages = self._streams.get(stream_id)
+        if messages is None:
+            return None
+        available = len(messages)
+        if skip + limit > available and stream_id not in self._complete:
+            return None
+
+        end = max(available - skip, 0)
+        start = max(end - limit, 0)
+        return list(messages)[start:end]
+
+    def remove(self, stream_id: str, message_id: str):
+        messages = self._streams.get(stream_id)
+        if not messages:
+            return
+        for message in messages:
+            if message.get("id") == message_id:
+                messages.remove(message)
+                return
+
+    def clear(self, stream_id: str):
+        self._streams.pop(stream_id, None)
+        self._complete.discard(stream_id)
+
+    def _new_buffer(self, stream_id: str) -> Deque[dict]:
+        if len(self._streams) >= self.max_streams:
+            evicted, _ = self._streams.popitem(last=False)
+            self._complete.discard(evicted)
+        messages: Deque[dict] = deque(maxlen=self.size)
+        self._streams[stream_id] = messages
+        return messages
+
+
+chat_history = ChatHistory()
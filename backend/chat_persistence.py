@@ -0,0 +1,89 @@
+"""
+Write-behind persistence for WebSocket chat messages.
+
+Messages are queued in memory and written to chat_messages with insert_many
+once a batch fills up or the flush interval passes, so storing chat history
+never adds a database round trip to message delivery.
+"""
+from typing import List, Optional
+import asyncio
+import os
+from dotenv import load_dotenv
+from database import get_chat_collection
+
+load_dotenv()
+
+CHAT_FLUSH_BATCH_SIZE = int(os.getenv("CHAT_FLUSH_BATCH_SIZE", "100"))
+CHAT_FLUSH_INTERVAL_MS = int(os.getenv("CHAT_FLUSH_INTERVAL_MS", "250"))
+CHAT_BUFFER_MAX_SIZE = int(os.getenv("CHAT_BUFFER_MAX_SIZE", "5000"))
+
+# Queued by stop() to tell the flusher to write what it has and exit
+_STOP = object()
+
+
+class ChatWriteBuffer:
+    def __init__(
+        self,
+        batch_size: int = CHAT_FLUSH_BATCH_SIZE,
+        flush_interval_ms: int = CHAT_FLUSH_INTERVAL_MS,
+        max_size: int = CHAT_BUFFER_MAX_SIZE
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_size = max_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._flusher is None:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._flusher = asyncio.create_task(self._run())
+
+    async def add(self, message: dict):
+        """Queue a chat document; waits (backpressure) while the buffer is full"""
+        await self._queue.put(message)
+
+    async def stop(self):
+        """Flush everything still buffered and stop the flusher"""
+        if self._flusher is None:
+            return
+        await self._queue.put(_STOP)
+        await self._flusher
+        self._flusher = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+            if stopping:
+                return
+
+    async def _flush(self, batch: List[dict]):
+        try:
+            chat_collection = await get_chat_collection()
+            await chat_collection.insert_many(batch, ordered=False)
+        except Exception as e:
+            print(f"❌ Failed to persist {len(batch)} chat messages: {e}")
+
+
+chat_buffer = ChatWriteBuffer()
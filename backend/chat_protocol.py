@@ -0,0 +1,151 @@
+"""
+Compact binary chat protocol.
+
+Clients opt in by offering the "chat.msgpack.v1" WebSocket subprotocol (or
+?protocol=msgpack); everyone else keeps the JSON text protocol. Compact
+frames are MessagePack arrays:
+
+    [0, [[ref, string], ...]]                        define interned strings
+    [1, id, username_ref, message, ts_ms, color]      chat message
+    [2, {...}]                                       any other frame, as-is
+    [3, [frame, ...]]                                batch of frames 1/2
+
+Usernames and colors are interned per stream, so each message is encoded
+once for every compact viewer; a connection is sent the definitions it has
+not seen yet just before the first frame that uses them. Colors come from
+clients, so only the first MAX_INTERNED_COLORS distinct colors of a stream
+are interned; `color` is a ref (int) or, past that, the string itself.
+A username or color that is not a string is sent as-is rather than
+interned, so one malformed message cannot break a broadcast.
+When the username table fills up it starts over under a new generation and
+the frame is re-encoded against the new table. Messages sent by
+clients stay JSON text. permessage-deflate is negotiated by the server
+(uvicorn) for either protocol.
+"""
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple, Union
+from fastapi import WebSocket
+from serialization import loads
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depends on the environment
+    msgpack = None
+
+PROTOCOL_JSON = "json"
+PROTOCOL_MSGPACK = "msgpack"
+
+SUBPROTOCOLS = {
+    "chat.json.v1": PROTOCOL_JSON,
+    "chat.msgpack.v1": PROTOCOL_MSGPACK,
+}
+
+FRAME_DEFINE = 0
+FRAME_CHAT = 1
+FRAME_OTHER = 2
+FRAME_BATCH = 3
+
+# Interned strings per stream before the table starts over
+MAX_INTERNED = 65536
+# Distinct colors interned per stream; further colors are sent inline
+MAX_INTERNED_COLORS = 256
+
+
+def negotiate(websocket: WebSocket) -> Tuple[str, Optional[str]]:
+    """Pick the protocol for a socket; returns (protocol, subprotocol to accept)"""
+    for offered in websocket.scope.get("subprotocols", []):
+        protocol = SUBPROTOCOLS.get(offered)
+        if protocol == PROTOCOL_MSGPACK and msgpack is None:
+            continue
+        if protocol:
+            return protocol, offered
+
+    if websocket.query_params.get("protocol") == PROTOCOL_MSGPACK and msgpack is not None:
+        return PROTOCOL_MSGPACK, None
+    return PROTOCOL_JSON, None
+
+
+@dataclass
+class CompactFrame:
+    body: bytes
+    # Interned strings the body refers to
+    refs: Dict[int, str]
+    generation: int
+
+
+class CompactEncoder:
+    """Per-stream intern table and JSON frame -> MessagePack encoder"""
+
+    def __init__(self):
+        self.generation = 0
+        self._refs: Dict[str, int] = {}
+        self._colors = 0
+
+    def encode(self, frame: str) -> CompactFrame:
+        data = loads(frame)
+        refs: Dict[int, str] = {}
+        try:
+            payload = self._compact(data, refs)
+        except _TableFull:
+            # Start a new table and encode the whole frame against it, so no
+            # ref from the old generation ends up in the frame
+            self._refs.clear()
+            self._colors = 0
+            self.generation += 1
+            refs = {}
+            payload = self._compact(data, refs)
+        return CompactFrame(body=msgpack.packb(payload), refs=refs, generation=self.generation)
+
+    @staticmethod
+    def define_frame(refs: Dict[int, str]) -> bytes:
+        return msgpack.packb([FRAME_DEFINE, [[ref, value] for ref, value in refs.items()]])
+
+    def _compact(self, data: dict, refs: Dict[int, str]) -> list:
+        frame_type = data.get("type")
+        if frame_type == "chat_message":
+            return [
+                FRAME_CHAT,
+                data.get("id"),
+                self._intern(data.get("username"), refs),
+                data.get("message"),
+                _epoch_ms(data.get("timestamp")),
+                self._intern_color(data.get("color"), refs)
+            ]
+        if frame_type == "chat_batch":
+            return [FRAME_BATCH, [self._compact(message, refs) for message in data["messages"]]]
+        return [FRAME_OTHER, data]
+
+    def _intern(self, value: str, refs: Dict[int, str]) -> Union[int, str]:
+        if not isinstance(value, str):
+            return value
+        ref = self._refs.get(value)
+        if ref is None:
+            if len(self._refs) >= MAX_INTERNED:
+                raise _TableFull()
+            ref = self._refs[value] = len(self._refs)
+        refs[ref] = value
+        return ref
+
+    def _intern_color(self, value: str, refs: Dict[int, str]) -> Union[int, str]:
+        if not isinstance(value, str):
+            return value
+        if value not in self._refs:
+            if self._colors >= MAX_INTERNED_COLORS:
+                return value
+            self._colors += 1
+        return self._intern(value, refs)
+
+
+class _TableFull(Exception):
+    """The intern table has no room for another string"""
+
+
+def _epoch_ms(timestamp: str) -> Optional[int]:
+    if not isinstance(timestamp, str):
+        return None
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is None:
+        # Chat timestamps are naive utcnow() values
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
@@ -1,53 +1,300 @@
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorClientSession, AsyncIOMotorCollection, AsyncIOMotorDatabase
 from pymongo.errors import ConnectionFailure
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest, PrimaryPreferred, Secondary, SecondaryPreferred
+from bson import json_util
+from bson.timestamp import Timestamp
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Optional, Tuple
+import asyncio
+import base64
 import os
+import time
 from dotenv import load_dotenv
+from metrics import mongo_command_listener
+from indexes import query_shapes, VERIFY_QUERY_PLANS
 
 load_dotenv()
 
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/twitch_clone")
 
+# Connection pool and timeouts (0 means no timeout)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "0"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "0"))
+# Wire compression, e.g. "zstd,snappy,zlib" (zstd and snappy need their own packages)
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
+# Connections opened at startup so the first requests do not pay for them
+MONGO_WARM_CONNECTIONS = int(os.getenv("MONGO_WARM_CONNECTIONS", str(MONGO_MIN_POOL_SIZE)))
+
+# Read routing: heavy read endpoints use a read profile; writes always go to the primary
+READ_PRIMARY = "primary"
+READ_DIRECTORY = "directory"  # live directory and categories
+READ_HISTORY = "history"      # chat history
+READ_PROFILE = "profile"      # user profiles and stream lists
+MONGO_SECONDARY_READS = os.getenv("MONGO_SECONDARY_READS", "false").lower() == "true"
+# Bounded staleness for secondary reads (MongoDB's minimum is 90 seconds)
+MONGO_MAX_STALENESS_SECONDS = int(os.getenv("MONGO_MAX_STALENESS_SECONDS", "90"))
+MONGO_SECONDARY_READ_CONCERN = os.getenv("MONGO_SECONDARY_READ_CONCERN", "local")
+# Read preference mode per profile, e.g. MONGO_READ_DIRECTORY=nearest
+READ_MODES = {
+    profile: os.getenv(
+        f"MONGO_READ_{profile.upper()}",
+        "secondaryPreferred" if MONGO_SECONDARY_READS else "primary"
+    )
+    for profile in (READ_DIRECTORY, READ_HISTORY, READ_PROFILE)
+}
+# How long an author's reads wait for their own latest write
+CAUSAL_WINDOW_SECONDS = float(os.getenv("MONGO_CAUSAL_WINDOW_SECONDS", str(MONGO_MAX_STALENESS_SECONDS)))
+CAUSAL_MAX_AUTHORS = int(os.getenv("MONGO_CAUSAL_MAX_AUTHORS", "10000"))
+# Carries an author's position to the client and back, so any worker can restore it
+CAUSAL_POSITION_HEADER = "X-Causal-Position"
+
+_READ_PREFERENCES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
 class Database:
     client: AsyncIOMotorClient = None
+    database: AsyncIOMotorDatabase = None
     database_name = "twitch_clone"
+    # Collection handles, resolved once per client
+    collections: Dict[str, AsyncIOMotorCollection] = {}
 
 db = Database()
 
-async def get_database():
-    if db.client is None:
+# Guards client creation so a cold-start burst cannot create several clients
+_connect_lock = asyncio.Lock()
+
+def _read_options(profile: str) -> dict:
+    """Collection options for a read profile; empty when it reads from the primary"""
+    mode = READ_MODES.get(profile, "primary")
+    if mode == "primary":
+        return {}
+    return {
+        "read_preference": _READ_PREFERENCES[mode](max_staleness=MONGO_MAX_STALENESS_SECONDS),
+        "read_concern": ReadConcern(MONGO_SECONDARY_READ_CONCERN),
+    }
+
+def reads_from_secondaries(profile: str) -> bool:
+    return bool(_read_options(profile))
+
+def _client_options() -> dict:
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS or None,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS or None,
+        "event_listeners": [mongo_command_listener],
+    }
+    if VERIFY_QUERY_PLANS:
+        # Explains every new query shape the app sends (see indexes.py)
+        options["event_listeners"].append(query_shapes)
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return options
+
+async def connect_to_mongo():
+    """Create the client once, check it and warm the connection pool"""
+    async with _connect_lock:
+        if db.client is not None:
+            return
+
+        client = AsyncIOMotorClient(MONGO_URL, **_client_options())
         try:
-            db.client = AsyncIOMotorClient(MONGO_URL)
             # Test the connection
-            await db.client.admin.command('ping')
+            await client.admin.command('ping')
+            # Concurrent pings each check out their own pooled connection
+            await asyncio.gather(*(client.admin.command('ping') for _ in range(MONGO_WARM_CONNECTIONS)))
             print(f"✅ Connected to MongoDB: {MONGO_URL}")
         except ConnectionFailure as e:
+            client.close()
             print(f"❌ Failed to connect to MongoDB: {e}")
             raise e
-    
-    return db.client[db.database_name]
+
+        db.client = client
+        db.database = None
+        db.collections = {}
+
+async def get_database():
+    if db.database is None:
+        if db.client is None:
+            await connect_to_mongo()
+        db.database = db.client[db.database_name]
+    return db.database
 
 async def close_database_connection():
     if db.client:
         db.client.close()
+        db.client = None
+        db.database = None
+        db.collections = {}
         print("👋 Disconnected from MongoDB")
 
-# Collections
-async def get_users_collection():
-    database = await get_database()
-    return database.users
+async def get_collection(name: str, profile: str = READ_PRIMARY) -> AsyncIOMotorCollection:
+    """Collection handle configured for a read profile, resolved once per client"""
+    key = f"{name}:{profile}"
+    collection = db.collections.get(key)
+    if collection is None:
+        database = await get_database()
+        options = _read_options(profile)
+        collection = db.collections[key] = database[name].with_options(**options) if options else database[name]
+    return collection
+
+def collection_for(name: str, profile: str):
+    """FastAPI dependency returning a collection routed by a read profile"""
+    async def dependency() -> AsyncIOMotorCollection:
+        return await get_collection(name, profile)
+    return dependency
+
+class CausalPositions:
+    """Cluster/operation time of each author's latest write, kept for a short window"""
+
+    def __init__(self, window_seconds: float = CAUSAL_WINDOW_SECONDS, max_authors: int = CAUSAL_MAX_AUTHORS):
+        self.window_seconds = window_seconds
+        self.max_authors = max_authors
+        self._positions: "OrderedDict[str, Tuple[dict, object, float]]" = OrderedDict()
+
+    def remember(self, author: str, session: AsyncIOMotorClientSession):
+        # Standalone servers have no cluster time to wait for
+        if session.operation_time is None or session.cluster_time is None:
+            return
+        self._positions[author] = (session.cluster_time, session.operation_time, time.monotonic() + self.window_seconds)
+        self._positions.move_to_end(author)
+        while len(self._positions) > self.max_authors:
+            self._positions.popitem(last=False)
+
+    def get(self, author: str) -> Optional[Tuple[dict, object]]:
+        position = self._positions.get(author)
+        if position is None:
+            return None
+        if position[2] <= time.monotonic():
+            del self._positions[author]
+            return None
+        return position[0], position[1]
+
+causal_positions = CausalPositions()
+
+# Per-request holder: the position the client sent back and the one its writes reached
+_request_positions: ContextVar[Optional[dict]] = ContextVar("causal_request_positions", default=None)
+
+def encode_position(cluster_time: dict, operation_time: Timestamp) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps([cluster_time, operation_time]).encode()).decode()
+
+def decode_position(value: str) -> Optional[Tuple[dict, Timestamp]]:
+    """Position from a client header; None when it is missing or malformed"""
+    if not value or len(value) > 1024:
+        return None
+    try:
+        cluster_time, operation_time = json_util.loads(base64.urlsafe_b64decode(value.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(operation_time, Timestamp) or not isinstance(cluster_time, dict):
+        return None
+    if not isinstance(cluster_time.get("clusterTime"), Timestamp):
+        return None
+    return cluster_time, operation_time
+
+def note_written_position(cluster_time: dict, operation_time: Timestamp):
+    """Send a write's position back with the current response"""
+    positions = _request_positions.get()
+    if positions is not None:
+        positions["written"] = (cluster_time, operation_time)
+
+def request_position() -> Optional[Tuple[dict, Timestamp]]:
+    """Position the client sent back with the current request"""
+    positions = _request_positions.get()
+    return positions["incoming"] if positions is not None else None
+
+class CausalPositionMiddleware:
+    """
+    Round-trips the author's position through the client, so read-your-writes
+    holds whichever worker serves the next request
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for name, value in scope["headers"]:
+            if name == b"x-causal-position":
+                incoming = decode_position(value.decode("latin-1"))
+        positions = {"incoming": incoming, "written": None}
+
+        async def send_with_position(message):
+            if message["type"] == "http.response.start" and positions["written"] is not None:
+                header = (b"x-causal-position", encode_position(*positions["written"]).encode())
+                message = {**message, "headers": [*message.get("headers", []), header]}
+            await send(message)
+
+        token = _request_positions.set(positions)
+        try:
+            await self.app(scope, receive, send_with_position)
+        finally:
+            _request_positions.reset(token)
+
+@asynccontextmanager
+async def write_session(author: str) -> AsyncIterator[Optional[AsyncIOMotorClientSession]]:
+    """
+    Causally consistent session for an author's writes. Its position is kept,
+    and returned to the client, so the author's next reads see the writes even
+    when routed to a secondary. Yields None when every read goes to the primary anyway.
+    """
+    if not any(mode != "primary" for mode in READ_MODES.values()):
+        yield None
+        return
+    await get_database()
+    async with await db.client.start_session(causal_consistency=True) as session:
+        yield session
+        causal_positions.remember(author, session)
+        if session.operation_time is not None and session.cluster_time is not None:
+            note_written_position(session.cluster_time, session.operation_time)
+
+@asynccontextmanager
+async def read_session(reader: Optional[str]) -> AsyncIterator[Optional[AsyncIOMotorClientSession]]:
+    """Session that waits for the reader's own recent writes, or None when they have none"""
+    candidates = (causal_positions.get(reader) if reader else None, request_position())
+    positions = [position for position in candidates if position is not None]
+    if not positions:
+        yield None
+        return
+    await get_database()
+    async with await db.client.start_session(causal_consistency=True) as session:
+        # Advancing only ever moves forward, so the later position wins
+        for cluster_time, operation_time in positions:
+            session.advance_cluster_time(cluster_time)
+            session.advance_operation_time(operation_time)
+        yield session
+
+# Collections (also used as FastAPI dependencies)
+async def get_users_collection() -> AsyncIOMotorCollection:
+    return await get_collection("users")
 
-async def get_streams_collection():
-    database = await get_database()
-    return database.streams
+async def get_streams_collection() -> AsyncIOMotorCollection:
+    return await get_collection("streams")
 
-async def get_chat_collection():
-    database = await get_database()
-    return database.chat_messages
+async def get_chat_collection() -> AsyncIOMotorCollection:
+    return await get_collection("chat_messages")
 
-async def get_categories_collection():
-    database = await get_database()
-    return database.categories
+async def get_categories_collection() -> AsyncIOMotorCollection:
+    return await get_collection("categories")
 
-async def get_follows_collection():
-    database = await get_database()
-    return database.follows
\ No newline at end of file
+async def get_follows_collection() -> AsyncIOMotorCollection:
+    return await get_collection("follows")
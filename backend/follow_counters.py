@@ -0,0 +1,181 @@
+"""
+Follower/following counters.
+
+Follow and unfollow only write the follows collection (an idempotent upsert
+or delete guarded by the unique follower/following index) and record the
+counter change here. Changes are coalesced per user in memory and written
+with one bulk_write of $inc updates per flush, so a creator gaining
+thousands of followers gets one update per interval instead of one per
+follow. A periodic reconciler recomputes every count from the follows
+collection in bulk to repair any drift, e.g. changes lost in a crash.
+
+Other workers may hold deltas that are already reflected in the follows
+collection but not yet in the counters, so the reconciler must not simply
+overwrite them. Every flush bumps the user's follow_counts_version; the
+reconciler notes the versions, aggregates, waits long enough for pending
+deltas everywhere to be flushed, and only writes users whose version did
+not move, with the version in the update filter.
+"""
+from pymongo import UpdateOne
+from bson import ObjectId
+from typing import Dict, Optional, Set
+import asyncio
+import os
+from dotenv import load_dotenv
+from database import get_follows_collection, get_users_collection
+from user_cache import user_cache
+
+load_dotenv()
+
+FOLLOW_COUNTER_FLUSH_INTERVAL_SECONDS = float(os.getenv("FOLLOW_COUNTER_FLUSH_INTERVAL_SECONDS", "2"))
+# 0 disables the periodic reconcile
+FOLLOW_RECONCILE_INTERVAL_SECONDS = float(os.getenv("FOLLOW_RECONCILE_INTERVAL_SECONDS", "3600"))
+FOLLOW_RECONCILE_BATCH_SIZE = int(os.getenv("FOLLOW_RECONCILE_BATCH_SIZE", "1000"))
+# How long the reconciler waits for every worker to flush deltas recorded before its aggregate
+FOLLOW_RECONCILE_SETTLE_SECONDS = float(
+    os.getenv("FOLLOW_RECONCILE_SETTLE_SECONDS", str(3 * FOLLOW_COUNTER_FLUSH_INTERVAL_SECONDS))
+)
+
+
+class FollowCounters:
+    def __init__(
+        self,
+        flush_interval: float = FOLLOW_COUNTER_FLUSH_INTERVAL_SECONDS,
+        reconcile_interval: float = FOLLOW_RECONCILE_INTERVAL_SECONDS,
+        batch_size: int = FOLLOW_RECONCILE_BATCH_SIZE,
+        settle_seconds: float = FOLLOW_RECONCILE_SETTLE_SECONDS
+    ):
+        self.flush_interval = flush_interval
+        self.reconcile_interval = reconcile_interval
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+        # user _id -> {"followers_count": delta, "following_count": delta}
+        self._deltas: Dict[ObjectId, Dict[str, int]] = {}
+        # Cached users whose counts change on the next flush
+        self._usernames: Set[str] = set()
+        self._flusher: Optional[asyncio.Task] = None
+        self._reconciler: Optional[asyncio.Task] = None
+
+    def record(self, follower_id: ObjectId, following_id: ObjectId, delta: int, *usernames: str):
+        """Count a follow (+1) or unfollow (-1) towards the next flush"""
+        follower = self._deltas.setdefault(follower_id, {})
+        follower["following_count"] = follower.get("following_count", 0) + delta
+        following = self._deltas.setdefault(following_id, {})
+        following["followers_count"] = following.get("followers_count", 0) + delta
+        self._usernames.update(usernames)
+
+    async def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run_flusher())
+        if self._reconciler is None and self.reconcile_interval > 0:
+            self._reconciler = asyncio.create_task(self._run_reconciler())
+
+    async def stop(self):
+        for task in (self._flusher, self._reconciler):
+            if task is not None:
+                task.cancel()
+        self._flusher = self._reconciler = None
+        await self.flush()
+
+    async def flush(self):
+        """Apply the coalesced deltas with one bulk write"""
+        if not self._deltas:
+            return
+        deltas, self._deltas = self._deltas, {}
+        usernames, self._usernames = self._usernames, set()
+
+        updates = [
+            UpdateOne({"_id": user_id}, {"$inc": {**counts, "follow_counts_version": 1}})
+            for user_id, counts in deltas.items()
+            if any(counts.values())
+        ]
+        try:
+            if updates:
+                users_collection = await get_users_collection()
+                await users_collection.bulk_write(updates, ordered=False)
+        except Exception:
+            # Merge back so the next flush retries them
+            for user_id, counts in deltas.items():
+                pending = self._deltas.setdefault(user_id, {})
+                for field, delta in counts.items():
+                    pending[field] = pending.get(field, 0) + delta
+            self._usernames.update(usernames)
+            raise
+        user_cache.invalidate(*usernames)
+
+    async def reconcile(self) -> int:
+        """Recompute every user's counts from the follows collection; returns the users fixed"""
+        await self.flush()
+        follows_collection = await get_follows_collection()
+        users_collection = await get_users_collection()
+
+        # Versions before the aggregate: a user flushed after this point may
+        # have had deltas pending somewhere when the aggregate ran
+        versions = {
+            user["_id"]: user.get("follow_counts_version")
+            async for user in users_collection.find({}, {"follow_counts_version": 1})
+        }
+        following = {
+            total["_id"]: total["count"]
+            for total in await follows_collection.aggregate([
+                {"$group": {"_id": "$follower_id", "count": {"$sum": 1}}}
+            ]).to_list(length=None)
+        }
+        followers = {
+            total["_id"]: total["count"]
+            for total in await follows_collection.aggregate([
+                {"$group": {"_id": "$following_id", "count": {"$sum": 1}}}
+            ]).to_list(length=None)
+        }
+        # Deltas for follows the aggregate saw are flushed by every worker within this
+        await asyncio.sleep(self.settle_seconds)
+
+        fixed = 0
+        updates = []
+        stale_usernames = []
+        users = users_collection.find(
+            {}, {"username": 1, "followers_count": 1, "following_count": 1, "follow_counts_version": 1}
+        )
+        async for user in users:
+            version = user.get("follow_counts_version")
+            if user["_id"] not in versions or versions[user["_id"]] != version:
+                # Counters moved while reconciling; the next run checks them again
+                continue
+            counts = {
+                "followers_count": followers.get(user["_id"], 0),
+                "following_count": following.get(user["_id"], 0)
+            }
+            if user.get("followers_count") == counts["followers_count"] and user.get("following_count") == counts["following_count"]:
+                continue
+            # No-op if a flush lands between this read and the write
+            updates.append(UpdateOne({"_id": user["_id"], "follow_counts_version": version}, {"$set": counts}))
+            stale_usernames.append(user["username"])
+            if len(updates) >= self.batch_size:
+                fixed += (await users_collection.bulk_write(updates, ordered=False)).modified_count
+                updates = []
+        if updates:
+            fixed += (await users_collection.bulk_write(updates, ordered=False)).modified_count
+
+        user_cache.invalidate(*stale_usernames)
+        return fixed
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Follow counter flush failed: {e}")
+
+    async def _run_reconciler(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                fixed = await self.reconcile()
+                if fixed:
+                    print(f"🔧 Reconciled follow counts for {fixed} users")
+            except Exception as e:
+                print(f"❌ Follow counter reconcile failed: {e}")
+
+
+follow_counters = FollowCounters()
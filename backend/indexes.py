@@ -0,0 +1,299 @@
+"""
+Index registry and query-plan verification.
+
+INDEXES lists every index the routers rely on; ensure_indexes creates them
+idempotently at startup and from startup.py. QUERY_SHAPES holds the hot
+queries (built with the same helpers the routers use) and verify_query_plans
+explains each one at startup to make sure none falls back to a collection
+scan.
+
+With VERIFY_QUERY_PLANS=true, query_shapes also listens to every command the
+app sends. Each new filter/sort/pipeline shape is explained in the
+background and reported if it scans, so a query added to a router is checked
+without being listed anywhere. Queries with no filter at all read the whole
+collection on purpose (e.g. the reconcilers) and are skipped.
+
+Run `python indexes.py` to create the indexes and check every query plan.
+"""
+from pymongo import ASCENDING, DESCENDING, IndexModel, monitoring
+from pymongo.errors import OperationFailure, PyMongoError
+from bson import ObjectId
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+import asyncio
+import os
+import sys
+import threading
+from dotenv import load_dotenv
+from pagination import apply_cursor, encode_cursor
+
+load_dotenv()
+
+VERIFY_QUERY_PLANS = os.getenv("VERIFY_QUERY_PLANS", "false").lower() == "true"
+QUERY_SHAPE_CHECK_INTERVAL_SECONDS = float(os.getenv("QUERY_SHAPE_CHECK_INTERVAL_SECONDS", "10"))
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "streams": [
+        # /live and category listings, sorted by viewers with _id as the cursor tie-break
+        IndexModel([("is_live", ASCENDING), ("viewer_count", DESCENDING), ("_id", DESCENDING)],
+                   name="live_by_viewers"),
+        IndexModel([("is_live", ASCENDING), ("category_slug", ASCENDING), ("viewer_count", DESCENDING),
+                    ("_id", DESCENDING)], name="live_by_category"),
+        IndexModel([("streamer_id", ASCENDING), ("is_live", ASCENDING)], name="streamer_live"),
+        IndexModel([("streamer_username", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+                   name="streamer_history"),
+        # Backfill of streams missing category_slug, run on every start
+        IndexModel([("category_slug", ASCENDING)], name="category_slug"),
+        # Recent streams loaded by the search index rebuild
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+    ],
+    "chat_messages": [
+        IndexModel([("stream_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+                   name="stream_timeline"),
+    ],
+    "follows": [
+        IndexModel([("follower_id", ASCENDING), ("following_id", ASCENDING)],
+                   name="follower_following_unique", unique=True),
+        IndexModel([("follower_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+                   name="follower_timeline"),
+        IndexModel([("following_id", ASCENDING)], name="following"),
+    ],
+    "categories": [
+        IndexModel([("slug", ASCENDING)], name="slug_unique", unique=True),
+    ],
+}
+
+_SAMPLE_ID = ObjectId()
+
+
+def _page(query: Dict[str, Any], sort_field: str, direction: int, sample: Any, forward: bool = True):
+    """The (filter, sort) a router sends for a page after/before a cursor, via apply_cursor itself"""
+    query, sort, _ = apply_cursor(query, sort_field, direction, encode_cursor(sample, _SAMPLE_ID), forward)
+    return query, sort
+
+
+# (collection, filter, sort) of the hot router queries, checked at startup
+QUERY_SHAPES: List[Tuple[str, Dict[str, Any], Optional[List[Tuple[str, int]]]]] = [
+    ("users", {"username": "sample"}, None),
+    ("users", {"email": "sample@example.com"}, None),
+    ("users", {"_id": {"$in": [_SAMPLE_ID]}}, None),
+    ("streams", {"is_live": True}, [("viewer_count", DESCENDING), ("_id", DESCENDING)]),
+    ("streams", *_page({"is_live": True}, "viewer_count", DESCENDING, 0)),
+    ("streams", *_page({"is_live": True}, "viewer_count", DESCENDING, 0, forward=False)),
+    ("streams", {"is_live": True, "category_slug": "sample"},
+     [("viewer_count", DESCENDING), ("_id", DESCENDING)]),
+    ("streams", *_page({"is_live": True, "category_slug": "sample"}, "viewer_count", DESCENDING, 0)),
+    ("streams", {"is_live": True, "category_slug": {"$in": ["sample"]}}, None),
+    ("streams", {"_id": {"$in": [_SAMPLE_ID]}}, None),
+    ("streams", {"streamer_id": _SAMPLE_ID, "is_live": True}, None),
+    ("streams", {"streamer_username": "sample"}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("streams", *_page({"streamer_username": "sample"}, "created_at", DESCENDING, datetime.utcnow())),
+    ("streams", {"category_slug": {"$exists": False}}, None),
+    ("streams", {"$or": [{"is_live": True}, {"created_at": {"$gte": datetime.utcnow()}}]}, None),
+    ("chat_messages", {"stream_id": _SAMPLE_ID}, [("timestamp", DESCENDING), ("_id", DESCENDING)]),
+    ("chat_messages", *_page({"stream_id": _SAMPLE_ID}, "timestamp", DESCENDING, datetime.utcnow())),
+    ("follows", {"follower_id": _SAMPLE_ID, "following_id": _SAMPLE_ID}, None),
+    ("follows", {"follower_id": _SAMPLE_ID}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("follows", *_page({"follower_id": _SAMPLE_ID}, "created_at", DESCENDING, datetime.utcnow())),
+    ("categories", {"slug": "sample"}, None),
+    ("categories", {"slug": {"$in": ["sample"]}}, None),
+]
+
+
+async def ensure_indexes(database):
+    """Create every registered index; safe to run on every start"""
+    for collection_name, indexes in INDEXES.items():
+        try:
+            await database[collection_name].create_indexes(indexes)
+        except OperationFailure as e:
+            # e.g. duplicates preventing a unique index; keep the other collections going
+            print(f"❌ Failed to create indexes on {collection_name}: {e}")
+    print("✅ Database indexes ensured")
+
+
+def _plan_stages(plan: dict):
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+    # Slot-based engine plans nest the classic plan under queryPlan
+    if "queryPlan" in plan:
+        yield from _plan_stages(plan["queryPlan"])
+
+
+def _winning_plans(explanation):
+    """Winning plans anywhere in an explain result, e.g. under an aggregate's $cursor stage"""
+    if isinstance(explanation, dict):
+        for key, value in explanation.items():
+            if key == "winningPlan":
+                yield value
+            elif key != "rejectedPlans":
+                yield from _winning_plans(value)
+    elif isinstance(explanation, list):
+        for item in explanation:
+            yield from _winning_plans(item)
+
+
+def scans_collection(explanation: dict) -> bool:
+    return any("COLLSCAN" in _plan_stages(plan) for plan in _winning_plans(explanation))
+
+
+async def verify_query_plans(database) -> List[str]:
+    """Explain every registered query shape; returns the ones that scan a whole collection"""
+    collection_scans = []
+    for collection_name, query, sort in QUERY_SHAPES:
+        cursor = database[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        if scans_collection(await cursor.explain()):
+            collection_scans.append(f"{collection_name}.find({query}).sort({sort})")
+    return collection_scans
+
+
+async def check_query_plans(database):
+    """Raise if any registered query shape falls back to COLLSCAN"""
+    collection_scans = await verify_query_plans(database)
+    if collection_scans:
+        raise RuntimeError("Queries without index support:\n  " + "\n  ".join(collection_scans))
+    print(f"✅ All {len(QUERY_SHAPES)} query shapes use an index")
+
+
+# Commands whose plans are checked, and the parts of them that decide the plan
+_EXPLAINED_COMMANDS = ("find", "count", "distinct", "aggregate", "findAndModify", "update", "delete")
+_PLAN_FIELDS = ("filter", "query", "key", "sort", "pipeline", "hint")
+
+
+def query_shape(value: Any):
+    """A filter/sort/pipeline with every value replaced by its type name; keys and operators stay"""
+    if isinstance(value, dict):
+        return ("{}", *((key, query_shape(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        # $in lists share a shape whatever their length
+        shapes = []
+        for item in value:
+            shape = query_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return ("[]", *shapes)
+    return type(value).__name__
+
+
+class QueryShapeRecorder(monitoring.CommandListener):
+    """
+    Records the first command of every distinct query shape the app sends,
+    so check() can explain it. Registered on the client with VERIFY_QUERY_PLANS.
+    """
+
+    def __init__(self, interval: float = QUERY_SHAPE_CHECK_INTERVAL_SECONDS):
+        self.interval = interval
+        self._seen: Set[tuple] = set()
+        self._pending: List[Tuple[str, dict]] = []
+        self.collection_scans: List[str] = []
+        # Commands are started from pymongo's threads as well as the event loop
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def started(self, event):
+        command = self._plan_command(event.command_name, event.command)
+        if command is None:
+            return
+        shape = (event.database_name, query_shape(command))
+        with self._lock:
+            if shape in self._seen:
+                return
+            self._seen.add(shape)
+            self._pending.append((event.database_name, command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    @staticmethod
+    def _plan_command(name: str, command: dict) -> Optional[dict]:
+        """The part of a command worth explaining, or None for commands without a filter"""
+        if name not in _EXPLAINED_COMMANDS:
+            return None
+        plan_command = {name: command[name]}
+        if name in ("update", "delete"):
+            statements = command.get("updates" if name == "update" else "deletes") or []
+            if not statements or not statements[0].get("q"):
+                return None
+            statement = {"q": statements[0]["q"], "limit": statements[0].get("limit", 0)}
+            if name == "update":
+                statement["u"] = statements[0]["u"]
+            plan_command["updates" if name == "update" else "deletes"] = [statement]
+            return plan_command
+
+        plan_command.update((field, command[field]) for field in _PLAN_FIELDS if field in command)
+        if name == "findAndModify":
+            plan_command.update((field, command[field]) for field in ("update", "remove") if field in command)
+        if name == "aggregate":
+            pipeline = command.get("pipeline") or []
+            if not pipeline or not pipeline[0].get("$match"):
+                return None
+            plan_command["cursor"] = {}
+        elif not plan_command.get("filter") and not plan_command.get("query") and not plan_command.get("sort"):
+            return None
+        return plan_command
+
+    async def check(self, client) -> List[str]:
+        """Explain every shape recorded since the last check; returns the ones that scan"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        collection_scans = []
+        for database_name, command in pending:
+            try:
+                explanation = await client[database_name].command(
+                    {"explain": command, "verbosity": "queryPlanner"}
+                )
+            except PyMongoError as e:
+                print(f"❌ Could not explain {command}: {e}")
+                continue
+            if scans_collection(explanation):
+                collection_scans.append(str(command))
+        self.collection_scans.extend(collection_scans)
+        return collection_scans
+
+    def start(self, client):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(client))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, client):
+        while True:
+            try:
+                for command in await self.check(client):
+                    print(f"❌ Query without index support: {command}")
+            except Exception as e:
+                print(f"❌ Query plan check failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+query_shapes = QueryShapeRecorder()
+
+
+async def main():
+    from database import get_database
+
+    database = await get_database()
+    await ensure_indexes(database)
+    await check_query_plans(database)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
@@ -0,0 +1,77 @@
+"""
+Cached snapshot of the live directory (GET /api/streams/live).
+
+Pages are kept pre-serialized with an ETag per (category, paging) key. They
+expire after LIVE_DIRECTORY_TTL_SECONDS and are dropped as soon as a stream
+goes live or offline on this worker. Concurrent misses for the same page
+share a single rebuild.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable
+import asyncio
+import hashlib
+import os
+import time
+from dotenv import load_dotenv
+from serialization import dumps
+
+load_dotenv()
+
+LIVE_DIRECTORY_TTL_SECONDS = float(os.getenv("LIVE_DIRECTORY_TTL_SECONDS", "5"))
+LIVE_DIRECTORY_MAX_PAGES = int(os.getenv("LIVE_DIRECTORY_MAX_PAGES", "1000"))
+
+
+@dataclass
+class DirectoryPage:
+    body: bytes
+    etag: str
+    expires_at: float
+
+
+class LiveDirectory:
+    def __init__(self, ttl_seconds: float = LIVE_DIRECTORY_TTL_SECONDS, max_pages: int = LIVE_DIRECTORY_MAX_PAGES):
+        self.ttl_seconds = ttl_seconds
+        self.max_pages = max_pages
+        self._pages: "OrderedDict[Hashable, DirectoryPage]" = OrderedDict()
+        self._rebuilds: Dict[Hashable, asyncio.Task] = {}
+        # Bumped on invalidation so a rebuild that started earlier is not cached
+        self._generation = 0
+
+    async def get(self, key: Hashable, load: Callable[[], Awaitable[list]]) -> DirectoryPage:
+        page = self._pages.get(key)
+        if page is not None and page.expires_at > time.monotonic():
+            self._pages.move_to_end(key)
+            return page
+
+        # Single-flight: every concurrent miss waits on the same rebuild
+        rebuild = self._rebuilds.get(key)
+        if rebuild is None:
+            rebuild = asyncio.create_task(self._rebuild(key, load))
+            self._rebuilds[key] = rebuild
+        return await asyncio.shield(rebuild)
+
+    def invalidate(self):
+        self._generation += 1
+        self._pages.clear()
+
+    async def _rebuild(self, key: Hashable, load: Callable[[], Awaitable[list]]) -> DirectoryPage:
+        generation = self._generation
+        try:
+            body = dumps(await load())
+            page = DirectoryPage(
+                body=body,
+                etag=f'"{hashlib.sha1(body).hexdigest()}"',
+                expires_at=time.monotonic() + self.ttl_seconds
+            )
+            if generation == self._generation:
+                self._pages[key] = page
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+            return page
+        finally:
+            del self._rebuilds[key]
+
+
+live_directory = LiveDirectory()
@@ -1,38 +1,86 @@
-from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from motor.motor_asyncio import AsyncIOMotorClient
 from contextlib import asynccontextmanager
 import os
+import re
+import uuid
 from dotenv import load_dotenv
-import json
 from typing import List, Dict, Any
 from datetime import datetime
+from bson import ObjectId
 
 # Load environment variables
 load_dotenv()
 
 # Import routers
-from routers import auth, users, streams, chat, categories
-from database import get_database
-from websocket_manager import ConnectionManager
-
-# WebSocket connection manager
-manager = ConnectionManager()
+from routers import auth, users, streams, chat, categories, search
+from database import connect_to_mongo, close_database_connection, get_database, CausalPositionMiddleware, CAUSAL_POSITION_HEADER
+from websocket_manager import manager, chat_message_frame, HEARTBEAT_INTERVAL_SECONDS, IDLE_TIMEOUT_SECONDS
+from chat_persistence import chat_buffer
+from indexes import ensure_indexes, check_query_plans, query_shapes, VERIFY_QUERY_PLANS
+from category_utils import reconcile_category_counters
+from user_cache import user_cache
+from auth_utils import tune_password_hashing, password_executor, get_token_subject
+from presence import presence
+from follow_counters import follow_counters
+from notifications import notifications
+from search_index import search_index
+from serialization import FastJSONResponse, loads, dumps_str
+from rate_limit import chat_rate_limiter, sender_key
+import metrics
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     print("🚀 Starting Twitch Clone Backend...")
+    try:
+        # Connect once up front rather than on the first request
+        await connect_to_mongo()
+        database = await get_database()
+        await ensure_indexes(database)
+        # Repair any counter drift from a previous run
+        await reconcile_category_counters()
+        await search_index.rebuild()
+    except Exception as e:
+        print(f"❌ Database bootstrap failed: {e}")
+    if VERIFY_QUERY_PLANS:
+        # Refuse to start when a router query would scan a whole collection
+        await check_query_plans(await get_database())
+        # ...and keep checking every query shape actually sent from here on
+        query_shapes.start((await get_database()).client)
+    await tune_password_hashing()
+    await manager.start()
+    await notifications.start()
+    await chat_buffer.start()
+    await presence.start()
+    await follow_counters.start()
+    await search_index.start()
+    metrics.loop_lag_monitor.start()
     yield
     # Shutdown
     print("👋 Shutting down Twitch Clone Backend...")
+    await manager.close()
+    await notifications.close()
+    await metrics.loop_lag_monitor.stop()
+    await presence.stop()
+    await search_index.stop()
+    # Apply pending follower/following count changes
+    await follow_counters.stop()
+    await chat_rate_limiter.close()
+    # Write out any chat still waiting in the buffer
+    await chat_buffer.stop()
+    password_executor.shutdown(wait=False)
+    await query_shapes.stop()
+    await close_database_connection()
 
 app = FastAPI(
     title="Twitch Clone API",
     description="A powerful streaming platform backend",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
 # CORS middleware
@@ -42,7 +90,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[CAUSAL_POSITION_HEADER],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(CausalPositionMiddleware)
 
 # Include routers
 app.include_router(auth.router, prefix="/api/auth", tags=["Authentication"])
@@ -50,6 +101,7 @@ app.include_router(users.router, prefix="/api/users", tags=["Users"])
 app.include_router(streams.router, prefix="/api/streams", tags=["Streams"])
 app.include_router(chat.router, prefix="/api/chat", tags=["Chat"])
 app.include_router(categories.router, prefix="/api/categories", tags=["Categories"])
+app.include_router(search.router, prefix="/api/search", tags=["Search"])
 
 @app.get("/")
 async def root():
@@ -61,32 +113,138 @@ async def health_check():
         db = await get_database()
         # Simple ping to check database connection
         await db.command("ping")
-        return {"status": "healthy", "database": "connected", "timestamp": datetime.utcnow()}
+        return {
+            "status": "healthy",
+            "database": "connected",
+            "timestamp": datetime.utcnow(),
+            "user_cache": user_cache.stats()
+        }
     except Exception as e:
         return {"status": "unhealthy", "database": "disconnected", "error": str(e)}
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+# Bounds for fields of chat messages sent over the socket (as in ChatMessageCreate)
+CHAT_MAX_MESSAGE_LENGTH = 500
+CHAT_MAX_USERNAME_LENGTH = 30
+CHAT_DEFAULT_COLOR = "#9146FF"
+_CHAT_COLOR = re.compile(r"^#[0-9A-Fa-f]{3,8}$")
+
+def _chat_text(value: Any, max_length: int) -> str:
+    """A client-supplied field as a bounded string; anything else counts as empty"""
+    return value.strip()[:max_length] if isinstance(value, str) else ""
+
 # WebSocket endpoint for real-time chat
 @app.websocket("/ws/chat/{stream_id}")
 async def websocket_chat_endpoint(websocket: WebSocket, stream_id: str):
+    # Identify the viewer so several tabs/sockets count once
+    username = get_token_subject(websocket.query_params.get("token"))
+    viewer_key = presence.viewer_key(
+        username=username,
+        session_id=websocket.query_params.get("session_id")
+    )
+    # Session ids and names are chosen by the client, so anonymous senders are
+    # rate limited by address (through trusted proxies) or per connection
+    rate_key = sender_key(
+        username,
+        websocket.client.host if websocket.client else None,
+        websocket.headers.get("x-forwarded-for"),
+        uuid.uuid4().hex
+    )
     await manager.connect(websocket, stream_id)
     try:
+        await presence.join(stream_id, viewer_key)
         while True:
             # Receive message from client
             data = await websocket.receive_text()
-            message_data = json.loads(data)
+            manager.mark_alive(websocket, stream_id)
+            try:
+                message_data = loads(data)
+            except ValueError:
+                continue
+            if not isinstance(message_data, dict) or message_data.get("type") == "pong":
+                continue
+            # Everything below ends up in every viewer's frame and in history
+            text = _chat_text(message_data.get("message"), CHAT_MAX_MESSAGE_LENGTH)
+            if not text:
+                continue
+            color = message_data.get("color")
+            if not isinstance(color, str) or not _CHAT_COLOR.match(color):
+                color = CHAT_DEFAULT_COLOR
+            
+            # Slow mode / flood protection, before anything is broadcast or stored
+            retry_after = await chat_rate_limiter.check(stream_id, rate_key)
+            if retry_after:
+                await manager.send_personal_message(dumps_str({
+                    "type": "system",
+                    "message": f"You are sending messages too fast, wait {retry_after:.1f}s",
+                    "stream_id": stream_id,
+                    "retry_after": round(retry_after, 3)
+                }), websocket)
+                continue
+            
+            message_id = ObjectId()
+            chat_message = {
+                "id": str(message_id),
+                # Signed-in senders cannot post under someone else's name
+                "username": username or _chat_text(message_data.get("username"), CHAT_MAX_USERNAME_LENGTH) or "Anonymous",
+                "message": text,
+                "color": color,
+                "timestamp": datetime.utcnow()
+            }
             
             # Broadcast message to all clients in this stream
-            await manager.broadcast_to_stream(stream_id, {
-                "type": "chat_message",
-                "username": message_data.get("username", "Anonymous"),
-                "message": message_data.get("message", ""),
-                "timestamp": datetime.utcnow().isoformat(),
-                "color": message_data.get("color", "#9146FF")
+            await manager.broadcast_to_stream(stream_id, chat_message_frame(chat_message))
+            
+            # Persist in the background (write-behind)
+            await chat_buffer.add({
+                "_id": message_id,
+                "stream_id": ObjectId(stream_id) if ObjectId.is_valid(stream_id) else stream_id,
+                "user_id": None,
+                "username": chat_message["username"],
+                "message": chat_message["message"],
+                "color": chat_message["color"],
+                "timestamp": chat_message["timestamp"]
             })
             
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket, stream_id)
+        await presence.leave(stream_id, viewer_key)
+
+# WebSocket endpoint for live-status notifications
+@app.websocket("/ws/notifications")
+async def websocket_notifications_endpoint(websocket: WebSocket):
+    # Followers are identified by token; ?streams=id1,id2 and ?directory=true add more topics
+    stream_ids = [stream_id for stream_id in websocket.query_params.get("streams", "").split(",") if stream_id]
+    try:
+        # Inside the try: loading the user's follows can fail after the socket is registered
+        await notifications.connect(
+            websocket,
+            username=get_token_subject(websocket.query_params.get("token")),
+            stream_ids=stream_ids,
+            directory=websocket.query_params.get("directory", "false").lower() == "true"
+        )
+        while True:
+            # Clients can change the streams they watch without reconnecting
+            message_data = loads(await websocket.receive_text())
+            stream_id = message_data.get("stream_id", "")
+            if message_data.get("type") == "watch":
+                notifications.watch_stream(websocket, stream_id)
+            elif message_data.get("type") == "unwatch":
+                notifications.unwatch_stream(websocket, stream_id)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        notifications.disconnect(websocket)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
+    # Protocol-level pings keep clients that do not answer JSON heartbeats in check
+    uvicorn.run(
+        "main:app", host="0.0.0.0", port=8001, reload=True, ws_per_message_deflate=True,
+        ws_ping_interval=HEARTBEAT_INTERVAL_SECONDS, ws_ping_timeout=IDLE_TIMEOUT_SECONDS
+    )
\ No newline at end of file
@@ -0,0 +1,264 @@
+"""
+Prometheus-style metrics served at /metrics.
+
+A small registry of counters, gauges and histograms rendered in the
+Prometheus text format, plus the hot-path instrumentation that feeds it:
+an ASGI middleware timing every HTTP route, a pymongo command listener
+timing database operations per collection, and an event-loop lag monitor.
+Values are per worker process; Prometheus aggregates across workers.
+"""
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import asyncio
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from pymongo import monitoring
+
+load_dotenv()
+
+EVENT_LOOP_LAG_INTERVAL_SECONDS = float(os.getenv("EVENT_LOOP_LAG_INTERVAL_SECONDS", "0.5"))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; covers sub-millisecond cache hits up to multi-second stalls
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = Tuple[str, ...]
+
+_registry: List["Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Observations may come from pymongo's threads as well as the event loop
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _labels(self, labels: Labels, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterable[str]:
+        return []
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{self._labels(labels)} {value}"
+
+
+class Gauge(Metric):
+    """A gauge set directly, or computed at scrape time by a callback"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._function: Optional[Callable[[], Dict[Labels, float]]] = None
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def set_function(self, function: Callable[[], Dict[Labels, float]]):
+        """Compute the values when scraped, as {label values: value}"""
+        self._function = function
+
+    def samples(self) -> Iterable[str]:
+        values = self._function() if self._function else dict(self._values)
+        for labels, value in values.items():
+            yield f"{self.name}{self._labels(labels)} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: per-bucket counts (last one is +Inf), then the sum
+        self._series: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            series = [(labels, list(values)) for labels, values in self._series.items()]
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self._labels(labels, le)} {cumulative}"
+            yield f"{self.name}_count{self._labels(labels)} {cumulative}"
+            yield f"{self.name}_sum{self._labels(labels)} {values[-1]}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# HTTP
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ["method", "route", "status"]
+)
+
+
+class MetricsMiddleware:
+    """Time every HTTP request, labelled by the matched route template"""
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Dict[Callable, str] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_request_duration.observe(
+                time.perf_counter() - started, scope["method"], self._route(scope), str(status)
+            )
+
+    def _route(self, scope) -> str:
+        # Templates rather than raw paths keep label cardinality bounded
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        route = self._routes.get(endpoint)
+        if route is None:
+            route = next(
+                (r.path for r in scope["app"].routes if getattr(r, "endpoint", None) is endpoint),
+                "unmatched"
+            )
+            self._routes[endpoint] = route
+        return route
+
+
+# MongoDB
+mongo_command_duration = Histogram(
+    "mongodb_command_duration_seconds", "MongoDB command latency", ["collection", "command", "outcome"]
+)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Time MongoDB commands per collection and command name"""
+
+    def __init__(self):
+        self._collections: Dict[Tuple[int, object], str] = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        self._collections[(event.request_id, event.connection_id)] = target if isinstance(target, str) else "-"
+
+    def succeeded(self, event):
+        self._observe(event, "success")
+
+    def failed(self, event):
+        self._observe(event, "failure")
+
+    def _observe(self, event, outcome: str):
+        collection = self._collections.pop((event.request_id, event.connection_id), "-")
+        mongo_command_duration.observe(event.duration_micros / 1_000_000, collection, event.command_name, outcome)
+
+
+mongo_command_listener = MongoCommandListener()
+
+
+# Event loop
+event_loop_lag = Gauge("event_loop_lag_seconds", "Most recent event loop scheduling delay")
+event_loop_lag_histogram = Histogram("event_loop_lag_distribution_seconds", "Event loop scheduling delay")
+
+
+class EventLoopLagMonitor:
+    """Measure how late a periodic sleep wakes up; that delay is what every callback waits"""
+
+    def __init__(self, interval: float = EVENT_LOOP_LAG_INTERVAL_SECONDS):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - expected)
+            event_loop_lag.set(lag)
+            event_loop_lag_histogram.observe(lag)
+
+
+loop_lag_monitor = EventLoopLagMonitor()
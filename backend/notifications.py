@@ -0,0 +1,189 @@
+"""
+Live-status notifications pushed over /ws/notifications.
+
+Stream events (going live or offline, title/category changes and viewer
+count changes) are published once through a backplane, like chat, and each
+worker fans them out to its own sockets. A socket receives an event when
+its user follows the streamer, when it watches that stream, or when it
+watches the whole directory, so clients no longer poll the REST endpoints
+for live status.
+"""
+from fastapi import WebSocket
+from bson import ObjectId
+from typing import Dict, Iterable, Optional, Set
+import asyncio
+import os
+from dotenv import load_dotenv
+from backplane import Backplane, create_backplane
+from database import get_follows_collection, get_users_collection
+from metrics import Gauge
+from serialization import dumps_str
+from websocket_manager import ClientConnection, SLOW_CONSUMER_CLOSE_CODE, close_client
+
+load_dotenv()
+
+NOTIFY_CHANNEL_PREFIX = os.getenv("NOTIFY_CHANNEL_PREFIX", "twitch_clone:notify:")
+
+
+class Subscriber:
+    """A notifications socket and what it is subscribed to"""
+
+    __slots__ = ("client", "username", "streamers", "streams", "directory")
+
+    def __init__(self, client: ClientConnection, username: Optional[str], directory: bool):
+        self.client = client
+        self.username = username
+        self.streamers: Set[str] = set()
+        self.streams: Set[str] = set()
+        self.directory = directory
+
+
+class NotificationHub:
+    def __init__(self, backplane: Optional[Backplane] = None):
+        # Directory watchers need every stream, so subscribe to all channels
+        self.backplane = backplane or create_backplane(NOTIFY_CHANNEL_PREFIX, subscribe_all=True)
+        self._subscribers: Dict[WebSocket, Subscriber] = {}
+        # Indexes from topic to sockets, for O(1) fan-out lookups
+        self._by_streamer: Dict[str, Set[WebSocket]] = {}
+        self._by_stream: Dict[str, Set[WebSocket]] = {}
+        self._by_user: Dict[str, Set[WebSocket]] = {}
+        self._directory: Set[WebSocket] = set()
+
+    async def start(self):
+        await self.backplane.start(self.deliver_local)
+
+    async def close(self):
+        await self.backplane.close()
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        username: Optional[str] = None,
+        stream_ids: Iterable[str] = (),
+        directory: bool = False
+    ):
+        await websocket.accept()
+        client = ClientConnection(websocket, "notifications")
+        subscriber = self._subscribers[websocket] = Subscriber(client, username, directory)
+        client.writer_task = asyncio.create_task(self._writer(client))
+
+        if directory:
+            self._directory.add(websocket)
+        for stream_id in stream_ids:
+            self.watch_stream(websocket, stream_id)
+        if username:
+            self._by_user.setdefault(username, set()).add(websocket)
+            for streamer_id in await self._followed_streamers(username):
+                self._index(self._by_streamer, streamer_id, websocket)
+                subscriber.streamers.add(streamer_id)
+
+        client.enqueue(dumps_str({
+            "type": "system",
+            "message": "Connected to notifications",
+            "following": len(subscriber.streamers),
+            "streams": sorted(subscriber.streams),
+            "directory": directory
+        }))
+
+    def disconnect(self, websocket: WebSocket):
+        subscriber = self._subscribers.pop(websocket, None)
+        if subscriber is None:
+            return
+        client = subscriber.client
+        if client.writer_task and client.writer_task is not asyncio.current_task():
+            client.writer_task.cancel()
+
+        self._directory.discard(websocket)
+        for streamer_id in subscriber.streamers:
+            self._unindex(self._by_streamer, streamer_id, websocket)
+        for stream_id in subscriber.streams:
+            self._unindex(self._by_stream, stream_id, websocket)
+        if subscriber.username:
+            self._unindex(self._by_user, subscriber.username, websocket)
+
+    def watch_stream(self, websocket: WebSocket, stream_id: str):
+        subscriber = self._subscribers.get(websocket)
+        if subscriber and ObjectId.is_valid(stream_id):
+            self._index(self._by_stream, stream_id, websocket)
+            subscriber.streams.add(stream_id)
+
+    def unwatch_stream(self, websocket: WebSocket, stream_id: str):
+        subscriber = self._subscribers.get(websocket)
+        if subscriber and stream_id in subscriber.streams:
+            subscriber.streams.discard(stream_id)
+            self._unindex(self._by_stream, stream_id, websocket)
+
+    def follow(self, username: str, streamer_id: str):
+        """Subscribe a user's open sockets on this worker to a newly followed streamer"""
+        for websocket in self._by_user.get(username, ()):
+            self._subscribers[websocket].streamers.add(streamer_id)
+            self._index(self._by_streamer, streamer_id, websocket)
+
+    def unfollow(self, username: str, streamer_id: str):
+        for websocket in self._by_user.get(username, ()):
+            self._subscribers[websocket].streamers.discard(streamer_id)
+            self._unindex(self._by_streamer, streamer_id, websocket)
+
+    async def publish(self, event_type: str, stream_id: str, streamer_id: str, **fields):
+        """Publish a stream event once; every worker delivers it to its own subscribers"""
+        event = {"type": event_type, "stream_id": stream_id, "streamer_id": streamer_id, **fields}
+        await self.backplane.publish(f"{streamer_id}:{stream_id}", dumps_str(event))
+
+    async def deliver_local(self, topic: str, frame: str):
+        streamer_id, _, stream_id = topic.partition(":")
+        recipients = set(self._directory)
+        recipients.update(self._by_streamer.get(streamer_id, ()))
+        recipients.update(self._by_stream.get(stream_id, ()))
+
+        # The same serialized frame goes to every recipient's queue once
+        for websocket in recipients:
+            subscriber = self._subscribers.get(websocket)
+            if subscriber and not subscriber.client.enqueue(frame):
+                self._evict(subscriber.client)
+
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    async def _followed_streamers(self, username: str) -> Set[str]:
+        users_collection = await get_users_collection()
+        user = await users_collection.find_one({"username": username}, {"_id": 1})
+        if not user:
+            return set()
+        follows_collection = await get_follows_collection()
+        follows = await follows_collection.find(
+            {"follower_id": user["_id"]}, {"following_id": 1, "_id": 0}
+        ).to_list(length=None)
+        return {str(follow["following_id"]) for follow in follows}
+
+    @staticmethod
+    def _index(index: Dict[str, Set[WebSocket]], key: str, websocket: WebSocket):
+        index.setdefault(key, set()).add(websocket)
+
+    @staticmethod
+    def _unindex(index: Dict[str, Set[WebSocket]], key: str, websocket: WebSocket):
+        sockets = index.get(key)
+        if sockets is None:
+            return
+        sockets.discard(websocket)
+        if not sockets:
+            del index[key]
+
+    async def _writer(self, client: ClientConnection):
+        try:
+            await client.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Connection is dead or stalled: close it too, so the
+            # /ws/notifications receive loop ends
+            self._evict(client)
+
+    def _evict(self, client: ClientConnection):
+        self.disconnect(client.websocket)
+        asyncio.create_task(close_client(client, SLOW_CONSUMER_CLOSE_CODE))
+
+
+notifications = NotificationHub()
+
+notification_subscribers = Gauge("notification_subscribers", "Open notification sockets on this worker")
+notification_subscribers.set_function(lambda: {(): notifications.subscriber_count()})
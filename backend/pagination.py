@@ -0,0 +1,80 @@
+"""
+Opaque cursor (keyset) pagination helpers.
+
+A cursor encodes the sort key and _id of a listed document. Paging from a
+cursor turns into a range query on an indexed (sort_key, _id) pair instead
+of making MongoDB walk past every skipped document.
+"""
+from fastapi import HTTPException, status
+from bson import ObjectId, json_util
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+import base64
+import binascii
+import json
+
+# Sort values a cursor may carry; anything else (e.g. an operator document
+# like {"$ne": null}) would change the meaning of the keyset query
+CURSOR_VALUE_TYPES = (str, int, float, datetime, ObjectId, type(None))
+
+
+def encode_cursor(value: Any, document_id: ObjectId) -> str:
+    """Build an opaque cursor from a document's sort key and _id"""
+    raw = json_util.dumps([value, ObjectId(document_id)])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, ObjectId]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, document_id = json_util.loads(base64.urlsafe_b64decode(padded).decode())
+        if not isinstance(document_id, ObjectId):
+            raise ValueError("cursor _id is not an ObjectId")
+        if not isinstance(value, CURSOR_VALUE_TYPES):
+            raise ValueError("cursor sort value is not a scalar")
+        return value, document_id
+    except (ValueError, TypeError, binascii.Error, json.JSONDecodeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
+def apply_cursor(
+    query: dict,
+    sort_field: str,
+    direction: int,
+    cursor: Optional[str] = None,
+    forward: bool = True
+) -> Tuple[dict, List[Tuple[str, int]], bool]:
+    """
+    Narrow `query` to the documents after (forward) or before the cursor in
+    the listing order given by sort_field/direction, tie-broken on _id.
+
+    Returns the query, the sort to run it with and whether the fetched page
+    must be reversed to come back in listing order.
+    """
+    sort = [(sort_field, direction), ("_id", direction)]
+    if not cursor:
+        return query, sort, False
+
+    value, document_id = decode_cursor(cursor)
+    operator = "$gt" if (direction == 1) == forward else "$lt"
+    keyset = {"$or": [
+        {sort_field: {operator: value}},
+        {sort_field: value, "_id": {operator: document_id}}
+    ]}
+    query = {"$and": [query, keyset]}
+
+    if forward:
+        return query, sort, False
+    # Walk backwards from the cursor, then flip the page into listing order
+    return query, [(sort_field, -direction), ("_id", -direction)], True
+
+
+def reject_both_cursors(before: Optional[str], after: Optional[str]):
+    if before and after:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Use either before or after, not both"
+        )
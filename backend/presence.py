@@ -0,0 +1,325 @@
+"""
+Viewer presence for live streams.
+
+Chat sockets join and leave a stream's presence. Viewers are deduplicated
+by user (JWT subject) or client session, so several tabs count once, and
+across workers through a shared Redis store. Changes are only coalesced in
+memory; a background task periodically writes the current counts to
+streams.viewer_count and the affected category totals with bulk writes.
+
+In Redis each worker keeps its own viewer set per stream, with a TTL the
+flush loop refreshes, so the viewers of a crashed worker expire instead of
+being counted forever.
+"""
+from pymongo import UpdateOne
+from bson import ObjectId
+from typing import Dict, Iterable, Optional, Set
+import asyncio
+import os
+import time
+import uuid
+from dotenv import load_dotenv
+from database import get_categories_collection, get_streams_collection
+from notifications import notifications
+from search_index import search_index, KIND_STREAM
+from backplane import CHAT_BACKPLANE_URL
+
+load_dotenv()
+
+PRESENCE_STORE_URL = os.getenv("PRESENCE_STORE_URL", CHAT_BACKPLANE_URL)
+PRESENCE_KEY_PREFIX = os.getenv("PRESENCE_KEY_PREFIX", "twitch_clone:presence:")
+PRESENCE_FLUSH_INTERVAL_SECONDS = float(os.getenv("PRESENCE_FLUSH_INTERVAL_SECONDS", "5"))
+# A worker's viewer sets expire this long after its last flush; every
+# stream with viewers in the store is recounted on the same period
+PRESENCE_TTL_SECONDS = int(os.getenv("PRESENCE_TTL_SECONDS", "30"))
+
+
+class LocalPresenceStore:
+    """Unique viewers per stream for a single worker"""
+
+    def __init__(self):
+        self._viewers: Dict[str, Set[str]] = {}
+
+    async def add(self, stream_id: str, viewer_key: str):
+        self._viewers.setdefault(stream_id, set()).add(viewer_key)
+
+    async def remove(self, stream_id: str, viewer_key: str):
+        viewers = self._viewers.get(stream_id)
+        if viewers is None:
+            return
+        viewers.discard(viewer_key)
+        if not viewers:
+            del self._viewers[stream_id]
+
+    async def counts(self, stream_ids: Iterable[str]) -> Dict[str, int]:
+        return {stream_id: len(self._viewers.get(stream_id, ())) for stream_id in stream_ids}
+
+    async def refresh(self, stream_ids: Iterable[str]):
+        pass
+
+    async def tracked_streams(self) -> Set[str]:
+        return set()
+
+    async def close(self):
+        pass
+
+
+class RedisPresenceStore:
+    """
+    Unique viewers per stream shared by every worker. Each worker writes its
+    viewers of a stream to its own expiring set; a stream's count is the
+    size of the union of its workers' sets.
+    """
+
+    def __init__(
+        self,
+        url: str = PRESENCE_STORE_URL,
+        client=None,
+        key_prefix: str = PRESENCE_KEY_PREFIX,
+        ttl: int = PRESENCE_TTL_SECONDS
+    ):
+        self.url = url
+        self.client = client
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.worker_id = uuid.uuid4().hex
+
+    def _redis(self):
+        if self.client is None:
+            # Only needed when a Redis URL is configured
+            import redis.asyncio as redis
+            self.client = redis.from_url(self.url, decode_responses=True)
+        return self.client
+
+    def _viewers_key(self, stream_id: str, worker_id: str) -> str:
+        return f"{self.key_prefix}{stream_id}:viewers:{worker_id}"
+
+    def _workers_key(self, stream_id: str) -> str:
+        return f"{self.key_prefix}{stream_id}:workers"
+
+    def _streams_key(self) -> str:
+        return f"{self.key_prefix}streams"
+
+    async def add(self, stream_id: str, viewer_key: str):
+        viewers_key = self._viewers_key(stream_id, self.worker_id)
+        pipeline = self._redis().pipeline(transaction=False)
+        pipeline.sadd(viewers_key, viewer_key)
+        pipeline.expire(viewers_key, self.ttl)
+        self._register(pipeline, stream_id)
+        await pipeline.execute()
+
+    async def remove(self, stream_id: str, viewer_key: str):
+        await self._redis().srem(self._viewers_key(stream_id, self.worker_id), viewer_key)
+
+    async def counts(self, stream_ids: Iterable[str]) -> Dict[str, int]:
+        stream_ids = list(stream_ids)
+        redis = self._redis()
+        pipeline = redis.pipeline(transaction=False)
+        for stream_id in stream_ids:
+            pipeline.smembers(self._workers_key(stream_id))
+        workers = dict(zip(stream_ids, await pipeline.execute()))
+
+        # The union is stored under a scratch key so only its size comes back
+        counts = {stream_id: 0 for stream_id in stream_ids}
+        watched = [stream_id for stream_id in stream_ids if workers[stream_id]]
+        pipeline = redis.pipeline(transaction=False)
+        for stream_id in watched:
+            scratch = f"{self.key_prefix}{stream_id}:union:{self.worker_id}"
+            viewer_keys = [self._viewers_key(stream_id, worker) for worker in workers[stream_id]]
+            pipeline.sunionstore(scratch, viewer_keys)
+            pipeline.delete(scratch)
+        results = await pipeline.execute()
+        counts.update(zip(watched, results[::2]))
+
+        # Forget workers whose sets expired, and streams nobody watches
+        pipeline = redis.pipeline(transaction=False)
+        for stream_id, stream_workers in workers.items():
+            for worker in stream_workers:
+                pipeline.exists(self._viewers_key(stream_id, worker))
+        alive = iter(await pipeline.execute())
+        pipeline = redis.pipeline(transaction=False)
+        for stream_id, stream_workers in workers.items():
+            dead = [worker for worker in stream_workers if not next(alive)]
+            if dead:
+                pipeline.srem(self._workers_key(stream_id), *dead)
+            if not counts[stream_id]:
+                pipeline.srem(self._streams_key(), stream_id)
+        await pipeline.execute()
+        return counts
+
+    async def refresh(self, stream_ids: Iterable[str]):
+        """Keep this worker's viewer sets alive; called on every flush tick"""
+        pipeline = self._redis().pipeline(transaction=False)
+        for stream_id in stream_ids:
+            pipeline.expire(self._viewers_key(stream_id, self.worker_id), self.ttl)
+            self._register(pipeline, stream_id)
+        await pipeline.execute()
+
+    async def tracked_streams(self) -> Set[str]:
+        """Streams any worker has reported viewers for"""
+        return set(await self._redis().smembers(self._streams_key()))
+
+    def _register(self, pipeline, stream_id: str):
+        workers_key = self._workers_key(stream_id)
+        pipeline.sadd(workers_key, self.worker_id)
+        pipeline.expire(workers_key, self.ttl)
+        pipeline.sadd(self._streams_key(), stream_id)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+
+
+def create_presence_store():
+    """Pick the store from PRESENCE_STORE_URL (defaults to the chat backplane URL)"""
+    if PRESENCE_STORE_URL.startswith(("redis://", "rediss://")):
+        return RedisPresenceStore(PRESENCE_STORE_URL)
+    return LocalPresenceStore()
+
+
+class PresenceTracker:
+    def __init__(self, store=None, flush_interval: float = PRESENCE_FLUSH_INTERVAL_SECONDS):
+        self.store = store or create_presence_store()
+        self.flush_interval = flush_interval
+        # Sockets per (stream, viewer) on this worker; the store only sees 0 <-> 1 transitions
+        self._sockets: Dict[str, Dict[str, int]] = {}
+        self._dirty: Set[str] = set()
+        # Last viewer count pushed to notification subscribers, per stream
+        self._published: Dict[str, int] = {}
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_sweep = 0.0
+
+    @staticmethod
+    def viewer_key(username: Optional[str] = None, session_id: Optional[str] = None) -> str:
+        """Deduplicate by user, then by client session, else count the socket on its own"""
+        if username:
+            return f"user:{username}"
+        if session_id:
+            return f"session:{session_id}"
+        return f"socket:{uuid.uuid4().hex}"
+
+    async def join(self, stream_id: str, viewer_key: str):
+        sockets = self._sockets.setdefault(stream_id, {})
+        sockets[viewer_key] = sockets.get(viewer_key, 0) + 1
+        if sockets[viewer_key] == 1:
+            await self.store.add(stream_id, viewer_key)
+            self._dirty.add(stream_id)
+
+    async def leave(self, stream_id: str, viewer_key: str):
+        sockets = self._sockets.get(stream_id)
+        if not sockets or viewer_key not in sockets:
+            return
+        sockets[viewer_key] -= 1
+        if sockets[viewer_key] > 0:
+            return
+
+        del sockets[viewer_key]
+        if not sockets:
+            del self._sockets[stream_id]
+        await self.store.remove(stream_id, viewer_key)
+        self._dirty.add(stream_id)
+
+    def touch(self, stream_id: str):
+        """Rewrite a stream's viewer count on the next flush (e.g. after it goes live)"""
+        self._dirty.add(stream_id)
+
+    async def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+        await self.store.close()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.store.refresh(list(self._sockets))
+                # Recount every watched stream now and then, so viewers of a
+                # crashed worker drop out once its sets expire
+                now = time.monotonic()
+                if now - self._last_sweep >= PRESENCE_TTL_SECONDS:
+                    self._last_sweep = now
+                    self._dirty.update(await self.store.tracked_streams())
+                await self.flush()
+            except Exception as e:
+                print(f"❌ Presence flush failed: {e}")
+
+    async def flush(self):
+        """Write viewer counts for every stream that changed since the last flush"""
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        stream_ids = [stream_id for stream_id in dirty if ObjectId.is_valid(stream_id)]
+        if not stream_ids:
+            return
+
+        try:
+            counts = await self.store.counts(stream_ids)
+            streams_collection = await get_streams_collection()
+            object_ids = [ObjectId(stream_id) for stream_id in stream_ids]
+
+            # Absolute values, so workers flushing the same stream agree
+            await streams_collection.bulk_write([
+                UpdateOne(
+                    {"_id": ObjectId(stream_id), "is_live": True},
+                    {"$set": {"viewer_count": count}}
+                )
+                for stream_id, count in counts.items()
+            ], ordered=False)
+
+            streams = await streams_collection.find(
+                {"_id": {"$in": object_ids}}, {"streamer_id": 1, "category_slug": 1, "is_live": 1}
+            ).to_list(length=None)
+            slugs = {stream["category_slug"] for stream in streams if stream.get("category_slug")}
+            await self._refresh_category_viewers(list(slugs))
+        except Exception:
+            # Try again on the next flush
+            self._dirty.update(dirty)
+            raise
+
+        await self._publish_viewer_counts(streams, counts)
+
+    async def _publish_viewer_counts(self, streams, counts: Dict[str, int]):
+        """Push changed viewer counts of live streams to notification subscribers"""
+        for stream in streams:
+            stream_id = str(stream["_id"])
+            if not stream.get("is_live"):
+                self._published.pop(stream_id, None)
+                continue
+            count = counts.get(stream_id, 0)
+            previous = self._published.get(stream_id, 0)
+            if count == previous:
+                continue
+            self._published[stream_id] = count
+            search_index.update_rank(KIND_STREAM, stream_id, viewers=count)
+            await notifications.publish(
+                "viewer_count", stream_id, str(stream["streamer_id"]),
+                viewer_count=count, delta=count - previous
+            )
+
+    async def _refresh_category_viewers(self, slugs):
+        if not slugs:
+            return
+        streams_collection = await get_streams_collection()
+        categories_collection = await get_categories_collection()
+
+        totals = await streams_collection.aggregate([
+            {"$match": {"is_live": True, "category_slug": {"$in": slugs}}},
+            {"$group": {"_id": "$category_slug", "viewer_count": {"$sum": "$viewer_count"}}}
+        ]).to_list(length=None)
+        viewers = {total["_id"]: total["viewer_count"] for total in totals}
+
+        await categories_collection.bulk_write([
+            UpdateOne({"slug": slug}, {"$set": {"viewer_count": viewers.get(slug, 0)}})
+            for slug in slugs
+        ], ordered=False)
+        for slug in slugs:
+            search_index.update_category_rank(slug, viewers=viewers.get(slug, 0))
+
+
+presence = PresenceTracker()
@@ -0,0 +1,94 @@
+"""
+Per-endpoint field lists shared by queries and response formatting.
+
+Each mapping lists the fields an endpoint returns (with the default used
+when a document lacks one). projection() turns it into a MongoDB projection
+so the query only pulls those fields, and format_document() builds the
+response from the same mapping, so the two cannot drift apart.
+"""
+from typing import Any, Dict, Mapping
+
+Fields = Mapping[str, Any]
+
+# Streams
+LIVE_STREAM_FIELDS: Fields = {
+    "streamer_id": None,
+    "streamer_username": None,
+    "title": None,
+    "category": None,
+    "thumbnail_url": None,
+    "viewer_count": 0,
+    "is_live": False,
+    "started_at": None,
+}
+STREAM_DETAIL_FIELDS: Fields = {
+    **LIVE_STREAM_FIELDS,
+    "description": None,
+    "created_at": None,
+}
+USER_STREAM_FIELDS: Fields = {
+    "title": None,
+    "category": None,
+    "thumbnail_url": None,
+    "viewer_count": 0,
+    "is_live": False,
+    "started_at": None,
+    "ended_at": None,
+    "created_at": None,
+}
+STREAM_STATUS_FIELDS: Fields = {
+    "is_live": False,
+}
+# Read by start/stop/update to flip live state, adjust category counters and notify
+STREAM_CONTROL_FIELDS: Fields = {
+    "title": None,
+    "category": None,
+    "category_slug": None,
+    "is_live": False,
+    "viewer_count": 0,
+}
+
+# Users
+PUBLIC_PROFILE_FIELDS: Fields = {
+    "username": None,
+    "full_name": None,
+    "avatar_url": None,
+    "bio": "",
+    "followers_count": 0,
+    "following_count": 0,
+    "is_streaming": False,
+    "created_at": None,
+}
+# Authenticated users are loaded with everything except the password hash
+AUTH_USER_PROJECTION = {"hashed_password": 0}
+
+# Chat
+CHAT_MESSAGE_FIELDS: Fields = {
+    "username": None,
+    "message": None,
+    "color": "#9146FF",
+    "timestamp": None,
+}
+
+# Categories
+CATEGORY_FIELDS: Fields = {
+    "name": None,
+    "slug": None,
+    "description": None,
+    "thumbnail_url": None,
+    "viewer_count": 0,
+    "stream_count": 0,
+}
+
+
+def projection(fields: Fields) -> Dict[str, int]:
+    """MongoDB projection returning exactly `fields` (plus _id)"""
+    return {field: 1 for field in fields}
+
+
+def format_document(document: dict, fields: Fields) -> dict:
+    """Response dict with the document's id followed by `fields`"""
+    formatted = {"id": str(document["_id"])}
+    for field, default in fields.items():
+        formatted[field] = document.get(field, default)
+    return formatted
@@ -0,0 +1,216 @@
+"""
+Chat rate limiting and slow mode with token buckets.
+
+Every message must take a token from the sender's bucket for that stream
+(slow mode: one token per CHAT_SLOW_MODE_SECONDS, up to CHAT_USER_BURST) and
+from the stream's own bucket (CHAT_STREAM_MESSAGES_PER_SECOND overall, up to
+CHAT_STREAM_BURST). Checks run before a message is broadcast or persisted.
+
+A bucket is two floats, so memory is O(1) per active sender; idle buckets
+are evicted. With a Redis URL configured the buckets live in Redis and are
+shared by every worker.
+
+Senders are keyed by their token subject, never by a name the client
+sends. Anonymous senders are keyed by address, read from X-Forwarded-For
+only when the peer is a CHAT_TRUSTED_PROXIES entry; if that still leaves
+only a proxy's address, the bucket is per connection.
+"""
+from typing import Dict, Optional, Tuple
+import ipaddress
+import os
+import time
+from dotenv import load_dotenv
+from backplane import CHAT_BACKPLANE_URL
+
+load_dotenv()
+
+CHAT_SLOW_MODE_SECONDS = float(os.getenv("CHAT_SLOW_MODE_SECONDS", "1"))
+CHAT_USER_BURST = float(os.getenv("CHAT_USER_BURST", "3"))
+CHAT_STREAM_MESSAGES_PER_SECOND = float(os.getenv("CHAT_STREAM_MESSAGES_PER_SECOND", "50"))
+CHAT_STREAM_BURST = float(os.getenv("CHAT_STREAM_BURST", "100"))
+CHAT_LIMITER_IDLE_SECONDS = float(os.getenv("CHAT_LIMITER_IDLE_SECONDS", "120"))
+RATE_LIMIT_STORE_URL = os.getenv("RATE_LIMIT_STORE_URL", CHAT_BACKPLANE_URL)
+RATE_LIMIT_KEY_PREFIX = os.getenv("RATE_LIMIT_KEY_PREFIX", "twitch_clone:ratelimit:")
+# Peers allowed to report the client address in X-Forwarded-For (IPs or CIDRs), e.g. the load balancer
+CHAT_TRUSTED_PROXIES = [
+    ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.getenv("CHAT_TRUSTED_PROXIES", "127.0.0.1,::1").split(",")
+    if proxy.strip()
+]
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in CHAT_TRUSTED_PROXIES)
+
+
+def client_address(peer: Optional[str], forwarded_for: Optional[str] = None) -> Optional[str]:
+    """The sender's address: X-Forwarded-For walked back from the peer past every trusted proxy"""
+    address = peer
+    if address and forwarded_for and _is_trusted_proxy(address):
+        for hop in reversed([hop.strip() for hop in forwarded_for.split(",") if hop.strip()]):
+            address = hop
+            if not _is_trusted_proxy(hop):
+                break
+    return address
+
+
+def sender_key(username: Optional[str], peer: Optional[str], forwarded_for: Optional[str], connection_id: str) -> str:
+    """Rate limit key of a chat sender; username must come from a verified token"""
+    if username:
+        return f"user:{username}"
+    address = client_address(peer, forwarded_for)
+    if address and not _is_trusted_proxy(address):
+        return f"addr:{address}"
+    # All we can see is a proxy, which every anonymous viewer would share
+    return f"conn:{connection_id}"
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, rate: float, burst: float, now: float) -> float:
+        """Take one token; returns 0 on success, else seconds until one is available"""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+
+class ChatRateLimiter:
+    """In-process buckets, for a single worker"""
+
+    def __init__(
+        self,
+        slow_mode_seconds: float = CHAT_SLOW_MODE_SECONDS,
+        user_burst: float = CHAT_USER_BURST,
+        stream_rate: float = CHAT_STREAM_MESSAGES_PER_SECOND,
+        stream_burst: float = CHAT_STREAM_BURST,
+        idle_seconds: float = CHAT_LIMITER_IDLE_SECONDS
+    ):
+        # Slow mode off means an effectively unlimited refill rate
+        self.user_rate = 1 / slow_mode_seconds if slow_mode_seconds > 0 else 1e9
+        self.user_burst = user_burst
+        self.stream_rate = stream_rate
+        self.stream_burst = stream_burst
+        self.idle_seconds = idle_seconds
+        self._senders: Dict[Tuple[str, str], TokenBucket] = {}
+        self._streams: Dict[str, TokenBucket] = {}
+        self._next_sweep = time.monotonic() + idle_seconds
+
+    async def check(self, stream_id: str, sender_key: str) -> float:
+        """0 if the message may be sent, otherwise seconds to wait before retrying"""
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._evict_idle(now)
+
+        sender = self._senders.get((stream_id, sender_key))
+        if sender is None:
+            sender = self._senders[(stream_id, sender_key)] = TokenBucket(self.user_burst, now)
+        retry_after = sender.take(self.user_rate, self.user_burst, now)
+        if retry_after:
+            return retry_after
+
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            stream = self._streams[stream_id] = TokenBucket(self.stream_burst, now)
+        retry_after = stream.take(self.stream_rate, self.stream_burst, now)
+        if retry_after:
+            # The stream is saturated; do not charge the sender for it
+            sender.tokens += 1
+        return retry_after
+
+    async def close(self):
+        pass
+
+    def _evict_idle(self, now: float):
+        cutoff = now - self.idle_seconds
+        self._senders = {key: bucket for key, bucket in self._senders.items() if bucket.updated >= cutoff}
+        self._streams = {key: bucket for key, bucket in self._streams.items() if bucket.updated >= cutoff}
+        self._next_sweep = now + self.idle_seconds
+
+
+# Both buckets are checked atomically; the sender's token is refunded when the stream is saturated
+_TOKEN_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local ttl = tonumber(ARGV[5])
+
+local function take(key, rate, burst)
+    local state = redis.call('HMGET', key, 't', 'u')
+    local tokens = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + (now - updated) * rate)
+    local retry = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        retry = (1 - tokens) / rate
+    end
+    redis.call('HSET', key, 't', tokens, 'u', now)
+    redis.call('PEXPIRE', key, ttl)
+    return retry
+end
+
+local retry = take(KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]))
+if retry > 0 then
+    return tostring(retry)
+end
+retry = take(KEYS[2], tonumber(ARGV[3]), tonumber(ARGV[4]))
+if retry > 0 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 't', 1)
+end
+return tostring(retry)
+"""
+
+
+class RedisChatRateLimiter(ChatRateLimiter):
+    """Buckets stored in Redis and shared by every worker; idle ones expire"""
+
+    def __init__(self, url: str = RATE_LIMIT_STORE_URL, client=None, key_prefix: str = RATE_LIMIT_KEY_PREFIX, **limits):
+        super().__init__(**limits)
+        self.url = url
+        self.client = client
+        self.key_prefix = key_prefix
+        self._script = None
+
+    async def check(self, stream_id: str, sender_key: str) -> float:
+        if self._script is None:
+            if self.client is None:
+                # Only needed when a Redis URL is configured
+                import redis.asyncio as redis
+                self.client = redis.from_url(self.url, decode_responses=True)
+            self._script = self.client.register_script(_TOKEN_BUCKET_SCRIPT)
+
+        retry_after = await self._script(
+            keys=[f"{self.key_prefix}{stream_id}:{sender_key}", f"{self.key_prefix}{stream_id}"],
+            args=[
+                self.user_rate, self.user_burst,
+                self.stream_rate, self.stream_burst,
+                int(self.idle_seconds * 1000)
+            ]
+        )
+        return float(retry_after)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+
+
+def create_rate_limiter() -> ChatRateLimiter:
+    """Pick the limiter from RATE_LIMIT_STORE_URL (defaults to the chat backplane URL)"""
+    if RATE_LIMIT_STORE_URL.startswith(("redis://", "rediss://")):
+        return RedisChatRateLimiter(RATE_LIMIT_STORE_URL)
+    return ChatRateLimiter()
+
+
+chat_rate_limiter = create_rate_limiter()
@@ -1,8 +1,11 @@
 from fastapi import APIRouter, HTTPException, status, Depends
 from fastapi.security import HTTPBearer
+from motor.motor_asyncio import AsyncIOMotorCollection
 from database import get_users_collection
 from models import UserCreate, UserLogin, Token, UserProfile
-from auth_utils import verify_password, get_password_hash, create_access_token, get_current_user
+from auth_utils import verify_password_async, get_password_hash_async, create_access_token, get_current_user
+from serialization import json_response
+from search_index import search_index, user_doc
 from bson import ObjectId
 from datetime import datetime, timedelta
 
@@ -10,12 +13,13 @@ router = APIRouter()
 security = HTTPBearer()
 
 @router.post("/register", response_model=dict)
-async def register_user(user: UserCreate):
+async def register_user(
+    user: UserCreate,
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
+):
     """Register a new user"""
-    users_collection = await get_users_collection()
-    
     # Check if username already exists
-    existing_user = await users_collection.find_one({"username": user.username})
+    existing_user = await users_collection.find_one({"username": user.username}, {"_id": 1})
     if existing_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -23,7 +27,7 @@ async def register_user(user: UserCreate):
         )
     
     # Check if email already exists
-    existing_email = await users_collection.find_one({"email": user.email})
+    existing_email = await users_collection.find_one({"email": user.email}, {"_id": 1})
     if existing_email:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -31,7 +35,7 @@ async def register_user(user: UserCreate):
         )
     
     # Create new user
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash_async(user.password)
     user_data = {
         "username": user.username,
         "email": user.email,
@@ -47,6 +51,7 @@ async def register_user(user: UserCreate):
     }
     
     result = await users_collection.insert_one(user_data)
+    search_index.add(user_doc(user_data))
     
     # Create access token
     access_token_expires = timedelta(minutes=30)
@@ -67,12 +72,13 @@ async def register_user(user: UserCreate):
     }
 
 @router.post("/login", response_model=Token)
-async def login_user(user: UserLogin):
+async def login_user(
+    user: UserLogin,
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
+):
     """Login user and return access token"""
-    users_collection = await get_users_collection()
-    
     # Find user by username
-    db_user = await users_collection.find_one({"username": user.username})
+    db_user = await users_collection.find_one({"username": user.username}, {"hashed_password": 1})
     if not db_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -81,7 +87,7 @@ async def login_user(user: UserLogin):
         )
     
     # Verify password
-    if not verify_password(user.password, db_user["hashed_password"]):
+    if not await verify_password_async(user.password, db_user["hashed_password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -112,4 +118,4 @@ async def get_current_user_profile(current_user: dict = Depends(get_current_user
         "is_streaming": current_user.get("is_streaming", False),
         "created_at": current_user.get("created_at")
     }
-    return user_profile
\ No newline at end of file
+    return json_response(user_profile)
\ No newline at end of file
@@ -1,7 +1,13 @@
-from fastapi import APIRouter, HTTPException, status, Query
-from database import get_categories_collection, get_streams_collection
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from motor.motor_asyncio import AsyncIOMotorCollection
+from database import get_categories_collection, collection_for, READ_DIRECTORY
 from models import Category
-from typing import List
+from category_utils import reconcile_category_counters
+from pagination import apply_cursor, encode_cursor, reject_both_cursors
+from serialization import json_response
+from search_index import search_index, category_doc
+from projections import CATEGORY_FIELDS, LIVE_STREAM_FIELDS, projection, format_document
+from typing import List, Optional
 from bson import ObjectId
 
 router = APIRouter()
@@ -9,17 +15,17 @@ router = APIRouter()
 @router.get("/", response_model=List[dict])
 async def get_categories(
     limit: int = Query(20, le=100),
-    skip: int = Query(0, ge=0)
+    skip: int = Query(0, ge=0),
+    categories_collection: AsyncIOMotorCollection = Depends(collection_for("categories", READ_DIRECTORY)),
+    primary_categories: AsyncIOMotorCollection = Depends(get_categories_collection)
 ):
     """Get all streaming categories"""
-    categories_collection = await get_categories_collection()
-    streams_collection = await get_streams_collection()
-    
     # Get categories
-    categories = await categories_collection.find({}).skip(skip).limit(limit).to_list(length=None)
+    categories = await categories_collection.find({}, projection(CATEGORY_FIELDS)).skip(skip).limit(limit).to_list(length=None)
     
-    # If no categories exist, create default ones
-    if not categories:
+    # If no categories exist, create default ones (checked on the primary, since
+    # the listing may come from a lagging secondary)
+    if not categories and not await primary_categories.find_one({}, {"_id": 1}):
         default_categories = [
             {
                 "name": "Games",
@@ -71,94 +77,50 @@ async def get_categories(
             }
         ]
         
-        await categories_collection.insert_many(default_categories)
-        categories = await categories_collection.find({}).to_list(length=None)
+        await primary_categories.insert_many(default_categories)
+        # Seed counters for streams that went live before the categories existed
+        await reconcile_category_counters()
+        categories = await primary_categories.find({}, projection(CATEGORY_FIELDS)).to_list(length=None)
+        for category in categories:
+            search_index.add(category_doc(category))
     
-    # Update stream counts for each category
-    for category in categories:
-        stream_count = await streams_collection.count_documents({
-            "category": {"$regex": category["name"], "$options": "i"},
-            "is_live": True
-        })
-        
-        # Update category with current stream count
-        await categories_collection.update_one(
-            {"_id": category["_id"]},
-            {"$set": {"stream_count": stream_count}}
-        )
-        category["stream_count"] = stream_count
+    # stream_count/viewer_count are maintained incrementally (see category_utils)
     
     # Format response
-    formatted_categories = []
-    for category in categories:
-        formatted_categories.append({
-            "id": str(category["_id"]),
-            "name": category["name"],
-            "slug": category["slug"],
-            "description": category.get("description"),
-            "thumbnail_url": category.get("thumbnail_url"),
-            "viewer_count": category.get("viewer_count", 0),
-            "stream_count": category.get("stream_count", 0)
-        })
+    formatted_categories = [format_document(category, CATEGORY_FIELDS) for category in categories]
     
-    return formatted_categories
+    return json_response(formatted_categories)
 
 @router.get("/{category_slug}", response_model=dict)
-async def get_category(category_slug: str):
+async def get_category(
+    category_slug: str,
+    categories_collection: AsyncIOMotorCollection = Depends(collection_for("categories", READ_DIRECTORY))
+):
     """Get category details by slug"""
-    categories_collection = await get_categories_collection()
-    streams_collection = await get_streams_collection()
-    
-    category = await categories_collection.find_one({"slug": category_slug})
+    category = await categories_collection.find_one({"slug": category_slug}, projection(CATEGORY_FIELDS))
     if not category:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Category not found"
         )
     
-    # Get current stream count
-    stream_count = await streams_collection.count_documents({
-        "category": {"$regex": category["name"], "$options": "i"},
-        "is_live": True
-    })
-    
-    # Calculate total viewers in this category
-    pipeline = [
-        {"$match": {
-            "category": {"$regex": category["name"], "$options": "i"},
-            "is_live": True
-        }},
-        {"$group": {
-            "_id": None,
-            "total_viewers": {"$sum": "$viewer_count"}
-        }}
-    ]
-    
-    result = await streams_collection.aggregate(pipeline).to_list(length=1)
-    total_viewers = result[0]["total_viewers"] if result else 0
-    
-    return {
-        "id": str(category["_id"]),
-        "name": category["name"],
-        "slug": category["slug"],
-        "description": category.get("description"),
-        "thumbnail_url": category.get("thumbnail_url"),
-        "viewer_count": total_viewers,
-        "stream_count": stream_count
-    }
+    return json_response(format_document(category, CATEGORY_FIELDS))
 
 @router.get("/{category_slug}/streams", response_model=List[dict])
 async def get_category_streams(
     category_slug: str,
     limit: int = Query(20, le=100),
-    skip: int = Query(0, ge=0)
+    skip: int = Query(0, ge=0),
+    after: Optional[str] = Query(None, description="Cursor of a stream; returns the next page"),
+    before: Optional[str] = Query(None, description="Cursor of a stream; returns the previous page"),
+    categories_collection: AsyncIOMotorCollection = Depends(collection_for("categories", READ_DIRECTORY)),
+    streams_collection: AsyncIOMotorCollection = Depends(collection_for("streams", READ_DIRECTORY))
 ):
     """Get streams in a specific category"""
-    categories_collection = await get_categories_collection()
-    streams_collection = await get_streams_collection()
+    reject_both_cursors(before, after)
     
     # Get category
-    category = await categories_collection.find_one({"slug": category_slug})
+    category = await categories_collection.find_one({"slug": category_slug}, {"slug": 1})
     if not category:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -166,24 +128,21 @@ async def get_category_streams(
         )
     
     # Get streams in this category
-    streams = await streams_collection.find({
-        "category": {"$regex": category["name"], "$options": "i"},
-        "is_live": True
-    }).sort("viewer_count", -1).skip(skip).limit(limit).to_list(length=None)
+    query, sort, reverse = apply_cursor({
+        "is_live": True,
+        "category_slug": category["slug"]
+    }, "viewer_count", -1, cursor=after or before, forward=before is None)
+    streams = await streams_collection.find(
+        query, projection(LIVE_STREAM_FIELDS)
+    ).sort(sort).skip(skip).limit(limit).to_list(length=None)
+    if reverse:
+        streams.reverse()
     
     # Format response
     formatted_streams = []
     for stream in streams:
-        formatted_streams.append({
-            "id": str(stream["_id"]),
-            "streamer_id": str(stream["streamer_id"]),
-            "streamer_username": stream["streamer_username"],
-            "title": stream["title"],
-            "category": stream["category"],
-            "thumbnail_url": stream["thumbnail_url"],
-            "viewer_count": stream["viewer_count"],
-            "is_live": stream["is_live"],
-            "started_at": stream["started_at"]
-        })
+        formatted_stream = format_document(stream, LIVE_STREAM_FIELDS)
+        formatted_stream["cursor"] = encode_cursor(stream["viewer_count"], stream["_id"])
+        formatted_streams.append(formatted_stream)
     
-    return formatted_streams
\ No newline at end of file
+    return json_response(formatted_streams)
\ No newline at end of file
@@ -1,10 +1,21 @@
 from fastapi import APIRouter, HTTPException, status, Depends, Query
-from database import get_chat_collection, get_streams_collection
+from motor.motor_asyncio import AsyncIOMotorCollection
+from database import (
+    get_chat_collection, get_streams_collection, collection_for, read_session, write_session,
+    reads_from_secondaries, READ_HISTORY
+)
 from models import ChatMessage, ChatMessageCreate
-from auth_utils import get_current_user
+from auth_utils import get_current_user, get_optional_username
+from chat_history import chat_history
+from pagination import apply_cursor, encode_cursor, reject_both_cursors
+from websocket_manager import manager, chat_message_frame, chat_deleted_frame
+from projections import CHAT_MESSAGE_FIELDS, STREAM_STATUS_FIELDS, projection, format_document
+from serialization import json_response
+from rate_limit import chat_rate_limiter
 from bson import ObjectId
 from typing import List, Optional
 from datetime import datetime
+import math
 import random
 
 router = APIRouter()
@@ -13,12 +24,11 @@ router = APIRouter()
 async def send_chat_message(
     stream_id: str,
     message_data: ChatMessageCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    chat_collection: AsyncIOMotorCollection = Depends(get_chat_collection),
+    streams_collection: AsyncIOMotorCollection = Depends(get_streams_collection)
 ):
     """Send a chat message to a stream"""
-    chat_collection = await get_chat_collection()
-    streams_collection = await get_streams_collection()
-    
     # Validate stream ID
     if not ObjectId.is_valid(stream_id):
         raise HTTPException(
@@ -26,8 +36,17 @@ async def send_chat_message(
             detail="Invalid stream ID"
         )
     
+    # Slow mode / flood protection, before any database work
+    retry_after = await chat_rate_limiter.check(stream_id, f"user:{current_user['username']}")
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="You are sending messages too fast",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+    
     # Check if stream exists and is live
-    stream = await streams_collection.find_one({"_id": ObjectId(stream_id)})
+    stream = await streams_collection.find_one({"_id": ObjectId(stream_id)}, projection(STREAM_STATUS_FIELDS))
     if not stream:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -51,64 +70,88 @@ async def send_chat_message(
         "timestamp": datetime.utcnow()
     }
     
-    result = await chat_collection.insert_one(chat_message)
+    async with write_session(current_user["username"]) as session:
+        result = await chat_collection.insert_one(chat_message, session=session)
+    formatted_message = {
+        "id": str(result.inserted_id),
+        "username": current_user["username"],
+        "message": message_data.message,
+        "color": chat_message["color"],
+        "timestamp": chat_message["timestamp"]
+    }
+    
+    # Deliver to chat sockets (this also records it in the recent chat buffer)
+    await manager.broadcast_to_stream(stream_id, chat_message_frame(formatted_message))
     
-    return {
+    return json_response({
         "message": "Chat message sent successfully",
         "message_id": str(result.inserted_id),
-        "chat_message": {
-            "id": str(result.inserted_id),
-            "username": current_user["username"],
-            "message": message_data.message,
-            "color": chat_message["color"],
-            "timestamp": chat_message["timestamp"]
-        }
-    }
+        "chat_message": formatted_message
+    })
+
+def _with_cursor(message: dict) -> dict:
+    return {**message, "cursor": encode_cursor(message["timestamp"], message["id"])}
 
 @router.get("/{stream_id}/messages", response_model=List[dict])
 async def get_chat_messages(
     stream_id: str,
     limit: int = Query(50, le=100),
-    skip: int = Query(0, ge=0)
+    skip: int = Query(0, ge=0),
+    before: Optional[str] = Query(None, description="Cursor of a message; returns older messages"),
+    after: Optional[str] = Query(None, description="Cursor of a message; returns newer messages"),
+    reader: Optional[str] = Depends(get_optional_username),
+    chat_collection: AsyncIOMotorCollection = Depends(collection_for("chat_messages", READ_HISTORY))
 ):
     """Get chat messages for a stream"""
-    chat_collection = await get_chat_collection()
-    
     # Validate stream ID
     if not ObjectId.is_valid(stream_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid stream ID"
         )
+    reject_both_cursors(before, after)
+    
+    # Serve from the recent chat buffer when the whole window is in memory
+    # (and the buffer is kept current for this stream on this worker)
+    tracks_history = manager.tracks_history(stream_id)
+    if tracks_history and not before and not after:
+        cached_messages = chat_history.window(stream_id, skip, limit)
+        if cached_messages is not None:
+            return json_response([_with_cursor(message) for message in cached_messages])
+    
+    # Newest first; "before" pages towards older messages
+    query, sort, reverse = apply_cursor(
+        {"stream_id": ObjectId(stream_id)}, "timestamp", -1,
+        cursor=before or after, forward=after is None
+    )
     
     # Get messages
-    messages = await chat_collection.find({
-        "stream_id": ObjectId(stream_id)
-    }).sort("timestamp", -1).skip(skip).limit(limit).to_list(length=None)
+    async with read_session(reader) as session:
+        messages = await chat_collection.find(
+            query, projection(CHAT_MESSAGE_FIELDS), session=session
+        ).sort(sort).skip(skip).limit(limit).to_list(length=None)
+    if reverse:
+        messages.reverse()
     
     # Format response (reverse to show oldest first)
-    formatted_messages = []
-    for message in reversed(messages):
-        formatted_messages.append({
-            "id": str(message["_id"]),
-            "username": message["username"],
-            "message": message["message"],
-            "color": message["color"],
-            "timestamp": message["timestamp"]
-        })
-    
-    return formatted_messages
+    formatted_messages = [format_document(message, CHAT_MESSAGE_FIELDS) for message in reversed(messages)]
+    
+    # Seed the buffer so the next viewers are served from memory (never from
+    # a lagging secondary, which could miss the newest messages)
+    if tracks_history and skip == 0 and not before and not after and not reads_from_secondaries(READ_HISTORY):
+        chat_history.prime(stream_id, formatted_messages, complete=len(messages) < limit)
+    
+    return json_response([_with_cursor(message) for message in formatted_messages])
 
 @router.delete("/{stream_id}/message/{message_id}")
 async def delete_chat_message(
     stream_id: str,
     message_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    chat_collection: AsyncIOMotorCollection = Depends(get_chat_collection),
+    streams_collection: AsyncIOMotorCollection = Depends(get_streams_collection)
 ):
     """Delete a chat message (only message owner or stream owner can delete)"""
-    chat_collection = await get_chat_collection()
-    streams_collection = await get_streams_collection()
-    
     # Validate IDs
     if not ObjectId.is_valid(stream_id) or not ObjectId.is_valid(message_id):
         raise HTTPException(
@@ -117,7 +160,7 @@ async def delete_chat_message(
         )
     
     # Get message
-    message = await chat_collection.find_one({"_id": ObjectId(message_id)})
+    message = await chat_collection.find_one({"_id": ObjectId(message_id)}, {"user_id": 1})
     if not message:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -125,7 +168,7 @@ async def delete_chat_message(
         )
     
     # Get stream
-    stream = await streams_collection.find_one({"_id": ObjectId(stream_id)})
+    stream = await streams_collection.find_one({"_id": ObjectId(stream_id)}, {"streamer_id": 1})
     if not stream:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -149,4 +192,7 @@ async def delete_chat_message(
             detail="Failed to delete message"
         )
     
+    # Every worker drops it from its recent chat buffer and tells its viewers
+    await manager.broadcast_to_stream(stream_id, chat_deleted_frame(stream_id, message_id))
+    
     return {"message": "Chat message deleted successfully"}
\ No newline at end of file
@@ -0,0 +1,16 @@
+from fastapi import APIRouter, Query
+from search_index import search_index, KIND_USER, KIND_STREAM, KIND_CATEGORY
+from serialization import json_response
+from typing import List, Optional
+
+router = APIRouter()
+
+# "" so /api/search?q=... is served without a redirect
+@router.get("", response_model=List[dict])
+async def search(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(10, ge=1, le=50),
+    kind: Optional[str] = Query(None, pattern=f"^({KIND_USER}|{KIND_STREAM}|{KIND_CATEGORY})$")
+):
+    """Prefix search over usernames, stream titles and categories, live and popular first"""
+    return json_response(search_index.search(q, limit=limit, kind=kind))
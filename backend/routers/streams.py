@@ -1,8 +1,24 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Query
-from database import get_streams_collection, get_users_collection, get_categories_collection
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request, Response
+from motor.motor_asyncio import AsyncIOMotorCollection
+from database import (
+    get_streams_collection, get_users_collection, get_categories_collection,
+    get_collection, collection_for, read_session, write_session, READ_DIRECTORY, READ_PROFILE
+)
 from models import StreamCreate, StreamUpdate, Stream
-from auth_utils import get_current_user
+from notifications import notifications
+from auth_utils import get_current_user, get_optional_username
+from user_cache import user_cache
+from presence import presence
+from live_directory import live_directory, LIVE_DIRECTORY_TTL_SECONDS
+from search_index import search_index, stream_doc, KIND_STREAM, KIND_USER
+from category_utils import slugify, adjust_category_counters
+from pagination import apply_cursor, encode_cursor, reject_both_cursors
+from serialization import json_response
+from projections import (
+    LIVE_STREAM_FIELDS, STREAM_DETAIL_FIELDS, USER_STREAM_FIELDS, STREAM_CONTROL_FIELDS, projection, format_document
+)
 from bson import ObjectId
+from pymongo import ReturnDocument
 from typing import List, Optional
 from datetime import datetime
 import random
@@ -12,17 +28,16 @@ router = APIRouter()
 @router.post("/create", response_model=dict)
 async def create_stream(
     stream_data: StreamCreate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    streams_collection: AsyncIOMotorCollection = Depends(get_streams_collection),
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
 ):
     """Create a new stream"""
-    streams_collection = await get_streams_collection()
-    users_collection = await get_users_collection()
-    
     # Check if user is already streaming
     existing_stream = await streams_collection.find_one({
         "streamer_id": ObjectId(current_user["_id"]),
         "is_live": True
-    })
+    }, {"_id": 1})
     
     if existing_stream:
         raise HTTPException(
@@ -36,6 +51,7 @@ async def create_stream(
         "streamer_username": current_user["username"],
         "title": stream_data.title,
         "category": stream_data.category,
+        "category_slug": slugify(stream_data.category),
         "thumbnail_url": stream_data.thumbnail_url or f"https://picsum.photos/320/180?random={random.randint(1, 1000)}",
         "description": stream_data.description,
         "is_live": False,
@@ -45,7 +61,9 @@ async def create_stream(
         "created_at": datetime.utcnow()
     }
     
-    result = await streams_collection.insert_one(stream)
+    async with write_session(current_user["username"]) as session:
+        result = await streams_collection.insert_one(stream, session=session)
+    search_index.add(stream_doc(stream))
     
     return {
         "message": "Stream created successfully",
@@ -61,12 +79,11 @@ async def create_stream(
 @router.put("/{stream_id}/start")
 async def start_stream(
     stream_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    streams_collection: AsyncIOMotorCollection = Depends(get_streams_collection),
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
 ):
     """Start a stream (go live)"""
-    streams_collection = await get_streams_collection()
-    users_collection = await get_users_collection()
-    
     # Validate stream ID
     if not ObjectId.is_valid(stream_id):
         raise HTTPException(
@@ -78,7 +95,7 @@ async def start_stream(
     stream = await streams_collection.find_one({
         "_id": ObjectId(stream_id),
         "streamer_id": ObjectId(current_user["_id"])
-    })
+    }, projection(STREAM_CONTROL_FIELDS))
     
     if not stream:
         raise HTTPException(
@@ -92,22 +109,54 @@ async def start_stream(
             detail="Stream is already live"
         )
     
-    # Start stream
-    await streams_collection.update_one(
-        {"_id": ObjectId(stream_id)},
-        {
-            "$set": {
-                "is_live": True,
-                "started_at": datetime.utcnow(),
-                "ended_at": None
-            }
-        }
-    )
+    started_at = datetime.utcnow()
+    async with write_session(current_user["username"]) as session:
+        # Start stream; the is_live filter lets only one concurrent start through.
+        # The counters use the document as it was switched, not the earlier read
+        started = await streams_collection.find_one_and_update(
+            {"_id": ObjectId(stream_id), "is_live": False},
+            {
+                "$set": {
+                    "is_live": True,
+                    "started_at": started_at,
+                    "ended_at": None
+                }
+            },
+            projection={"viewer_count": 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+        if started is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Stream is already live"
+            )
+    
+        # Update user streaming status
+        await users_collection.update_one(
+            {"_id": ObjectId(current_user["_id"])},
+            {"$set": {"is_streaming": True}},
+            session=session
+        )
+    user_cache.invalidate(current_user["username"])
     
-    # Update user streaming status
-    await users_collection.update_one(
-        {"_id": ObjectId(current_user["_id"])},
-        {"$set": {"is_streaming": True}}
+    await adjust_category_counters(
+        stream.get("category_slug") or slugify(stream["category"]),
+        streams=1, viewers=started.get("viewer_count", 0)
+    )
+    # Pick up viewers who were already sitting in chat
+    presence.touch(stream_id)
+    live_directory.invalidate()
+    search_index.update_rank(KIND_STREAM, stream_id, is_live=True)
+    search_index.update_rank(KIND_USER, str(current_user["_id"]), is_live=True)
+    # Push to followers and directory watchers instead of waiting for their next poll
+    await notifications.publish(
+        "stream_live", stream_id, str(current_user["_id"]),
+        streamer_username=current_user["username"],
+        title=stream.get("title"),
+        category=stream.get("category"),
+        viewer_count=started.get("viewer_count", 0),
+        started_at=started_at
     )
     
     return {"message": "Stream started successfully"}
@@ -115,12 +164,11 @@ async def start_stream(
 @router.put("/{stream_id}/stop")
 async def stop_stream(
     stream_id: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    streams_collection: AsyncIOMotorCollection = Depends(get_streams_collection),
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
 ):
     """Stop a stream (go offline)"""
-    streams_collection = await get_streams_collection()
-    users_collection = await get_users_collection()
-    
     # Validate stream ID
     if not ObjectId.is_valid(stream_id):
         raise HTTPException(
@@ -132,7 +180,7 @@ async def stop_stream(
     stream = await streams_collection.find_one({
         "_id": ObjectId(stream_id),
         "streamer_id": ObjectId(current_user["_id"])
-    })
+    }, projection(STREAM_CONTROL_FIELDS))
     
     if not stream:
         raise HTTPException(
@@ -146,65 +194,182 @@ async def stop_stream(
             detail="Stream is not live"
         )
     
-    # Stop stream
-    await streams_collection.update_one(
-        {"_id": ObjectId(stream_id)},
-        {
-            "$set": {
-                "is_live": False,
-                "ended_at": datetime.utcnow(),
-                "viewer_count": 0
-            }
-        }
-    )
+    async with write_session(current_user["username"]) as session:
+        # Stop stream; the is_live filter lets only one concurrent stop through.
+        # The viewers removed from the category are the ones this update zeroed,
+        # even if a presence flush changed them since the read above
+        stopped = await streams_collection.find_one_and_update(
+            {"_id": ObjectId(stream_id), "is_live": True},
+            {
+                "$set": {
+                    "is_live": False,
+                    "ended_at": datetime.utcnow(),
+                    "viewer_count": 0
+                }
+            },
+            projection={"viewer_count": 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+        if stopped is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Stream is not live"
+            )
     
-    # Update user streaming status
-    await users_collection.update_one(
-        {"_id": ObjectId(current_user["_id"])},
-        {"$set": {"is_streaming": False}}
+        # Update user streaming status
+        await users_collection.update_one(
+            {"_id": ObjectId(current_user["_id"])},
+            {"$set": {"is_streaming": False}},
+            session=session
+        )
+    user_cache.invalidate(current_user["username"])
+    
+    await adjust_category_counters(
+        stream.get("category_slug") or slugify(stream["category"]),
+        streams=-1, viewers=-stopped.get("viewer_count", 0)
+    )
+    # Lets the next presence flush forget the stream's published viewer count
+    presence.touch(stream_id)
+    live_directory.invalidate()
+    search_index.update_rank(KIND_STREAM, stream_id, is_live=False, viewers=0)
+    search_index.update_rank(KIND_USER, str(current_user["_id"]), is_live=False)
+    await notifications.publish(
+        "stream_offline", stream_id, str(current_user["_id"]),
+        streamer_username=current_user["username"]
     )
     
     return {"message": "Stream stopped successfully"}
 
-@router.get("/live", response_model=List[dict])
-async def get_live_streams(
-    category: Optional[str] = Query(None),
-    limit: int = Query(20, le=100),
-    skip: int = Query(0, ge=0)
+@router.put("/{stream_id}", response_model=dict)
+async def update_stream(
+    stream_id: str,
+    stream_update: StreamUpdate,
+    current_user: dict = Depends(get_current_user),
+    streams_collection: AsyncIOMotorCollection = Depends(get_streams_collection)
 ):
-    """Get live streams with optional category filter"""
-    streams_collection = await get_streams_collection()
+    """Update a stream's title, category, thumbnail or description (live state goes through start/stop)"""
+    # Validate stream ID
+    if not ObjectId.is_valid(stream_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid stream ID"
+        )
+    
+    # Prepare update data
+    update_data = {}
+    if stream_update.title is not None:
+        update_data["title"] = stream_update.title
+    if stream_update.category is not None:
+        update_data["category"] = stream_update.category
+        update_data["category_slug"] = slugify(stream_update.category)
+    if stream_update.thumbnail_url is not None:
+        update_data["thumbnail_url"] = stream_update.thumbnail_url
+    if stream_update.description is not None:
+        update_data["description"] = stream_update.description
+    
+    if not update_data:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No data provided for update"
+        )
+    
+    # Update and read the previous state in one round trip
+    async with write_session(current_user["username"]) as session:
+        stream = await streams_collection.find_one_and_update(
+            {"_id": ObjectId(stream_id), "streamer_id": ObjectId(current_user["_id"])},
+            {"$set": update_data},
+            projection=projection(STREAM_CONTROL_FIELDS),
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+    
+    if not stream:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Stream not found"
+        )
+    
+    if stream["is_live"]:
+        # Move a live stream's counters to its new category
+        old_slug = stream.get("category_slug") or slugify(stream["category"])
+        new_slug = update_data.get("category_slug", old_slug)
+        if new_slug != old_slug:
+            viewers = stream.get("viewer_count", 0)
+            await adjust_category_counters(old_slug, streams=-1, viewers=-viewers)
+            await adjust_category_counters(new_slug, streams=1, viewers=viewers)
+        live_directory.invalidate()
+    
+    if "title" in update_data or "category" in update_data:
+        search_index.add(stream_doc({
+            **stream, **update_data, "_id": stream_id, "streamer_username": current_user["username"]
+        }))
+        await notifications.publish(
+            "stream_updated", stream_id, str(current_user["_id"]),
+            streamer_username=current_user["username"],
+            title=update_data.get("title", stream.get("title")),
+            category=update_data.get("category", stream.get("category")),
+            is_live=stream["is_live"]
+        )
+    
+    return {"message": "Stream updated successfully"}
+
+async def _load_live_streams(category_slug: Optional[str], limit: int, skip: int, after: Optional[str], before: Optional[str]):
+    # Shared by every viewer, so it reads from secondaries within the staleness bound
+    streams_collection = await get_collection("streams", READ_DIRECTORY)
     
     # Build query
     query = {"is_live": True}
-    if category and category.lower() != "all":
-        query["category"] = {"$regex": category, "$options": "i"}
+    if category_slug:
+        query["category_slug"] = category_slug
+    query, sort, reverse = apply_cursor(query, "viewer_count", -1, cursor=after or before, forward=before is None)
     
     # Get streams
-    streams = await streams_collection.find(query).sort("viewer_count", -1).skip(skip).limit(limit).to_list(length=None)
+    streams = await streams_collection.find(
+        query, projection(LIVE_STREAM_FIELDS)
+    ).sort(sort).skip(skip).limit(limit).to_list(length=None)
+    if reverse:
+        streams.reverse()
     
     # Format response
     formatted_streams = []
     for stream in streams:
-        formatted_streams.append({
-            "id": str(stream["_id"]),
-            "streamer_id": str(stream["streamer_id"]),
-            "streamer_username": stream["streamer_username"],
-            "title": stream["title"],
-            "category": stream["category"],
-            "thumbnail_url": stream["thumbnail_url"],
-            "viewer_count": stream["viewer_count"],
-            "is_live": stream["is_live"],
-            "started_at": stream["started_at"]
-        })
+        formatted_stream = format_document(stream, LIVE_STREAM_FIELDS)
+        formatted_stream["cursor"] = encode_cursor(stream["viewer_count"], stream["_id"])
+        formatted_streams.append(formatted_stream)
     
     return formatted_streams
 
+@router.get("/live", response_model=List[dict])
+async def get_live_streams(
+    request: Request,
+    category: Optional[str] = Query(None),
+    limit: int = Query(20, le=100),
+    skip: int = Query(0, ge=0),
+    after: Optional[str] = Query(None, description="Cursor of a stream; returns the next page"),
+    before: Optional[str] = Query(None, description="Cursor of a stream; returns the previous page")
+):
+    """Get live streams with optional category filter"""
+    reject_both_cursors(before, after)
+    category_slug = slugify(category) if category and category.lower() != "all" else None
+    
+    # Served from the pre-serialized directory snapshot
+    page = await live_directory.get(
+        (category_slug, limit, skip, after, before),
+        lambda: _load_live_streams(category_slug, limit, skip, after, before)
+    )
+    headers = {"ETag": page.etag, "Cache-Control": f"public, max-age={int(LIVE_DIRECTORY_TTL_SECONDS)}"}
+    if request.headers.get("if-none-match") == page.etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    return Response(content=page.body, media_type="application/json", headers=headers)
+
 @router.get("/{stream_id}", response_model=dict)
-async def get_stream(stream_id: str):
+async def get_stream(
+    stream_id: str,
+    streams_collection: AsyncIOMotorCollection = Depends(get_streams_collection)
+):
     """Get stream details"""
-    streams_collection = await get_streams_collection()
-    
     # Validate stream ID
     if not ObjectId.is_valid(stream_id):
         raise HTTPException(
@@ -212,7 +377,7 @@ async def get_stream(stream_id: str):
             detail="Invalid stream ID"
         )
     
-    stream = await streams_collection.find_one({"_id": ObjectId(stream_id)})
+    stream = await streams_collection.find_one({"_id": ObjectId(stream_id)}, projection(STREAM_DETAIL_FIELDS))
     
     if not stream:
         raise HTTPException(
@@ -220,41 +385,38 @@ async def get_stream(stream_id: str):
             detail="Stream not found"
         )
     
-    return {
-        "id": str(stream["_id"]),
-        "streamer_id": str(stream["streamer_id"]),
-        "streamer_username": stream["streamer_username"],
-        "title": stream["title"],
-        "category": stream["category"],
-        "thumbnail_url": stream["thumbnail_url"],
-        "description": stream.get("description"),
-        "viewer_count": stream["viewer_count"],
-        "is_live": stream["is_live"],
-        "started_at": stream["started_at"],
-        "created_at": stream["created_at"]
-    }
+    return json_response(format_document(stream, STREAM_DETAIL_FIELDS))
 
 @router.get("/user/{username}", response_model=List[dict])
-async def get_user_streams(username: str):
+async def get_user_streams(
+    username: str,
+    limit: Optional[int] = Query(None, ge=1, le=100),
+    skip: int = Query(0, ge=0),
+    after: Optional[str] = Query(None, description="Cursor of a stream; returns older streams"),
+    before: Optional[str] = Query(None, description="Cursor of a stream; returns newer streams"),
+    reader: Optional[str] = Depends(get_optional_username),
+    streams_collection: AsyncIOMotorCollection = Depends(collection_for("streams", READ_PROFILE))
+):
     """Get all streams by a specific user"""
-    streams_collection = await get_streams_collection()
+    reject_both_cursors(before, after)
     
-    streams = await streams_collection.find({
-        "streamer_username": username
-    }).sort("created_at", -1).to_list(length=None)
+    query, sort, reverse = apply_cursor(
+        {"streamer_username": username}, "created_at", -1,
+        cursor=after or before, forward=before is None
+    )
+    # The streamer sees their own just-created streams even on a lagging secondary
+    async with read_session(reader) as session:
+        cursor = streams_collection.find(query, projection(USER_STREAM_FIELDS), session=session).sort(sort).skip(skip)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        streams = await cursor.to_list(length=None)
+    if reverse:
+        streams.reverse()
     
     formatted_streams = []
     for stream in streams:
-        formatted_streams.append({
-            "id": str(stream["_id"]),
-            "title": stream["title"],
-            "category": stream["category"],
-            "thumbnail_url": stream["thumbnail_url"],
-            "viewer_count": stream["viewer_count"],
-            "is_live": stream["is_live"],
-            "started_at": stream["started_at"],
-            "ended_at": stream.get("ended_at"),
-            "created_at": stream["created_at"]
-        })
-    
-    return formatted_streams
\ No newline at end of file
+        formatted_stream = format_document(stream, USER_STREAM_FIELDS)
+        formatted_stream["cursor"] = encode_cursor(stream["created_at"], stream["_id"])
+        formatted_streams.append(formatted_stream)
+    
+    return json_response(formatted_streams)
\ No newline at end of file
@@ -1,17 +1,33 @@
-from fastapi import APIRouter, HTTPException, status, Depends
-from database import get_users_collection, get_follows_collection
+from fastapi import APIRouter, HTTPException, status, Depends, Query
+from motor.motor_asyncio import AsyncIOMotorCollection
+from database import (
+    get_users_collection, get_follows_collection, collection_for, read_session, write_session, READ_PROFILE
+)
 from models import UserProfile, UserUpdate, Follow
-from auth_utils import get_current_user
+from auth_utils import get_current_user, get_optional_username
+from user_cache import user_cache
+from follow_counters import follow_counters
+from notifications import notifications
+from search_index import search_index, user_doc
+from pagination import apply_cursor, encode_cursor, reject_both_cursors
+from serialization import json_response
+from projections import PUBLIC_PROFILE_FIELDS, projection, format_document
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from typing import List, Optional
 
 router = APIRouter()
 
 @router.get("/profile/{username}", response_model=dict)
-async def get_user_profile(username: str):
+async def get_user_profile(
+    username: str,
+    reader: Optional[str] = Depends(get_optional_username),
+    users_collection: AsyncIOMotorCollection = Depends(collection_for("users", READ_PROFILE))
+):
     """Get user profile by username"""
-    users_collection = await get_users_collection()
-    user = await users_collection.find_one({"username": username})
+    # Authors read their own profile edits and follows back through a causal session
+    async with read_session(reader) as session:
+        user = await users_collection.find_one({"username": username}, projection(PUBLIC_PROFILE_FIELDS), session=session)
     
     if not user:
         raise HTTPException(
@@ -20,27 +36,15 @@ async def get_user_profile(username: str):
         )
     
     # Return public profile information
-    profile = {
-        "id": str(user["_id"]),
-        "username": user["username"],
-        "full_name": user.get("full_name"),
-        "avatar_url": user.get("avatar_url"),
-        "bio": user.get("bio", ""),
-        "followers_count": user.get("followers_count", 0),
-        "following_count": user.get("following_count", 0),
-        "is_streaming": user.get("is_streaming", False),
-        "created_at": user.get("created_at")
-    }
-    return profile
+    return json_response(format_document(user, PUBLIC_PROFILE_FIELDS))
 
 @router.put("/profile", response_model=dict)
 async def update_user_profile(
     profile_update: UserUpdate,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
 ):
     """Update current user's profile"""
-    users_collection = await get_users_collection()
-    
     # Prepare update data
     update_data = {}
     if profile_update.full_name is not None:
@@ -57,10 +61,12 @@ async def update_user_profile(
         )
     
     # Update user profile
-    result = await users_collection.update_one(
-        {"_id": ObjectId(current_user["_id"])},
-        {"$set": update_data}
-    )
+    async with write_session(current_user["username"]) as session:
+        result = await users_collection.update_one(
+            {"_id": ObjectId(current_user["_id"])},
+            {"$set": update_data},
+            session=session
+        )
     
     if result.modified_count == 0:
         raise HTTPException(
@@ -68,76 +74,69 @@ async def update_user_profile(
             detail="Profile update failed"
         )
     
+    user_cache.invalidate(current_user["username"])
+    # Full names are searchable, and results show the avatar
+    if "full_name" in update_data or "avatar_url" in update_data:
+        search_index.add(user_doc({**current_user, **update_data}))
+    
     return {"message": "Profile updated successfully"}
 
 @router.post("/follow/{username}")
 async def follow_user(
     username: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection),
+    follows_collection: AsyncIOMotorCollection = Depends(get_follows_collection)
 ):
-    """Follow a user"""
+    """Follow a user (idempotent)"""
     if username == current_user["username"]:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Cannot follow yourself"
         )
     
-    users_collection = await get_users_collection()
-    follows_collection = await get_follows_collection()
-    
     # Check if target user exists
-    target_user = await users_collection.find_one({"username": username})
+    target_user = await users_collection.find_one({"username": username}, {"_id": 1})
     if not target_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found"
         )
     
-    # Check if already following
-    existing_follow = await follows_collection.find_one({
-        "follower_id": ObjectId(current_user["_id"]),
-        "following_id": ObjectId(target_user["_id"])
-    })
-    
-    if existing_follow:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Already following this user"
-        )
-    
-    # Create follow relationship
-    follow_data = {
-        "follower_id": ObjectId(current_user["_id"]),
-        "following_id": ObjectId(target_user["_id"]),
-        "created_at": datetime.utcnow()
-    }
-    
-    await follows_collection.insert_one(follow_data)
-    
-    # Update follower and following counts
-    await users_collection.update_one(
-        {"_id": ObjectId(current_user["_id"])},
-        {"$inc": {"following_count": 1}}
-    )
-    
-    await users_collection.update_one(
-        {"_id": ObjectId(target_user["_id"])},
-        {"$inc": {"followers_count": 1}}
-    )
+    # One upsert; the unique follower/following index turns a concurrent
+    # duplicate into a no-op instead of a second follow
+    follower_id = ObjectId(current_user["_id"])
+    try:
+        async with write_session(current_user["username"]) as session:
+            result = await follows_collection.update_one(
+                {"follower_id": follower_id, "following_id": target_user["_id"]},
+                {"$setOnInsert": {"created_at": datetime.utcnow()}},
+                upsert=True,
+                session=session
+            )
+        created = result.upserted_id is not None
+    except DuplicateKeyError:
+        created = False
+    
+    if not created:
+        return {"message": f"Already following {username}"}
+    
+    # Follower and following counts are applied in batches
+    follow_counters.record(follower_id, target_user["_id"], 1, current_user["username"], username)
+    notifications.follow(current_user["username"], str(target_user["_id"]))
     
     return {"message": f"Successfully followed {username}"}
 
 @router.delete("/unfollow/{username}")
 async def unfollow_user(
     username: str,
-    current_user: dict = Depends(get_current_user)
+    current_user: dict = Depends(get_current_user),
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection),
+    follows_collection: AsyncIOMotorCollection = Depends(get_follows_collection)
 ):
-    """Unfollow a user"""
-    users_collection = await get_users_collection()
-    follows_collection = await get_follows_collection()
-    
+    """Unfollow a user (idempotent)"""
     # Check if target user exists
-    target_user = await users_collection.find_one({"username": username})
+    target_user = await users_collection.find_one({"username": username}, {"_id": 1})
     if not target_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -145,54 +144,87 @@ async def unfollow_user(
         )
     
     # Remove follow relationship
-    result = await follows_collection.delete_one({
-        "follower_id": ObjectId(current_user["_id"]),
-        "following_id": ObjectId(target_user["_id"])
-    })
+    follower_id = ObjectId(current_user["_id"])
+    async with write_session(current_user["username"]) as session:
+        result = await follows_collection.delete_one({
+            "follower_id": follower_id,
+            "following_id": target_user["_id"]
+        }, session=session)
     
     if result.deleted_count == 0:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Not following this user"
-        )
+        return {"message": f"Not following {username}"}
     
-    # Update follower and following counts
-    await users_collection.update_one(
-        {"_id": ObjectId(current_user["_id"])},
-        {"$inc": {"following_count": -1}}
-    )
-    
-    await users_collection.update_one(
-        {"_id": ObjectId(target_user["_id"])},
-        {"$inc": {"followers_count": -1}}
-    )
+    # Follower and following counts are applied in batches
+    follow_counters.record(follower_id, target_user["_id"], -1, current_user["username"], username)
+    notifications.unfollow(current_user["username"], str(target_user["_id"]))
     
     return {"message": f"Successfully unfollowed {username}"}
 
 @router.get("/following", response_model=List[dict])
-async def get_following_list(current_user: dict = Depends(get_current_user)):
+async def get_following_list(
+    current_user: dict = Depends(get_current_user),
+    live_only: bool = Query(False, description="Only include users who are streaming right now"),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    after: Optional[str] = Query(None, description="Cursor of a follow; returns older follows"),
+    before: Optional[str] = Query(None, description="Cursor of a follow; returns newer follows"),
+    follows_collection: AsyncIOMotorCollection = Depends(get_follows_collection)
+):
     """Get list of users that current user is following"""
-    follows_collection = await get_follows_collection()
-    users_collection = await get_users_collection()
+    reject_both_cursors(before, after)
+    
+    # Most recent follows first
+    query, sort, reverse = apply_cursor(
+        {"follower_id": ObjectId(current_user["_id"])}, "created_at", -1,
+        cursor=after or before, forward=before is None
+    )
     
-    # Get all follows by current user
-    follows = await follows_collection.find({
-        "follower_id": ObjectId(current_user["_id"])
-    }).to_list(length=None)
+    # Join followed users in one round trip instead of one find_one per follow
+    pipeline = [
+        {"$match": query},
+        {"$sort": dict(sort)}
+    ]
+    # Without a filter on the joined user, limit first so only one page is joined
+    if limit is not None and not live_only:
+        pipeline.append({"$limit": limit})
+    pipeline += [
+        {"$lookup": {
+            "from": "users",
+            "localField": "following_id",
+            "foreignField": "_id",
+            "as": "user"
+        }},
+        {"$unwind": "$user"}
+    ]
+    if live_only:
+        pipeline.append({"$match": {"user.is_streaming": True}})
+        if limit is not None:
+            pipeline.append({"$limit": limit})
+    pipeline.append({"$project": {
+        "created_at": 1,
+        "user._id": 1,
+        "user.username": 1,
+        "user.full_name": 1,
+        "user.avatar_url": 1,
+        "user.is_streaming": 1
+    }})
+    
+    follows = await follows_collection.aggregate(pipeline).to_list(length=None)
+    if reverse:
+        follows.reverse()
     
     following_list = []
     for follow in follows:
-        user = await users_collection.find_one({"_id": follow["following_id"]})
-        if user:
-            following_list.append({
-                "id": str(user["_id"]),
-                "username": user["username"],
-                "full_name": user.get("full_name"),
-                "avatar_url": user.get("avatar_url"),
-                "is_streaming": user.get("is_streaming", False),
-                "followed_at": follow["created_at"]
-            })
-    
-    return following_list
+        user = follow["user"]
+        following_list.append({
+            "id": str(user["_id"]),
+            "username": user["username"],
+            "full_name": user.get("full_name"),
+            "avatar_url": user.get("avatar_url"),
+            "is_streaming": user.get("is_streaming", False),
+            "followed_at": follow["created_at"],
+            "cursor": encode_cursor(follow["created_at"], follow["_id"])
+        })
+    
+    return json_response(following_list)
 
 from datetime import datetime
\ No newline at end of file
@@ -0,0 +1,287 @@
+"""
+In-process prefix search over usernames, stream titles and categories.
+
+Every indexed document is split into lowercase terms. The index keeps a
+sorted list of distinct terms plus a posting set per term, so the terms
+starting with a query word form one contiguous bisect range. Multi-word
+queries must match every word as a prefix. Every match is scored and a
+bounded heap keeps the best: whether the name itself starts with the query,
+then live status, then viewers.
+
+Writes served by this worker update the index incrementally. A full
+rebuild from MongoDB runs at startup and every SEARCH_REBUILD_INTERVAL_SECONDS,
+which also picks up writes served by other workers. A rebuild is a few
+projected scans plus one sort, and the new index is swapped in atomically;
+incremental writes made while it loads are replayed onto the new index.
+"""
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import asyncio
+import heapq
+import os
+import re
+import time
+from dotenv import load_dotenv
+from database import get_categories_collection, get_streams_collection, get_users_collection
+
+load_dotenv()
+
+SEARCH_REBUILD_INTERVAL_SECONDS = float(os.getenv("SEARCH_REBUILD_INTERVAL_SECONDS", "300"))
+# Ended streams older than this are left out of the index
+SEARCH_STREAM_HISTORY_DAYS = int(os.getenv("SEARCH_STREAM_HISTORY_DAYS", "30"))
+
+KIND_USER = "user"
+KIND_STREAM = "stream"
+KIND_CATEGORY = "category"
+
+_WORDS = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return _WORDS.findall(text.lower()) if text else []
+
+
+class SearchDoc:
+    __slots__ = ("kind", "id", "label", "terms", "is_live", "viewers", "fields")
+
+    def __init__(self, kind: str, id: str, label: str, terms: Iterable[str], is_live: bool, viewers: int, fields: dict):
+        self.kind = kind
+        self.id = id
+        self.label = label
+        self.terms = frozenset(terms)
+        self.is_live = is_live
+        self.viewers = viewers
+        # Returned with the result, e.g. the streamer of a stream
+        self.fields = fields
+
+    @property
+    def key(self) -> str:
+        return f"{self.kind}:{self.id}"
+
+    def result(self) -> dict:
+        return {
+            "kind": self.kind,
+            "id": self.id,
+            "label": self.label,
+            "is_live": self.is_live,
+            # Users rank by followers, streams and categories by viewers
+            "followers_count" if self.kind == KIND_USER else "viewer_count": self.viewers,
+            **self.fields
+        }
+
+
+def user_doc(user: dict) -> SearchDoc:
+    username = user["username"]
+    return SearchDoc(
+        KIND_USER, str(user["_id"]), username,
+        [*tokenize(username), *tokenize(user.get("full_name"))],
+        user.get("is_streaming", False), user.get("followers_count", 0),
+        {"full_name": user.get("full_name"), "avatar_url": user.get("avatar_url")}
+    )
+
+
+def stream_doc(stream: dict) -> SearchDoc:
+    return SearchDoc(
+        KIND_STREAM, str(stream["_id"]), stream.get("title") or "",
+        [*tokenize(stream.get("title")), *tokenize(stream.get("category")), *tokenize(stream.get("streamer_username"))],
+        stream.get("is_live", False), stream.get("viewer_count", 0),
+        {"streamer_username": stream.get("streamer_username"), "category": stream.get("category")}
+    )
+
+
+def category_doc(category: dict) -> SearchDoc:
+    return SearchDoc(
+        KIND_CATEGORY, str(category["_id"]), category["name"],
+        tokenize(category["name"]),
+        category.get("stream_count", 0) > 0, category.get("viewer_count", 0),
+        {"slug": category.get("slug")}
+    )
+
+
+class SearchIndex:
+    def __init__(self, rebuild_interval: float = SEARCH_REBUILD_INTERVAL_SECONDS):
+        self.rebuild_interval = rebuild_interval
+        self._docs: Dict[str, SearchDoc] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        self._terms: List[str] = []
+        # Category slug -> document key, for counter updates by slug
+        self._category_keys: Dict[str, str] = {}
+        # Incremental writes made while a rebuild loads, replayed after the swap
+        self._replay: Optional[List[tuple]] = None
+        self._rebuilder: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, doc: SearchDoc):
+        """Index a document, replacing any previous version of it"""
+        if self._replay is not None:
+            self._replay.append((self.add, (doc,)))
+        key = doc.key
+        previous = self._docs.get(key)
+        if previous is not None:
+            for term in previous.terms - doc.terms:
+                self._unpost(term, key)
+        self._docs[key] = doc
+        for term in doc.terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = set()
+                insort(self._terms, term)
+            postings.add(key)
+        if doc.kind == KIND_CATEGORY and doc.fields.get("slug"):
+            self._category_keys[doc.fields["slug"]] = key
+
+    def remove(self, kind: str, id: str):
+        if self._replay is not None:
+            self._replay.append((self.remove, (kind, id)))
+        doc = self._docs.pop(f"{kind}:{id}", None)
+        if doc is not None:
+            for term in doc.terms:
+                self._unpost(term, doc.key)
+            if doc.kind == KIND_CATEGORY:
+                self._category_keys.pop(doc.fields.get("slug"), None)
+
+    def update_rank(self, kind: str, id: str, is_live: Optional[bool] = None, viewers: Optional[int] = None):
+        """Change a document's ranking without reindexing its terms"""
+        if self._replay is not None:
+            self._replay.append((self.update_rank, (kind, id, is_live, viewers)))
+        doc = self._docs.get(f"{kind}:{id}")
+        if doc is None:
+            return
+        if is_live is not None:
+            doc.is_live = is_live
+        if viewers is not None:
+            doc.viewers = viewers
+
+    def update_category_rank(self, slug: str, is_live: Optional[bool] = None, viewers: Optional[int] = None):
+        """update_rank for a category known by slug, e.g. after its counters change"""
+        key = self._category_keys.get(slug)
+        if key is not None:
+            self.update_rank(KIND_CATEGORY, key.split(":", 1)[1], is_live=is_live, viewers=viewers)
+
+    def search(self, query: str, limit: int = 10, kind: Optional[str] = None) -> List[dict]:
+        words = tokenize(query)
+        if not words:
+            return []
+
+        # Every word must prefix-match: expand only the rarest word's range and
+        # check the other words against each candidate's own terms
+        ranges = sorted((self._prefix_range(word) for word in words), key=lambda found: found[2])
+        candidates = self._prefix_matches(ranges[0])
+        others = [prefix for prefix, _, _ in ranges[1:]]
+        if others:
+            candidates = {
+                key for key in candidates
+                if all(any(term.startswith(prefix) for term in self._docs[key].terms) for prefix in others)
+            }
+
+        needle = query.strip().lower()
+        docs = (self._docs[key] for key in candidates)
+        # nlargest keeps a heap of `limit` entries while scoring every match
+        scored = (
+            ((doc.label.lower().startswith(needle), doc.is_live, doc.viewers), doc.key)
+            for doc in docs
+            if not kind or doc.kind == kind
+        )
+        return [self._docs[key].result() for _, key in heapq.nlargest(limit, scored)]
+
+    async def rebuild(self):
+        """Reload every searchable document from MongoDB and swap the index in"""
+        started = time.perf_counter()
+        self._replay = []
+        try:
+            docs = await self._load_docs()
+        except BaseException:
+            # Failed or cancelled: writes go straight to the current index again
+            self._replay = None
+            raise
+
+        # Build the replacement off to the side: one sort instead of an insort per term
+        index = {doc.key: doc for doc in docs}
+        postings: Dict[str, Set[str]] = {}
+        for doc in index.values():
+            for term in doc.terms:
+                postings.setdefault(term, set()).add(doc.key)
+        category_keys = {
+            doc.fields["slug"]: doc.key
+            for doc in index.values()
+            if doc.kind == KIND_CATEGORY and doc.fields.get("slug")
+        }
+        self._docs, self._postings, self._terms = index, postings, sorted(postings)
+        self._category_keys = category_keys
+
+        replay, self._replay = self._replay, None
+        for write, args in replay:
+            write(*args)
+        print(f"🔎 Search index rebuilt: {len(index)} documents in {time.perf_counter() - started:.2f}s")
+
+    async def _load_docs(self) -> List[SearchDoc]:
+        users_collection = await get_users_collection()
+        streams_collection = await get_streams_collection()
+        categories_collection = await get_categories_collection()
+
+        docs: List[SearchDoc] = []
+        async for user in users_collection.find(
+            {}, {"username": 1, "full_name": 1, "avatar_url": 1, "is_streaming": 1, "followers_count": 1}
+        ):
+            docs.append(user_doc(user))
+        async for stream in streams_collection.find(
+            {"$or": [
+                {"is_live": True},
+                {"created_at": {"$gte": datetime.utcnow() - timedelta(days=SEARCH_STREAM_HISTORY_DAYS)}}
+            ]},
+            {"title": 1, "category": 1, "streamer_username": 1, "is_live": 1, "viewer_count": 1}
+        ):
+            docs.append(stream_doc(stream))
+        async for category in categories_collection.find(
+            {}, {"name": 1, "slug": 1, "viewer_count": 1, "stream_count": 1}
+        ):
+            docs.append(category_doc(category))
+        return docs
+
+    async def start(self):
+        if self._rebuilder is None and self.rebuild_interval > 0:
+            self._rebuilder = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._rebuilder is not None:
+            self._rebuilder.cancel()
+            self._rebuilder = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.rebuild_interval)
+            try:
+                await self.rebuild()
+            except Exception as e:
+                print(f"❌ Search index rebuild failed: {e}")
+
+    def _prefix_range(self, prefix: str) -> Tuple[str, range, int]:
+        """(prefix, terms range, number of postings in it)"""
+        # Terms are [a-z0-9], so every term with the prefix sorts before prefix + "\uffff"
+        start = bisect_left(self._terms, prefix)
+        end = bisect_left(self._terms, prefix + "\uffff", start)
+        size = sum(len(self._postings[self._terms[index]]) for index in range(start, end))
+        return prefix, range(start, end), size
+
+    def _prefix_matches(self, found: Tuple[str, range, int]) -> Set[str]:
+        matches: Set[str] = set()
+        for index in found[1]:
+            matches.update(self._postings[self._terms[index]])
+        return matches
+
+    def _unpost(self, term: str, key: str):
+        postings = self._postings.get(term)
+        if postings is None:
+            return
+        postings.discard(key)
+        if not postings:
+            del self._postings[term]
+            index = bisect_left(self._terms, term)
+            if index < len(self._terms) and self._terms[index] == term:
+                del self._terms[index]
+
+
+search_index = SearchIndex()
@@ -0,0 +1,60 @@
+"""
+Shared JSON serialization for HTTP responses and WebSocket frames.
+
+Uses orjson when it is installed (falling back to the standard library) and
+encodes BSON types such as ObjectId directly, so documents do not have to go
+through FastAPI's jsonable_encoder and response_model re-validation first.
+"""
+from fastapi.responses import JSONResponse
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from datetime import date, datetime
+from typing import Any, Optional
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+def _default(obj: Any):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal128):
+        return str(obj.to_decimal())
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+    def dumps_str(obj: Any) -> str:
+        return orjson.dumps(obj, default=_default).decode()
+
+    loads = orjson.loads
+else:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, default=_default, separators=(",", ":")).encode()
+
+    def dumps_str(obj: Any) -> str:
+        return json.dumps(obj, default=_default, separators=(",", ":"))
+
+    loads = json.loads
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered straight from dicts holding ObjectIds/datetimes"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def json_response(content: Any, status_code: int = 200, headers: Optional[dict] = None) -> FastJSONResponse:
+    """Return from a route to skip response_model validation and jsonable_encoder"""
+    return FastJSONResponse(content=content, status_code=status_code, headers=headers)
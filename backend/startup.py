@@ -4,6 +4,8 @@ Startup script to initialize the database with sample data
 import asyncio
 from database import get_database, get_users_collection, get_streams_collection, get_categories_collection
 from auth_utils import get_password_hash
+from indexes import ensure_indexes
+from category_utils import slugify, reconcile_category_counters
 from datetime import datetime
 import random
 
@@ -113,11 +115,13 @@ async def create_sample_streams(user_ids):
     sample_streams = []
     for i, user in enumerate(users):
         if user["is_streaming"]:
+            category = ["Games", "Music", "Science & Technology", "Art", "Food & Drink"][i % 5]
             stream = {
                 "streamer_id": user["_id"],
                 "streamer_username": user["username"],
                 "title": f"Live Stream by {user['username']}",
-                "category": ["Games", "Music", "Science & Technology", "Art", "Food & Drink"][i % 5],
+                "category": category,
+                "category_slug": slugify(category),
                 "thumbnail_url": thumbnails[i % len(thumbnails)],
                 "description": f"Amazing live content from {user['username']}",
                 "is_live": True,
@@ -142,9 +146,12 @@ async def initialize_database():
         await db.command("ping")
         print("✅ Database connection successful")
         
+        await ensure_indexes(db)
+        
         # Create sample data
         user_ids = await create_sample_users()
         await create_sample_streams(user_ids)
+        await reconcile_category_counters()
         
         print("✅ Database initialization complete!")
         
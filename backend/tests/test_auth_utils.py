@@ -0,0 +1,9 @@
+"""bcrypt cost calibration never goes below passlib's default."""
+from passlib.hash import bcrypt as bcrypt_scheme
+import auth_utils
+
+
+def test_calibration_keeps_the_default_cost_on_a_slow_host():
+    rounds = auth_utils.calibrate_bcrypt_rounds(target_ms=1)
+    assert rounds == bcrypt_scheme.default_rounds
+    assert auth_utils.get_password_hash("hunter2").startswith(f"$2b${rounds}$")
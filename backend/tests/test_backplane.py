@@ -0,0 +1,83 @@
+"""Two workers sharing a Redis backplane, with fakeredis standing in for the server."""
+import asyncio
+import fakeredis
+from backplane import RedisBackplane
+from serialization import loads
+from websocket_manager import ConnectionManager
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.scope = {"subprotocols": []}
+        self.query_params = {}
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, frame):
+        self.sent.append(loads(frame))
+
+    async def close(self, code=1000):
+        pass
+
+
+async def wait_for(condition, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def chat_frames(websocket):
+    return [frame for frame in websocket.sent if frame["type"] == "chat_message"]
+
+
+def test_message_published_on_one_worker_reaches_the_other():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        workers = [
+            ConnectionManager(RedisBackplane(client=fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)))
+            for _ in range(2)
+        ]
+        for worker in workers:
+            await worker.start()
+        try:
+            viewer = FakeWebSocket()
+            await workers[1].connect(viewer, "stream-1")
+            assert workers[1].backplane.receives("stream-1")
+            assert not workers[0].backplane.receives("stream-1")
+
+            await workers[0].broadcast_to_stream("stream-1", {"type": "chat_message", "message": "hello"})
+            await wait_for(lambda: chat_frames(viewer))
+            assert chat_frames(viewer)[0]["message"] == "hello"
+        finally:
+            for worker in workers:
+                await worker.close()
+
+    asyncio.run(scenario())
+
+
+def test_worker_unsubscribes_when_last_local_socket_leaves():
+    async def scenario():
+        backplane = RedisBackplane(client=fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True))
+        worker = ConnectionManager(backplane)
+        await worker.start()
+        try:
+            viewers = [FakeWebSocket(), FakeWebSocket()]
+            for viewer in viewers:
+                await worker.connect(viewer, "stream-1")
+
+            worker.disconnect(viewers[0], "stream-1")
+            await asyncio.sleep(0.05)
+            assert backplane.receives("stream-1")
+
+            worker.disconnect(viewers[1], "stream-1")
+            await wait_for(lambda: not backplane.receives("stream-1"))
+            assert await backplane.client.pubsub_numsub(f"{backplane.channel_prefix}stream-1") == [
+                (f"{backplane.channel_prefix}stream-1", 0)
+            ]
+        finally:
+            await worker.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,43 @@
+"""Causal positions round-tripped through the client."""
+import asyncio
+import httpx
+from bson.timestamp import Timestamp
+from database import (
+    CausalPositionMiddleware, decode_position, encode_position, note_written_position, request_position
+)
+
+CLUSTER_TIME = {"clusterTime": Timestamp(1700000000, 3), "signature": {"keyId": 7}}
+OPERATION_TIME = Timestamp(1700000000, 2)
+
+
+def test_positions_survive_the_header_encoding():
+    assert decode_position(encode_position(CLUSTER_TIME, OPERATION_TIME)) == (CLUSTER_TIME, OPERATION_TIME)
+
+
+def test_malformed_positions_are_ignored():
+    assert decode_position("not base64 !") is None
+    assert decode_position(encode_position({"clusterTime": 1}, OPERATION_TIME)) is None
+    assert decode_position("x" * 2000) is None
+
+
+def test_a_write_position_is_returned_and_restored_on_the_next_request():
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(request_position())
+        if scope["path"] == "/write":
+            note_written_position(CLUSTER_TIME, OPERATION_TIME)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=CausalPositionMiddleware(app))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            written = await client.post("/write")
+            position = written.headers["x-causal-position"]
+            # Possibly another worker: only the header carries the position
+            read = await client.get("/read", headers={"X-Causal-Position": position})
+            assert "x-causal-position" not in read.headers
+
+    asyncio.run(scenario())
+    assert seen == [None, (CLUSTER_TIME, OPERATION_TIME)]
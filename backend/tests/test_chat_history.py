@@ -0,0 +1,45 @@
+"""Ring buffer windows served from memory instead of MongoDB."""
+from chat_history import ChatHistory
+
+
+def _messages(count):
+    return [{"id": str(number), "message": f"hi {number}"} for number in range(count)]
+
+
+def test_window_counts_back_from_the_newest_message():
+    history = ChatHistory(size=5)
+    for message in _messages(8):
+        history.append("stream-1", message)
+
+    assert [m["id"] for m in history.window("stream-1", skip=0, limit=2)] == ["6", "7"]
+    assert [m["id"] for m in history.window("stream-1", skip=2, limit=3)] == ["3", "4", "5"]
+    # Older messages fell off the ring, so MongoDB has to answer
+    assert history.window("stream-1", skip=3, limit=3) is None
+
+
+def test_complete_history_answers_past_its_end():
+    history = ChatHistory(size=5)
+    history.prime("stream-1", _messages(3), complete=True)
+    assert [m["id"] for m in history.window("stream-1", skip=1, limit=10)] == ["0", "1"]
+
+    for message in _messages(3):
+        history.append("stream-1", message)
+    # A message was pushed out, so the buffer is no longer the whole chat
+    assert history.window("stream-1", skip=0, limit=10) is None
+
+
+def test_prime_does_not_overwrite_live_messages():
+    history = ChatHistory(size=5)
+    history.append("stream-1", {"id": "live"})
+    history.prime("stream-1", _messages(3), complete=True)
+    assert [m["id"] for m in history.recent("stream-1")] == ["live"]
+
+
+def test_least_recently_used_stream_is_evicted():
+    history = ChatHistory(size=5, max_streams=2)
+    history.append("stream-1", {"id": "a"})
+    history.append("stream-2", {"id": "b"})
+    history.append("stream-1", {"id": "c"})
+    history.append("stream-3", {"id": "d"})
+    assert history.window("stream-2", skip=0, limit=1) is None
+    assert [m["id"] for m in history.recent("stream-1")] == ["a", "c"]
@@ -0,0 +1,64 @@
+"""Compact (MessagePack) chat frames."""
+from datetime import datetime, timezone
+import time
+import msgpack
+import chat_protocol
+from chat_protocol import CompactEncoder, FRAME_BATCH
+from serialization import dumps_str
+
+SENT_AT = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def chat(username, color="#9146FF"):
+    return {
+        "type": "chat_message", "id": "1", "username": username, "message": "hi",
+        "timestamp": SENT_AT.isoformat(), "color": color
+    }
+
+
+def test_naive_timestamps_are_read_as_utc(monkeypatch):
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        body = msgpack.unpackb(CompactEncoder().encode(dumps_str(chat("alice"))).body)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert body[4] == int(SENT_AT.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def test_rollover_re_encodes_the_whole_frame(monkeypatch):
+    monkeypatch.setattr(chat_protocol, "MAX_INTERNED", 4)
+    encoder = CompactEncoder()
+    encoder.encode(dumps_str(chat("alice")))
+    encoder.encode(dumps_str(chat("bob")))
+
+    # "carol" fills the old table, so "dave" starts a new generation mid-batch
+    frame = encoder.encode(dumps_str({"type": "chat_batch", "messages": [chat("carol"), chat("dave")]}))
+    body = msgpack.unpackb(frame.body)
+    assert frame.generation == 1
+    assert body[0] == FRAME_BATCH
+    assert [frame.refs[message[2]] for message in body[1]] == ["carol", "dave"]
+    assert all(frame.refs[message[5]] == "#9146FF" for message in body[1])
+    # Every ref the frame defines belongs to the new table
+    assert all(encoder._refs.get(value) == ref for ref, value in frame.refs.items())
+
+
+def test_colors_past_the_budget_are_sent_inline(monkeypatch):
+    monkeypatch.setattr(chat_protocol, "MAX_INTERNED_COLORS", 1)
+    encoder = CompactEncoder()
+    first = encoder.encode(dumps_str(chat("alice", "#000001")))
+    second = encoder.encode(dumps_str(chat("alice", "#000002")))
+    assert first.refs[msgpack.unpackb(first.body)[5]] == "#000001"
+    assert msgpack.unpackb(second.body)[5] == "#000002"
+    assert second.generation == 0
+
+
+def test_non_string_fields_are_sent_as_is():
+    encoder = CompactEncoder()
+    frame = encoder.encode(dumps_str(chat({}, color=[])))
+    body = msgpack.unpackb(frame.body)
+    assert body[2] == {} and body[5] == []
+    assert frame.refs == {}
+    # The table is untouched for the next, well-formed message
+    assert msgpack.unpackb(encoder.encode(dumps_str(chat("alice"))).body)[2] == 0
@@ -0,0 +1,76 @@
+"""Query shapes recorded from the commands the app sends, and the COLLSCAN check on their plans."""
+import asyncio
+from types import SimpleNamespace
+from bson import ObjectId
+from indexes import QueryShapeRecorder, scans_collection
+from pagination import apply_cursor, encode_cursor
+
+
+def _started(command_name, command, database_name="twitch_clone"):
+    return SimpleNamespace(command_name=command_name, command=command, database_name=database_name)
+
+
+def _plan(stage):
+    return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": stage}}}}
+
+
+class FakeClient:
+    """Explains every command with the plan its collection is set up to use"""
+
+    def __init__(self, plans):
+        self.plans = plans
+        self.explained = []
+
+    def __getitem__(self, database_name):
+        return self
+
+    async def command(self, command):
+        self.explained.append(command["explain"])
+        name = next(iter(command["explain"]))
+        return self.plans[command["explain"][name]]
+
+
+def test_each_shape_is_explained_once_whatever_its_values():
+    recorder = QueryShapeRecorder()
+    for _ in range(3):
+        query, sort, _ = apply_cursor({"is_live": True}, "viewer_count", -1, encode_cursor(7, ObjectId()))
+        recorder.started(_started("find", {"find": "streams", "filter": query, "sort": dict(sort), "limit": 20}))
+    recorder.started(_started("find", {"find": "users", "filter": {"_id": {"$in": [ObjectId(), ObjectId()]}}}))
+    recorder.started(_started("find", {"find": "users", "filter": {"_id": {"$in": [ObjectId()]}}}))
+
+    client = FakeClient({"streams": _plan("IXSCAN"), "users": _plan("IXSCAN")})
+    assert asyncio.run(recorder.check(client)) == []
+    assert [next(iter(command.values())) for command in client.explained] == ["streams", "users"]
+    assert "limit" not in client.explained[0]
+
+
+def test_unindexed_router_query_is_reported():
+    recorder = QueryShapeRecorder()
+    recorder.started(_started("distinct", {"distinct": "streams", "key": "category", "query": {"category_slug": {"$exists": False}}}))
+    recorder.started(_started("aggregate", {"aggregate": "follows", "pipeline": [{"$match": {"follower_id": ObjectId()}}], "cursor": {}}))
+
+    client = FakeClient({
+        "streams": _plan("COLLSCAN"),
+        "follows": {"stages": [{"$cursor": {"queryPlanner": {
+            "winningPlan": {"stage": "IXSCAN"},
+            "rejectedPlans": [{"stage": "COLLSCAN"}]
+        }}}]}
+    })
+    collection_scans = asyncio.run(recorder.check(client))
+    assert len(collection_scans) == 1 and "category_slug" in collection_scans[0]
+
+
+def test_unfiltered_reads_and_other_commands_are_skipped():
+    recorder = QueryShapeRecorder()
+    recorder.started(_started("find", {"find": "categories", "filter": {}}))
+    recorder.started(_started("aggregate", {"aggregate": "follows", "pipeline": [{"$group": {"_id": "$follower_id"}}]}))
+    recorder.started(_started("insert", {"insert": "chat_messages", "documents": [{}]}))
+    recorder.started(_started("ping", {"ping": 1}, database_name="admin"))
+    client = FakeClient({})
+    assert asyncio.run(recorder.check(client)) == []
+    assert client.explained == []
+
+
+def test_collection_scan_is_found_in_slot_based_plans():
+    assert scans_collection({"queryPlanner": {"winningPlan": {"queryPlan": {"stage": "COLLSCAN"}}}})
+    assert not scans_collection(_plan("IXSCAN"))
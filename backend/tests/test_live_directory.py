@@ -0,0 +1,59 @@
+"""Single-flight rebuilds and invalidation of the cached live directory."""
+import asyncio
+from live_directory import LiveDirectory
+
+
+def test_concurrent_misses_share_one_rebuild():
+    async def scenario():
+        directory = LiveDirectory()
+        loads = []
+
+        async def load():
+            loads.append(1)
+            await asyncio.sleep(0.01)
+            return [{"title": "speedrun"}]
+
+        pages = await asyncio.gather(*(directory.get("page-1", load) for _ in range(5)))
+        assert len(loads) == 1
+        assert len({page.etag for page in pages}) == 1
+        # Served from the cache until it expires or is invalidated
+        await directory.get("page-1", load)
+        assert len(loads) == 1
+
+    asyncio.run(scenario())
+
+
+def test_rebuild_started_before_an_invalidation_is_not_cached():
+    async def scenario():
+        directory = LiveDirectory()
+        loads = []
+
+        async def load():
+            loads.append(1)
+            await asyncio.sleep(0.01)
+            return [len(loads)]
+
+        pending = asyncio.ensure_future(directory.get("page-1", load))
+        while not loads:
+            await asyncio.sleep(0)
+        directory.invalidate()
+        await pending
+        await directory.get("page-1", load)
+        assert len(loads) == 2
+
+    asyncio.run(scenario())
+
+
+def test_etag_follows_the_content():
+    async def scenario():
+        directory = LiveDirectory(ttl_seconds=0)
+
+        async def first():
+            return [1]
+
+        async def second():
+            return [2]
+
+        assert (await directory.get("page-1", first)).etag != (await directory.get("page-1", second)).etag
+
+    asyncio.run(scenario())
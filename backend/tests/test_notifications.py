@@ -0,0 +1,36 @@
+"""Notification sockets share the chat writer's eviction and drop accounting."""
+import asyncio
+from backplane import InProcessBackplane
+import websocket_manager
+from notifications import NotificationHub
+from test_websocket_manager import FakeWebSocket
+
+
+def test_a_failed_send_closes_the_notification_socket():
+    async def scenario():
+        hub = NotificationHub(InProcessBackplane())
+        websocket = FakeWebSocket(fail_sends=True)
+        await hub.connect(websocket, directory=True)
+        await asyncio.sleep(0.01)
+        # Closing is what ends the /ws/notifications receive loop
+        assert websocket.closed_with == websocket_manager.SLOW_CONSUMER_CLOSE_CODE
+        assert hub.subscriber_count() == 0
+
+    asyncio.run(scenario())
+
+
+def test_the_drop_allowance_resets_once_the_queue_drains():
+    async def scenario():
+        hub = NotificationHub(InProcessBackplane())
+        websocket = FakeWebSocket()
+        await hub.connect(websocket, directory=True)
+        await asyncio.sleep(0.01)
+        client = hub._subscribers[websocket].client
+        client.dropped = websocket_manager.MAX_DROPPED_MESSAGES
+
+        await hub.deliver_local("streamer-1:stream-1", '{"type": "stream_live"}')
+        await asyncio.sleep(0.01)
+        assert client.dropped == 0
+        assert websocket.sent[-1] == {"type": "stream_live"}
+
+    asyncio.run(scenario())
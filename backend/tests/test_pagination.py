@@ -0,0 +1,53 @@
+"""Opaque keyset cursors: encoding, validation and the range query they produce."""
+import base64
+import pytest
+from bson import ObjectId, json_util
+from datetime import datetime
+from fastapi import HTTPException
+from pagination import apply_cursor, decode_cursor, encode_cursor
+
+
+def _raw_cursor(payload) -> str:
+    return base64.urlsafe_b64encode(json_util.dumps(payload).encode()).decode().rstrip("=")
+
+
+def test_cursor_round_trips_sort_value_and_id():
+    document_id = ObjectId()
+    started_at = datetime(2024, 5, 1, 12, 30)
+    for value in (42, 1.5, "gamer", started_at, None):
+        assert decode_cursor(encode_cursor(value, document_id)) == (value, document_id)
+
+
+@pytest.mark.parametrize("cursor", [
+    "not a cursor",
+    _raw_cursor([1, "not-an-object-id"]),
+    _raw_cursor([{"$ne": None}, ObjectId()]),
+    _raw_cursor([[1, 2], ObjectId()]),
+])
+def test_malformed_cursors_are_rejected(cursor):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(cursor)
+    assert error.value.status_code == 400
+
+
+def test_forward_cursor_narrows_past_the_last_document():
+    document_id = ObjectId()
+    query, sort, reverse = apply_cursor({"is_live": True}, "viewer_count", -1, encode_cursor(10, document_id))
+    assert query == {"$and": [{"is_live": True}, {"$or": [
+        {"viewer_count": {"$lt": 10}},
+        {"viewer_count": 10, "_id": {"$lt": document_id}}
+    ]}]}
+    assert sort == [("viewer_count", -1), ("_id", -1)]
+    assert not reverse
+
+
+def test_backward_cursor_walks_back_and_asks_for_the_page_to_be_flipped():
+    document_id = ObjectId()
+    query, sort, reverse = apply_cursor({}, "viewer_count", -1, encode_cursor(10, document_id), forward=False)
+    assert query["$and"][1]["$or"][0] == {"viewer_count": {"$gt": 10}}
+    assert sort == [("viewer_count", 1), ("_id", 1)]
+    assert reverse
+
+
+def test_no_cursor_keeps_the_query():
+    assert apply_cursor({"a": 1}, "created_at", 1) == ({"a": 1}, [("created_at", 1), ("_id", 1)], False)
@@ -0,0 +1,42 @@
+"""Viewer counts in the shared Redis presence store, with fakeredis standing in for the server."""
+import asyncio
+import fakeredis
+from presence import RedisPresenceStore
+
+
+def test_viewers_are_deduplicated_across_workers():
+    async def scenario():
+        client = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        workers = [RedisPresenceStore(client=client) for _ in range(2)]
+        await workers[0].add("stream-1", "user:alice")
+        await workers[1].add("stream-1", "user:alice")
+        await workers[1].add("stream-1", "user:bob")
+        assert await workers[0].counts(["stream-1"]) == {"stream-1": 2}
+
+        await workers[1].remove("stream-1", "user:alice")
+        assert await workers[0].counts(["stream-1"]) == {"stream-1": 2}
+        await workers[0].remove("stream-1", "user:alice")
+        assert await workers[0].counts(["stream-1"]) == {"stream-1": 1}
+
+    asyncio.run(scenario())
+
+
+def test_viewers_of_a_crashed_worker_expire():
+    async def scenario():
+        client = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        alive = RedisPresenceStore(client=client, ttl=1)
+        crashed = RedisPresenceStore(client=client, ttl=1)
+        await alive.add("stream-1", "user:alice")
+        await crashed.add("stream-1", "user:bob")
+        await crashed.add("stream-2", "user:carol")
+        assert await alive.counts(["stream-1", "stream-2"]) == {"stream-1": 2, "stream-2": 1}
+
+        # Only the live worker keeps refreshing its sets
+        await asyncio.sleep(0.6)
+        await alive.refresh(["stream-1"])
+        await asyncio.sleep(0.6)
+        assert await alive.tracked_streams() == {"stream-1", "stream-2"}
+        assert await alive.counts(["stream-1", "stream-2"]) == {"stream-1": 1, "stream-2": 0}
+        assert await alive.tracked_streams() == {"stream-1"}
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+"""Token bucket refill, slow mode and the sender refund when a stream is saturated."""
+import asyncio
+import rate_limit
+from rate_limit import ChatRateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_sender_bucket_refills_at_the_slow_mode_rate(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = ChatRateLimiter(slow_mode_seconds=2, user_burst=2, stream_rate=100, stream_burst=100)
+
+    async def scenario():
+        assert await limiter.check("stream-1", "user:alice") == 0
+        assert await limiter.check("stream-1", "user:alice") == 0
+        assert await limiter.check("stream-1", "user:alice") == 2.0
+        # Other senders have their own bucket
+        assert await limiter.check("stream-1", "user:bob") == 0
+
+        clock.now += 1
+        assert await limiter.check("stream-1", "user:alice") == 1.0
+        clock.now += 1
+        assert await limiter.check("stream-1", "user:alice") == 0
+
+    asyncio.run(scenario())
+
+
+def test_saturated_stream_refunds_the_sender(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = ChatRateLimiter(slow_mode_seconds=1, user_burst=1, stream_rate=1, stream_burst=1)
+
+    async def scenario():
+        assert await limiter.check("stream-1", "user:alice") == 0
+        # Bob's token is given back, so his next try only waits on the stream
+        assert await limiter.check("stream-1", "user:bob") == 1.0
+        clock.now += 1
+        assert await limiter.check("stream-1", "user:bob") == 0
+
+    asyncio.run(scenario())
+
+
+def test_idle_buckets_are_evicted(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    limiter = ChatRateLimiter(idle_seconds=10)
+
+    async def scenario():
+        await limiter.check("stream-1", "user:alice")
+        clock.now += 11
+        await limiter.check("stream-2", "user:bob")
+        assert list(limiter._senders) == [("stream-2", "user:bob")]
+        assert list(limiter._streams) == ["stream-2"]
+
+    asyncio.run(scenario())
+
+
+def test_signed_in_senders_are_keyed_by_token_subject():
+    assert rate_limit.sender_key("alice", "203.0.113.7", None, "c1") == "user:alice"
+
+
+def test_anonymous_senders_behind_a_trusted_proxy_use_the_forwarded_address():
+    # The proxy appends the peer it saw; anything left of it is client-supplied
+    forwarded = "198.51.100.1, 203.0.113.7"
+    assert rate_limit.sender_key(None, "127.0.0.1", forwarded, "c1") == "addr:203.0.113.7"
+
+
+def test_forwarded_for_from_an_untrusted_peer_is_ignored():
+    assert rate_limit.sender_key(None, "203.0.113.7", "198.51.100.1", "c1") == "addr:203.0.113.7"
+
+
+def test_proxy_without_forwarded_for_falls_back_to_the_connection():
+    assert rate_limit.sender_key(None, "127.0.0.1", None, "c1") == "conn:c1"
+    assert rate_limit.sender_key(None, None, None, "c2") == "conn:c2"
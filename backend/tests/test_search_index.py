@@ -0,0 +1,59 @@
+"""Prefix search, rebuild swaps and category ranking in the in-process search index."""
+import asyncio
+from search_index import SearchIndex, category_doc, stream_doc, user_doc, KIND_STREAM
+
+
+def test_prefix_range_stops_at_the_last_matching_term():
+    index = SearchIndex()
+    index.add(user_doc({"_id": "u1", "username": "gamer_pro"}))
+    index.add(user_doc({"_id": "u2", "username": "gamez"}))
+    index.add(user_doc({"_id": "u3", "username": "gan"}))
+
+    assert {result["id"] for result in index.search("gam")} == {"u1", "u2"}
+    assert [result["id"] for result in index.search("gamer_p")] == ["u1"]
+    assert index.search("gb") == []
+
+
+def test_writes_during_a_rebuild_survive_the_swap():
+    async def scenario():
+        index = SearchIndex()
+        index.add(stream_doc({"_id": "s1", "title": "speedrun", "is_live": False}))
+
+        async def load_docs():
+            # Served by this worker while the scans are still running
+            index.add(stream_doc({"_id": "s2", "title": "speedrun any%"}))
+            index.update_rank(KIND_STREAM, "s1", is_live=True, viewers=7)
+            return [stream_doc({"_id": "s1", "title": "speedrun", "is_live": False})]
+
+        index._load_docs = load_docs
+        await index.rebuild()
+
+        results = {result["id"]: result for result in index.search("speed")}
+        assert set(results) == {"s1", "s2"}
+        assert results["s1"]["is_live"] and results["s1"]["viewer_count"] == 7
+
+    asyncio.run(scenario())
+
+
+def test_category_rank_follows_its_counters():
+    index = SearchIndex()
+    index.add(category_doc({"_id": "c1", "name": "Just Chatting", "slug": "just-chatting"}))
+    assert not index.search("chat")[0]["is_live"]
+
+    index.update_category_rank("just-chatting", is_live=True, viewers=12)
+    result = index.search("chat")[0]
+    assert result["is_live"] and result["viewer_count"] == 12
+
+
+
+def test_the_best_match_is_found_past_thousands_of_earlier_terms():
+    index = SearchIndex()
+    # Each title is its own term, all sorting before "gamezone"
+    for number in range(5000):
+        index.add(stream_doc({"_id": f"s{number}", "title": f"game{number:05d} chill"}))
+    index.add(stream_doc({"_id": "best", "title": "gamezone chill", "is_live": True, "viewer_count": 900}))
+
+    assert index.search("game", limit=1)[0]["id"] == "best"
+    # Intersections see every match of both words
+    assert [result["id"] for result in index.search("chill gamez")] == ["best"]
+    assert len(index.search("game chill", limit=50)) == 50
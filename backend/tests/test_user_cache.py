@@ -0,0 +1,52 @@
+"""TTL and size bounds of the authenticated user cache."""
+import user_cache as user_cache_module
+from user_cache import UserCache
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(user_cache_module.time, "monotonic", lambda: now[0])
+    cache = UserCache(ttl_seconds=30)
+    cache.set("alice", {"username": "alice"})
+
+    assert cache.get("alice") == {"username": "alice"}
+    now[0] += 31
+    assert cache.get("alice") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = UserCache(max_size=2)
+    cache.set("alice", {"username": "alice"})
+    cache.set("bob", {"username": "bob"})
+    cache.get("alice")
+    cache.set("carol", {"username": "carol"})
+
+    assert cache.get("bob") is None
+    assert cache.get("alice") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_callers_cannot_change_the_cached_document():
+    cache = UserCache()
+    cache.set("alice", {"username": "alice", "followers_count": 1})
+    cache.get("alice")["followers_count"] = 99
+    assert cache.get("alice")["followers_count"] == 1
+
+    cache.invalidate("alice")
+    assert cache.get("alice") is None
+
+
+def test_lookups_are_exported_as_metrics():
+    import metrics
+    cache = UserCache(max_size=1)
+    cache.set("alice", {"username": "alice"})
+    cache.get("alice")
+    cache.get("bob")
+    cache.set("bob", {"username": "bob"})
+
+    exported = metrics.render()
+    assert 'user_cache_lookups_total{result="hit"}' in exported
+    assert 'user_cache_lookups_total{result="miss"}' in exported
+    assert "user_cache_evictions_total" in exported
+    assert "user_cache_entries" in exported
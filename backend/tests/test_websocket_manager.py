@@ -0,0 +1,76 @@
+"""Chat socket heartbeats and eviction on one worker."""
+import asyncio
+from backplane import InProcessBackplane
+from serialization import loads
+import websocket_manager
+from websocket_manager import ConnectionManager
+
+
+class FakeWebSocket:
+    def __init__(self, query_params=None, fail_sends=False):
+        self.scope = {"subprotocols": []}
+        self.query_params = query_params or {}
+        self.fail_sends = fail_sends
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, frame):
+        if self.fail_sends:
+            raise RuntimeError("connection reset")
+        self.sent.append(loads(frame))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def test_only_heartbeat_clients_are_pinged_and_evicted_when_idle():
+    async def scenario():
+        manager = ConnectionManager(InProcessBackplane())
+        legacy = FakeWebSocket()
+        heartbeat = FakeWebSocket({"heartbeat": "1"})
+        await manager.connect(legacy, "stream-1")
+        await manager.connect(heartbeat, "stream-1")
+        await asyncio.sleep(0.01)
+        for client in manager.active_connections["stream-1"].values():
+            client.last_seen -= websocket_manager.IDLE_TIMEOUT_SECONDS + 1
+
+        assert await manager.reap_idle() == 1
+        await asyncio.sleep(0.01)
+        assert heartbeat.closed_with == websocket_manager.IDLE_CLOSE_CODE
+        assert legacy.closed_with is None
+        assert list(manager.active_connections["stream-1"]) == [legacy]
+        assert not any(frame["type"] == "ping" for frame in legacy.sent)
+
+    asyncio.run(scenario())
+
+
+def test_any_inbound_frame_keeps_a_heartbeat_client_alive():
+    async def scenario():
+        manager = ConnectionManager(InProcessBackplane())
+        websocket = FakeWebSocket({"heartbeat": "1"})
+        await manager.connect(websocket, "stream-1")
+        await asyncio.sleep(0.01)
+        client = manager.active_connections["stream-1"][websocket]
+        client.last_seen -= websocket_manager.IDLE_TIMEOUT_SECONDS + 1
+
+        manager.mark_alive(websocket, "stream-1")
+        assert await manager.reap_idle() == 0
+        assert websocket.closed_with is None
+
+    asyncio.run(scenario())
+
+
+
+def test_a_failed_send_closes_the_socket():
+    async def scenario():
+        manager = ConnectionManager(InProcessBackplane())
+        websocket = FakeWebSocket(fail_sends=True)
+        await manager.connect(websocket, "stream-1")
+        await asyncio.sleep(0.01)
+        assert websocket.closed_with == websocket_manager.SLOW_CONSUMER_CLOSE_CODE
+        assert websocket not in manager.active_connections.get("stream-1", {})
+
+    asyncio.run(scenario())
@@ -0,0 +1,83 @@
+"""
+TTL- and size-bounded cache of authenticated users, keyed by JWT subject.
+
+verify_token reads through this cache so authenticated requests do not pay
+a MongoDB round trip each time. Routes that write to a user document call
+invalidate() so the next request reloads it; the TTL bounds how stale an
+entry can get on other workers. Hits, misses and evictions are also
+exported at /metrics.
+"""
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import os
+import time
+from dotenv import load_dotenv
+from metrics import Counter, Gauge
+
+load_dotenv()
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+
+user_cache_lookups = Counter("user_cache_lookups_total", "Authenticated user cache lookups", ["result"])
+user_cache_evictions = Counter("user_cache_evictions_total", "Users evicted from the cache to stay under its size")
+user_cache_size = Gauge("user_cache_entries", "Users held in the cache on this worker")
+
+
+class UserCache:
+    def __init__(self, ttl_seconds: float = USER_CACHE_TTL_SECONDS, max_size: int = USER_CACHE_MAX_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, username: str) -> Optional[dict]:
+        entry = self._entries.get(username)
+        if entry is None:
+            self.misses += 1
+            user_cache_lookups.inc(1, "miss")
+            return None
+
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[username]
+            self.misses += 1
+            user_cache_lookups.inc(1, "miss")
+            return None
+
+        self._entries.move_to_end(username)
+        self.hits += 1
+        user_cache_lookups.inc(1, "hit")
+        # Callers get their own copy so they cannot alter the cached document
+        return dict(user)
+
+    def set(self, username: str, user: dict):
+        self._entries[username] = (time.monotonic() + self.ttl_seconds, dict(user))
+        self._entries.move_to_end(username)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            user_cache_evictions.inc()
+
+    def invalidate(self, *usernames: str):
+        for username in usernames:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+
+user_cache = UserCache()
+user_cache_size.set_function(lambda: {(): len(user_cache._entries)})
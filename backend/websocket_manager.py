@@ -1,51 +1,449 @@
 from fastapi import WebSocket
-from typing import Dict, List
-import json
+from typing import Dict, List, Optional, Set, Union
+from datetime import datetime
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from backplane import Backplane, create_backplane
+from chat_history import ChatHistory, chat_history
+from metrics import Counter, Gauge, Histogram
+from chat_protocol import PROTOCOL_JSON, PROTOCOL_MSGPACK, CompactEncoder, CompactFrame, negotiate
+from serialization import dumps_str, loads
+
+load_dotenv()
+
+# Fan-out configuration
+SEND_QUEUE_SIZE = int(os.getenv("CHAT_SEND_QUEUE_SIZE", "256"))
+SEND_TIMEOUT_SECONDS = float(os.getenv("CHAT_SEND_TIMEOUT_SECONDS", "5"))
+# "drop_oldest" keeps slow viewers connected but skips stale messages,
+# "disconnect" closes them as soon as their queue overflows
+SLOW_CONSUMER_POLICY = os.getenv("CHAT_SLOW_CONSUMER_POLICY", "drop_oldest")
+MAX_DROPPED_MESSAGES = int(os.getenv("CHAT_MAX_DROPPED_MESSAGES", "1000"))
+
+# Heartbeats: clients that opt in with ?heartbeat=1 are sent JSON pings when
+# quiet and evicted once idle for too long. Other clients (older frontends,
+# watch-only viewers) are left to the server's protocol-level WebSocket
+# pings, which close sockets that stop answering (uvicorn ws_ping_*)
+HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("CHAT_HEARTBEAT_INTERVAL_SECONDS", "20"))
+IDLE_TIMEOUT_SECONDS = float(os.getenv("CHAT_IDLE_TIMEOUT_SECONDS", "60"))
+REAPER_BATCH_SIZE = int(os.getenv("CHAT_REAPER_BATCH_SIZE", "500"))
+CLOSE_TIMEOUT_SECONDS = float(os.getenv("CHAT_CLOSE_TIMEOUT_SECONDS", "5"))
+
+# Close code sent to viewers that fall too far behind (RFC 6455 "try again later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# Close code sent to viewers that stopped answering heartbeats ("going away")
+IDLE_CLOSE_CODE = 1001
+
+# Opt-in batching: above the rate threshold, a stream's frames are coalesced
+# into one "chat_batch" frame per window (the window grows with the rate)
+BATCHING_ENABLED = os.getenv("CHAT_BATCHING_ENABLED", "false").lower() == "true"
+BATCH_RATE_THRESHOLD = float(os.getenv("CHAT_BATCH_RATE_THRESHOLD", "20"))
+BATCH_MIN_WINDOW_MS = float(os.getenv("CHAT_BATCH_MIN_WINDOW_MS", "50"))
+BATCH_MAX_WINDOW_MS = float(os.getenv("CHAT_BATCH_MAX_WINDOW_MS", "100"))
+
+
+chat_fanout_duration = Histogram(
+    "chat_fanout_duration_seconds", "Time to queue one frame for every local viewer of a stream"
+)
+chat_fanout_recipients = Counter("chat_fanout_recipients_total", "Frames queued for chat viewers")
+chat_evictions = Counter("chat_evicted_connections_total", "Chat sockets closed by the server", ["reason"])
+chat_connections = Gauge("chat_connections", "Open chat sockets on this worker", ["stream_id"])
+chat_queued_frames = Gauge("chat_send_queue_depth", "Frames waiting in viewers' send queues", ["stream_id"])
+
+
+def chat_deleted_frame(stream_id: str, message_id: str) -> dict:
+    """WebSocket frame telling viewers (and every worker's history) that a message was deleted"""
+    return {"type": "chat_message_deleted", "stream_id": stream_id, "id": message_id}
+
+
+def chat_message_frame(message: dict) -> dict:
+    """WebSocket frame for a formatted chat message (id, username, message, color, timestamp)"""
+    return {
+        "type": "chat_message",
+        "id": message.get("id"),
+        "username": message["username"],
+        "message": message["message"],
+        "timestamp": message["timestamp"].isoformat(),
+        "color": message["color"]
+    }
+
+
+class ClientConnection:
+    """A single chat socket with its own bounded outbound queue and writer task"""
+
+    def __init__(self, websocket: WebSocket, stream_id: str, protocol: str = PROTOCOL_JSON, heartbeats: bool = False):
+        self.websocket = websocket
+        self.stream_id = stream_id
+        self.protocol = protocol
+        # Whether the client answers JSON pings, so idling can evict it
+        self.heartbeats = heartbeats
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        # Frames dropped since the queue last drained
+        self.dropped = 0
+        # Last time anything was received from the client
+        self.last_seen = time.monotonic()
+        self.writer_task: Optional[asyncio.Task] = None
+        # Interned strings already sent to a compact client, per table generation
+        self.known_refs: Set[int] = set()
+        self.refs_generation = 0
+
+    def enqueue(self, frame: str) -> bool:
+        """Queue a pre-serialized frame without blocking; False means the client is too slow"""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if SLOW_CONSUMER_POLICY == "disconnect":
+            return False
+
+        # Drop the oldest pending frame to make room for the newest one
+        try:
+            self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        self.dropped += 1
+        if self.dropped > MAX_DROPPED_MESSAGES:
+            return False
+        self.queue.put_nowait(frame)
+        return True
+
+    def enqueue_compact(self, frame: CompactFrame) -> bool:
+        """Queue a compact frame, preceded by the interned strings this client has not seen"""
+        if self.refs_generation != frame.generation:
+            self.known_refs = set()
+            self.refs_generation = frame.generation
+        missing = frame.refs.keys() - self.known_refs
+
+        if self.queue.maxsize - self.queue.qsize() < (2 if missing else 1):
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                return False
+            # Queued frames may depend on definitions that are still queued,
+            # so drop the whole backlog rather than just the oldest frame
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                self.dropped += 1
+            if self.dropped > MAX_DROPPED_MESSAGES:
+                return False
+            self.known_refs = set()
+            missing = frame.refs.keys()
+
+        if missing:
+            self.queue.put_nowait(CompactEncoder.define_frame({ref: frame.refs[ref] for ref in missing}))
+            self.known_refs.update(missing)
+        self.queue.put_nowait(frame.body)
+        return True
+
+    async def drain(self):
+        """Send queued frames until the socket fails; raises when it is dead or stalled"""
+        while True:
+            frame: Union[str, bytes] = await self.queue.get()
+            if isinstance(frame, bytes):
+                send = self.websocket.send_bytes(frame)
+            else:
+                send = self.websocket.send_text(frame)
+            await asyncio.wait_for(send, SEND_TIMEOUT_SECONDS)
+            # A viewer that caught up starts over on its drop allowance
+            if self.dropped and self.queue.empty():
+                self.dropped = 0
+
+
+async def close_client(client: ClientConnection, code: int):
+    """Close an evicted socket so its handler's receive loop ends"""
+    # A half-open socket may never finish the closing handshake
+    try:
+        await asyncio.wait_for(client.websocket.close(code=code), CLOSE_TIMEOUT_SECONDS)
+    except Exception:
+        pass
+
+
+class StreamBatch:
+    """Per-stream message rate and frames waiting for the current batch window"""
+
+    __slots__ = ("frames", "flush_handle", "window_started", "window_count", "rate")
+
+    def __init__(self, now: float):
+        self.frames: List[str] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.window_started = now
+        self.window_count = 0
+        self.rate = 0.0
+
+    def observe(self, now: float) -> float:
+        """Count a message and return the stream's current messages per second"""
+        elapsed = now - self.window_started
+        if elapsed >= 1:
+            self.rate = self.window_count / elapsed
+            self.window_started = now
+            self.window_count = 0
+        self.window_count += 1
+        return max(self.rate, self.window_count)
+
+    def window_seconds(self) -> float:
+        # Busier rooms get longer windows, within the configured bounds
+        scaled = BATCH_MIN_WINDOW_MS * max(self.rate, self.window_count) / BATCH_RATE_THRESHOLD
+        return min(BATCH_MAX_WINDOW_MS, max(BATCH_MIN_WINDOW_MS, scaled)) / 1000
+
 
 class ConnectionManager:
-    def __init__(self):
-        # Store connections by stream_id
-        self.active_connections: Dict[str, List[WebSocket]] = {}
-    
+    def __init__(self, backplane: Optional[Backplane] = None, history: Optional[ChatHistory] = None):
+        # Store connections by stream_id, keyed by socket for O(1) lookup
+        self.active_connections: Dict[str, Dict[WebSocket, ClientConnection]] = {}
+        self.backplane = backplane or create_backplane()
+        # Recent chat replayed to new sockets, recorded from every delivered message
+        self.history = history
+        self.batching_enabled = BATCHING_ENABLED
+        self._batches: Dict[str, StreamBatch] = {}
+        # Per-stream intern tables, shared by that stream's compact clients
+        self._encoders: Dict[str, CompactEncoder] = {}
+        self._reaper_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self.backplane.start(self.deliver_local)
+        self._reaper_task = asyncio.create_task(self._reaper())
+
+    async def close(self):
+        if self._reaper_task:
+            self._reaper_task.cancel()
+        await self.backplane.close()
+
     async def connect(self, websocket: WebSocket, stream_id: str):
-        await websocket.accept()
-        if stream_id not in self.active_connections:
-            self.active_connections[stream_id] = []
-        self.active_connections[stream_id].append(websocket)
-        
+        protocol, subprotocol = negotiate(websocket)
+        await websocket.accept(subprotocol=subprotocol)
+        heartbeats = websocket.query_params.get("heartbeat", "").lower() in ("1", "true")
+        client = ClientConnection(websocket, stream_id, protocol, heartbeats)
+        first_socket = stream_id not in self.active_connections
+        self.active_connections.setdefault(stream_id, {})[websocket] = client
+        client.writer_task = asyncio.create_task(self._writer(client))
+        if first_socket:
+            await self.backplane.subscribe(stream_id)
+
         # Send welcome message
-        await websocket.send_text(json.dumps({
+        self._send(client, dumps_str({
             "type": "system",
             "message": "Connected to chat",
-            "stream_id": stream_id
+            "stream_id": stream_id,
+            "protocol": protocol,
+            "heartbeat": heartbeats
         }))
-    
+
+        # Replay recent chat so the viewer does not join an empty room
+        if self.history:
+            for message in self.history.recent(stream_id):
+                self._send(client, dumps_str(chat_message_frame(message)))
+
     def disconnect(self, websocket: WebSocket, stream_id: str):
+        connections = self.active_connections.get(stream_id)
+        if connections is None:
+            return
+
+        client = connections.pop(websocket, None)
+        if client and client.writer_task and client.writer_task is not asyncio.current_task():
+            client.writer_task.cancel()
+
+        # Clean up empty stream connections
+        if not connections:
+            del self.active_connections[stream_id]
+            self._encoders.pop(stream_id, None)
+            batch = self._batches.pop(stream_id, None)
+            if batch and batch.flush_handle:
+                batch.flush_handle.cancel()
+            asyncio.create_task(self._release_stream(stream_id))
+
+    async def _release_stream(self, stream_id: str):
+        # A socket may have joined again before this ran
         if stream_id in self.active_connections:
-            if websocket in self.active_connections[stream_id]:
-                self.active_connections[stream_id].remove(websocket)
-            
-            # Clean up empty stream connections
-            if not self.active_connections[stream_id]:
-                del self.active_connections[stream_id]
-    
+            return
+        try:
+            await self.backplane.unsubscribe(stream_id)
+        except Exception as e:
+            print(f"❌ Chat backplane unsubscribe failed: {e}")
+        if self.history and not self.backplane.receives(stream_id):
+            # The buffer stops following the stream's chat, so it would go stale
+            self.history.clear(stream_id)
+
+    def tracks_history(self, stream_id: str) -> bool:
+        """Whether this worker's recent chat buffer receives every message of the stream"""
+        return self.history is not None and self.backplane.receives(stream_id)
+
+    def mark_alive(self, websocket: WebSocket, stream_id: str):
+        """Record that the client sent something; any inbound frame counts, not just pongs"""
+        client = self.active_connections.get(stream_id, {}).get(websocket)
+        if client:
+            client.last_seen = time.monotonic()
+
     async def send_personal_message(self, message: str, websocket: WebSocket):
+        for connections in self.active_connections.values():
+            client = connections.get(websocket)
+            if client:
+                self._send(client, message)
+                return
         await websocket.send_text(message)
-    
+
     async def broadcast_to_stream(self, stream_id: str, message: dict):
-        if stream_id in self.active_connections:
-            # Send to all connected clients in this stream
-            disconnected_clients = []
-            for connection in self.active_connections[stream_id]:
-                try:
-                    await connection.send_text(json.dumps(message))
-                except Exception:
-                    # Connection is dead, mark for removal
-                    disconnected_clients.append(connection)
-            
-            # Remove dead connections
-            for connection in disconnected_clients:
-                self.disconnect(connection, stream_id)
-    
+        # Serialize once and publish once; every worker delivers to its own sockets
+        await self.backplane.publish(stream_id, dumps_str(message))
+
+    async def deliver_local(self, stream_id: str, frame: str):
+        if self.tracks_history(stream_id):
+            self._record_history(stream_id, frame)
+
+        if not self.batching_enabled or stream_id not in self.active_connections:
+            self._fan_out(stream_id, frame)
+            return
+
+        batch = self._batches.get(stream_id)
+        if batch is None:
+            batch = self._batches[stream_id] = StreamBatch(time.monotonic())
+        rate = batch.observe(time.monotonic())
+
+        # Quiet rooms keep per-message frames for the lowest latency
+        if batch.flush_handle is None and rate < BATCH_RATE_THRESHOLD:
+            self._fan_out(stream_id, frame)
+            return
+
+        batch.frames.append(frame)
+        if batch.flush_handle is None:
+            batch.flush_handle = asyncio.get_running_loop().call_later(
+                batch.window_seconds(), self._flush_batch, stream_id
+            )
+
+    def _flush_batch(self, stream_id: str):
+        batch = self._batches.get(stream_id)
+        if batch is None:
+            return
+        frames, batch.frames = batch.frames, []
+        batch.flush_handle = None
+
+        if len(frames) == 1:
+            self._fan_out(stream_id, frames[0])
+        elif frames:
+            # Frames are already serialized, so the batch is assembled without re-encoding
+            self._fan_out(
+                stream_id,
+                f'{{"type":"chat_batch","stream_id":{dumps_str(stream_id)},"messages":[{",".join(frames)}]}}'
+            )
+
+    def _fan_out(self, stream_id: str, frame: str):
+        connections = self.active_connections.get(stream_id)
+        if not connections:
+            return
+        started = time.perf_counter()
+
+        # Hand the same frame to every local viewer's queue; compact viewers
+        # share one encoding of it
+        compact: Optional[CompactFrame] = None
+        slow_clients = []
+        for client in connections.values():
+            if client.protocol == PROTOCOL_MSGPACK:
+                if compact is None:
+                    compact = self._encoder(stream_id).encode(frame)
+                queued = client.enqueue_compact(compact)
+            else:
+                queued = client.enqueue(frame)
+            if not queued:
+                slow_clients.append(client)
+
+        chat_fanout_recipients.inc(len(connections))
+        chat_fanout_duration.observe(time.perf_counter() - started)
+
+        # Remove viewers that fell too far behind
+        for client in slow_clients:
+            self._evict(client, SLOW_CONSUMER_CLOSE_CODE)
+
+    def _send(self, client: ClientConnection, frame: str) -> bool:
+        """Queue a JSON frame for one client in its negotiated protocol"""
+        if client.protocol == PROTOCOL_MSGPACK:
+            return client.enqueue_compact(self._encoder(client.stream_id).encode(frame))
+        return client.enqueue(frame)
+
+    def _encoder(self, stream_id: str) -> CompactEncoder:
+        encoder = self._encoders.get(stream_id)
+        if encoder is None:
+            encoder = self._encoders[stream_id] = CompactEncoder()
+        return encoder
+
     async def get_stream_viewer_count(self, stream_id: str) -> int:
-        return len(self.active_connections.get(stream_id, []))
\ No newline at end of file
+        return len(self.active_connections.get(stream_id, {}))
+
+    def _record_history(self, stream_id: str, frame: str):
+        data = loads(frame)
+        if data.get("type") == "chat_message_deleted":
+            self.history.remove(stream_id, data["id"])
+            return
+        if data.get("type") != "chat_message":
+            return
+        self.history.append(stream_id, {
+            "id": data.get("id"),
+            "username": data["username"],
+            "message": data["message"],
+            "color": data["color"],
+            "timestamp": datetime.fromisoformat(data["timestamp"])
+        })
+
+    async def _writer(self, client: ClientConnection):
+        """Drain a client's queue so a slow socket only ever delays itself"""
+        try:
+            await client.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Connection is dead or stalled: close it too, so the chat handler's
+            # receive loop ends and the viewer leaves presence
+            self._evict(client, SLOW_CONSUMER_CLOSE_CODE)
+
+    async def reap_idle(self) -> int:
+        """Ping quiet heartbeat clients and evict the ones idle past the timeout; returns the evicted count"""
+        now = time.monotonic()
+        clients = [
+            client
+            for connections in self.active_connections.values()
+            for client in connections.values()
+            if client.heartbeats
+        ]
+        ping = dumps_str({"type": "ping"})
+        reaped = 0
+
+        for start in range(0, len(clients), REAPER_BATCH_SIZE):
+            for client in clients[start:start + REAPER_BATCH_SIZE]:
+                if client.websocket not in self.active_connections.get(client.stream_id, {}):
+                    continue
+                idle = now - client.last_seen
+                if idle >= IDLE_TIMEOUT_SECONDS:
+                    self._evict(client, IDLE_CLOSE_CODE)
+                    reaped += 1
+                elif idle >= HEARTBEAT_INTERVAL_SECONDS and not self._send(client, ping):
+                    self._evict(client, SLOW_CONSUMER_CLOSE_CODE)
+                    reaped += 1
+            # Let chat traffic run between batches
+            await asyncio.sleep(0)
+        return reaped
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL_SECONDS)
+            try:
+                reaped = await self.reap_idle()
+                if reaped:
+                    print(f"🧹 Evicted {reaped} idle chat connections")
+            except Exception as e:
+                print(f"❌ Chat connection reaper failed: {e}")
+
+    def _evict(self, client: ClientConnection, code: int):
+        chat_evictions.inc(1, "idle" if code == IDLE_CLOSE_CODE else "slow")
+        self.disconnect(client.websocket, client.stream_id)
+        asyncio.create_task(close_client(client, code))
+
+
+# Shared by the chat socket in main.py and the REST routers
+manager = ConnectionManager(history=chat_history)
+
+chat_connections.set_function(lambda: {
+    (stream_id,): len(connections) for stream_id, connections in manager.active_connections.items()
+})
+chat_queued_frames.set_function(lambda: {
+    (stream_id,): sum(client.queue.qsize() for client in connections.values())
+    for stream_id, connections in manager.active_connections.items()
+})
@@ -15,16 +15,35 @@ class ApiService {
     }
   }
 
+  // Per-tab chat session id for presence; kept across reloads of the same tab
+  getChatSessionId() {
+    let sessionId = sessionStorage.getItem('chatSessionId');
+    if (!sessionId) {
+      sessionId = window.crypto.randomUUID
+        ? window.crypto.randomUUID()
+        : `${Date.now().toString(36)}${Math.random().toString(36).slice(2)}`;
+      sessionStorage.setItem('chatSessionId', sessionId);
+    }
+    return sessionId;
+  }
+
   getAuthHeaders() {
     return this.token ? { 'Authorization': `Bearer ${this.token}` } : {};
   }
 
+  // Position of this browser's latest write, echoed back so any server sees it
+  getCausalHeaders() {
+    const position = localStorage.getItem('causalPosition');
+    return position ? { 'X-Causal-Position': position } : {};
+  }
+
   async request(endpoint, options = {}) {
     const url = `${API_BASE_URL}${endpoint}`;
     const config = {
       headers: {
         'Content-Type': 'application/json',
         ...this.getAuthHeaders(),
+        ...this.getCausalHeaders(),
         ...options.headers,
       },
       ...options,
@@ -32,6 +51,10 @@ class ApiService {
 
     try {
       const response = await fetch(url, config);
+      const position = response.headers.get('X-Causal-Position');
+      if (position) {
+        localStorage.setItem('causalPosition', position);
+      }
       
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({}));
@@ -135,6 +158,12 @@ class ApiService {
     return this.request(`/api/categories/${categorySlug}`);
   }
 
+  async search(query, limit = 10, kind = null) {
+    const params = new URLSearchParams({ q: query, limit });
+    if (kind) params.set('kind', kind);
+    return this.request(`/api/search?${params}`);
+  }
+
   async getCategoryStreams(categorySlug, limit = 20, skip = 0) {
     return this.request(`/api/categories/${categorySlug}/streams?limit=${limit}&skip=${skip}`);
   }
@@ -153,7 +182,11 @@ class ApiService {
 
   // WebSocket for real-time chat
   connectToChat(streamId, onMessage, onConnect, onDisconnect) {
-    const ws = new WebSocket(`${WS_BASE_URL}/ws/chat/${streamId}`);
+    // Presence counts a signed-in user once across tabs, anonymous viewers once per tab
+    // heartbeat=1: this client answers JSON pings, so the server may evict it when idle
+    const params = new URLSearchParams({ session_id: this.getChatSessionId(), heartbeat: '1' });
+    if (this.token) params.set('token', this.token);
+    const ws = new WebSocket(`${WS_BASE_URL}/ws/chat/${streamId}?${params}`);
     
     ws.onopen = (event) => {
       console.log('Connected to chat:', streamId);
@@ -163,7 +196,18 @@ class ApiService {
     ws.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
-        if (onMessage) onMessage(data);
+        // Answer heartbeats so the server keeps the socket
+        if (data.type === 'ping') {
+          ws.send(JSON.stringify({ type: 'pong' }));
+          return;
+        }
+        if (!onMessage) return;
+        // Busy rooms may deliver several messages in one batched frame
+        if (data.type === 'chat_batch') {
+          data.messages.forEach(onMessage);
+        } else {
+          onMessage(data);
+        }
       } catch (error) {
         console.error('Error parsing message:', error);
       }
@@ -187,6 +231,47 @@ class ApiService {
       close: () => ws.close(),
     };
   }
+
+  // WebSocket for live-status notifications (go live/offline, stream updates, viewer counts)
+  connectToNotifications(onEvent, { streamIds = [], directory = false } = {}) {
+    const params = new URLSearchParams();
+    if (this.token) params.set('token', this.token);
+    if (streamIds.length) params.set('streams', streamIds.join(','));
+    if (directory) params.set('directory', 'true');
+    const ws = new WebSocket(`${WS_BASE_URL}/ws/notifications?${params}`);
+
+    ws.onmessage = (event) => {
+      try {
+        const data = JSON.parse(event.data);
+        if (onEvent && data.type !== 'system') onEvent(data);
+      } catch (error) {
+        console.error('Error parsing notification:', error);
+      }
+    };
+
+    ws.onerror = (error) => {
+      console.error('Notifications WebSocket error:', error);
+    };
+
+    const send = (message) => {
+      if (ws.readyState === WebSocket.OPEN) {
+        ws.send(JSON.stringify(message));
+      }
+    };
+
+    return {
+      watch: (streamId) => send({ type: 'watch', stream_id: streamId }),
+      unwatch: (streamId) => send({ type: 'unwatch', stream_id: streamId }),
+      close: () => ws.close(),
+    };
+  }
+
+  async updateStream(streamId, streamData) {
+    return this.request(`/api/streams/${streamId}`, {
+      method: 'PUT',
+      body: JSON.stringify(streamData),
+    });
+  }
 }
 
 export const apiService = new ApiService();
@@ -150,6 +150,10 @@ const StreamPage = () => {
   };
 
   const handleChatMessage = (messageData) => {
+    if (messageData.type === 'chat_message_deleted') {
+      setChatMessages(prev => prev.filter(message => message.id !== messageData.id));
+      return;
+    }
     setChatMessages(prev => [...prev.slice(-49), messageData]);
   };
 